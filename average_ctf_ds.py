@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Average the epochs around a mark of a CTF .ds dataset without the CTF tools
+
+Replaces averageDs, addMarker and newDs -resample:
+    the raw meg4 data are memory-mapped and each epoch (tmin to tmax around the
+    mark) is read in turn and added to a running sum, so only one epoch is held
+    in memory. The mean is resampled with a polyphase filter (scipy resample_poly)
+    on a window padded by pad_time on both sides to keep the filter edges out of
+    the epoch, and the averaged dataset is written once: a res4 patched for one
+    trial, a meg4 with the averaged samples, a MarkerFile.mrk with the avgspike
+    mark at 0 s, and the remaining small files of the run (head model, hc, ...)
+
+grand_average_ds averages several runs in parallel, weighting each run by its
+number of epochs.
+
+Usage:
+    average_ds(ds_dir, out_ds, marker='S', tmin=-1.5, tmax=0.5, sample_rate=600)
+    grand_average_ds([ds_dir1, ds_dir2], out_ds, marker='S', n_jobs=2)
+
+Data are averaged in ADC counts; channel gains in the res4 are unchanged.
+"""
+import glob
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+from functools import partial
+import numpy as np
+from scipy.signal import resample_poly
+from read_ctf_ds import read_ds_info, ds_file, res4_fields
+
+#Padding (seconds) read around each epoch so the resampling filter edges fall outside the epoch
+pad_time=0.1
+
+def meg4_files(ds_dir):
+    '''The meg4 data files of the dataset in order (name.meg4, name.1_meg4, ...)'''
+    first=ds_file(ds_dir,'meg4')
+    if not os.path.exists(first):
+        raise ValueError(first + ' does not exist')
+    extra=glob.glob(ds_file(ds_dir,'*_meg4'))
+    extra=sorted(extra,key=lambda f: int(os.path.basename(f).split('.')[-1].split('_')[0]))
+    return [first]+extra
+
+def open_meg4(ds_info):
+    '''Memory-map the meg4 files as a list of (n_trials, n_channels, n_samples) int32 arrays'''
+    trial_bytes=4*ds_info.n_channels*ds_info.n_samples
+    meg4=[]
+    for meg4_file in meg4_files(ds_info.ds_dir):
+        n_trials=(os.path.getsize(meg4_file)-8)//trial_bytes
+        if n_trials > 0:
+            meg4.append(np.memmap(meg4_file,dtype='>i4',mode='r',offset=8,shape=(n_trials,ds_info.n_channels,ds_info.n_samples)))
+    return meg4
+
+def read_window(meg4, start, stop):
+    '''Read absolute samples start to stop (exclusive) of all channels as float64
+    Windows that cross trial (or meg4 file) boundaries are stitched together
+    Returns None if the window falls outside the recording'''
+    n_samples=meg4[0].shape[2]
+    trial_offsets=np.cumsum([0]+[len(m) for m in meg4])
+    if start < 0 or stop > trial_offsets[-1]*n_samples:
+        return None
+    pieces=[]
+    sample=start
+    while sample < stop:
+        trial=sample//n_samples
+        file_idx=np.searchsorted(trial_offsets,trial,side='right')-1
+        first=sample-trial*n_samples
+        last=min(n_samples,first+stop-sample)
+        pieces.append(meg4[file_idx][trial-trial_offsets[file_idx],:,first:last])
+        sample+=last-first
+    return np.concatenate(pieces,axis=1).astype(np.float64)
+
+def resample_ratio(sample_rate, new_sample_rate):
+    '''Up and down factors of the polyphase resampling'''
+    ratio=Fraction(new_sample_rate/sample_rate).limit_denominator(1000)
+    return ratio.numerator, ratio.denominator
+
+def average_epochs(ds_dir, marker='S', tmin=-1.5, tmax=0.5, sample_rate=600.):
+    '''Running mean of the tmin to tmax epochs around every mark, resampled to sample_rate
+    Returns the (n_channels, n_times) mean in ADC counts, the number of epochs
+    averaged, and the output sample rate'''
+    ds_info=read_ds_info(ds_dir)
+    if marker not in ds_info.markers:
+        raise ValueError('Mark {} not found in {}'.format(marker,ds_dir))
+    up,down=resample_ratio(ds_info.sample_rate, sample_rate)
+    # Pad by a multiple of down so the padding maps onto whole output samples
+    pad=int(down*np.ceil(pad_time*ds_info.sample_rate/down)) if (up,down) != (1,1) else 0
+    first=int(np.round(tmin*ds_info.sample_rate))
+    last=int(np.round(tmax*ds_info.sample_rate))
+    meg4=open_meg4(ds_info)
+    total=np.zeros((ds_info.n_channels,last-first+1+2*pad))
+    n_epochs=0
+    for sample in ds_info.marker_samples(marker):
+        epoch=read_window(meg4,sample+first-pad,sample+last+1+pad)
+        if epoch is None:
+            continue
+        total+=epoch
+        n_epochs+=1
+    if n_epochs == 0:
+        raise ValueError('No complete {} epochs in {}'.format(marker,ds_dir))
+    mean=total/n_epochs
+    if (up,down) != (1,1):
+        pad_out=pad*up//down
+        n_out=int(np.floor((last-first)*up/down))+1
+        mean=resample_poly(mean,up,down,axis=1)[:,pad_out:pad_out+n_out]
+        return mean, n_epochs, ds_info.sample_rate*up/down
+    return mean, n_epochs, ds_info.sample_rate
+
+def write_marker_file(mrk_file, markers, ds_dir=''):
+    '''Write a MarkerFile.mrk with a dictionary of mark name to a list of (trial, time) pairs'''
+    lines=['PATH OF DATASET:',ds_dir,'','','NUMBER OF MARKERS:',str(len(markers)),'','']
+    for class_id,(name,marks) in enumerate(markers.items()):
+        lines+=['CLASSGROUPID:','3','NAME:',name,'COMMENT:','','COLOR:','red','EDITABLE:','Yes',
+                'CLASSID:',str(class_id+1),'NUMBER OF SAMPLES:',str(len(marks)),'LIST OF SAMPLES:',
+                'TRIAL NUMBER\t\tTIME FROM SYNC POINT (in seconds)']
+        lines+=['                  {:+d}\t\t\t\t{:+.6f}'.format(int(trial),float(time)) for trial,time in marks]
+        lines+=['','']
+    with open(mrk_file,'w') as fid:
+        fid.write('\n'.join(lines)+'\n')
+
+def write_averaged_ds(template_ds, out_ds, data, n_averaged, sample_rate, tmin, marker='avgspike'):
+    '''Write data (n_channels, n_times, in ADC counts) as a one-trial dataset out_ds
+    The res4 of template_ds is copied with the trial layout, sample rate and number of
+    averages updated, and marker is placed at 0 s'''
+    template_ds=os.path.normpath(template_ds)
+    out_ds=os.path.normpath(out_ds)
+    if not out_ds.endswith('.ds'):
+        raise ValueError('Output dataset must end in .ds')
+    if os.path.exists(out_ds):
+        raise ValueError(out_ds + ' already exists')
+    os.makedirs(out_ds)
+    # Copy the small files (head model, head coils, ...) except the data, marks and history, and the bad segments and
+    # trial classes, whose times and trial numbers refer to the raw run (read_raw_ctf makes BAD annotations of bad.segments)
+    skip=('.res4','.meg4','_meg4','.hist','MarkerFile.mrk','bad.segments','ClassFile.cls')
+    for item in os.listdir(template_ds):
+        path=os.path.join(template_ds,item)
+        if os.path.isfile(path) and not item.endswith(skip):
+            shutil.copy2(path,os.path.join(out_ds,item))
+    n_channels,n_times=data.shape
+    with open(ds_file(template_ds,'res4'),'rb') as fid:
+        res4=bytearray(fid.read())
+    setup={'n_averaged':n_averaged,
+           'n_samples':n_times,
+           'sample_rate':sample_rate,
+           'epoch_time':n_times/sample_rate,
+           'n_trials':1,
+           'pre_trig_pts':int(np.round(-tmin*sample_rate))}
+    for key,value in setup.items():
+        offset,dtype=res4_fields[key]
+        res4[offset:offset+np.dtype(dtype).itemsize]=np.array(value,dtype=dtype).tobytes()
+    with open(ds_file(out_ds,'res4'),'wb') as fid:
+        fid.write(res4)
+    with open(meg4_files(template_ds)[0],'rb') as fid:
+        meg4_header=fid.read(8)
+    counts=np.clip(np.round(data),np.iinfo(np.int32).min,np.iinfo(np.int32).max).astype('>i4')
+    with open(ds_file(out_ds,'meg4'),'wb') as fid:
+        fid.write(meg4_header)
+        fid.write(counts.tobytes())
+    write_marker_file(os.path.join(out_ds,'MarkerFile.mrk'),{marker:[(0,0.0)]},ds_dir=out_ds)
+    with open(ds_file(out_ds,'hist'),'w') as fid:
+        fid.write('Averaged {} epochs of {}\n    Sample rate: {}\n'.format(n_averaged,template_ds,sample_rate))
+    return out_ds
+
+def average_ds(ds_dir, out_ds, marker='S', tmin=-1.5, tmax=0.5, sample_rate=600., avg_marker='avgspike'):
+    '''Average the epochs around marker of ds_dir, resample and write them to out_ds'''
+    mean,n_epochs,out_rate=average_epochs(ds_dir,marker=marker,tmin=tmin,tmax=tmax,sample_rate=sample_rate)
+    return write_averaged_ds(ds_dir,out_ds,mean,n_epochs,out_rate,tmin,marker=avg_marker)
+
+def grand_average_ds(ds_dirs, out_ds, marker='S', tmin=-1.5, tmax=0.5, sample_rate=600., avg_marker='avgspike', n_jobs=None):
+    '''Average the epochs of several runs in parallel (one process per run) and write
+    the grand average, weighted by the number of epochs of each run, to out_ds
+    The first run is used as the template for the channel layout'''
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        results=list(pool.map(partial(average_epochs,marker=marker,tmin=tmin,tmax=tmax,sample_rate=sample_rate),ds_dirs))
+    shapes=set(mean.shape for mean,n_epochs,out_rate in results)
+    if len(shapes) != 1:
+        raise ValueError('Runs do not share the same channels and epoch length')
+    n_total=sum(n_epochs for mean,n_epochs,out_rate in results)
+    grand_mean=sum(mean*n_epochs for mean,n_epochs,out_rate in results)/n_total
+    return write_averaged_ds(ds_dirs[0],out_ds,grand_mean,n_total,results[0][2],tmin,marker=avg_marker)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bootstrap stability of the dSPM spike localization
+
+Each replicate resamples the spike epochs with replacement and localizes their
+average as the dSPM stage does (inverse, then the centered moving average). As
+averaging and the inverse kernel are linear up to the x,y,z norm, a chunk of
+replicates is computed with two matrix products: the replicate weights
+(counts/n_epochs) times the epochs, then the kernel (see inverse_kernel.py)
+times the replicate averages. Only the samples the moving average needs around
+each latency are localized.
+
+For every source the result is the fraction of replicates in which it is in the
+top 5% (top) of sources at each latency (e.g. the first and peak samples from
+dipole_timing.txt). Replicates are never stored: each chunk only adds to the
+counts, so memory is bounded by chunk_replicates. Chunks run in n_jobs processes;
+each chunk has its own seed, so the result does not depend on n_jobs.
+
+Usage:
+    kernel=compute_inverse_kernel(inv, lambda2, 'dSPM', nave=len(epochs))
+    freq=bootstrap_top_frequency(kernel, epochs, [first_sample, peak_sample], n_rep=1000, window=30, n_jobs=4)
+"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+from inverse_kernel import kernel_picks, apply_kernel
+
+#Replicates localized per matrix product; bounds the (sources, replicates, samples) working array
+chunk_replicates=20
+
+def latency_windows(n_times, samples, window):
+    '''Sample indices averaged by the centered moving average (see smooth_stcs.py) at each of samples'''
+    left=window//2
+    right=window-left-1
+    return [np.arange(max(sample-left,0),min(sample+right+1,n_times)) for sample in samples]
+
+def bootstrap_counts(seed, n_rep, data, kernel, n_samples, top=0.05):
+    '''Number of the n_rep replicates in which each source is in the top fraction at each latency
+    data is (n_epochs, n_channels, samples of all latency windows), n_samples the length of each window'''
+    rng=np.random.default_rng(seed)
+    n_epochs=len(data)
+    weights=rng.multinomial(n_epochs,np.full(n_epochs,1./n_epochs),size=n_rep)/n_epochs
+    averages=np.tensordot(weights,data,axes=1)
+    sol=apply_kernel(kernel,averages.transpose(1,0,2))
+    counts=np.zeros((len(sol),len(n_samples)),dtype=np.int64)
+    bounds=np.cumsum([0]+list(n_samples))
+    for idx,(start,stop) in enumerate(zip(bounds[:-1],bounds[1:])):
+        values=sol[:,:,start:stop].mean(axis=2)
+        threshold=np.percentile(values,100*(1-top),axis=0)
+        counts[:,idx]=(values >= threshold).sum(axis=1)
+    return counts
+
+def bootstrap_top_frequency(kernel, epochs, samples, n_rep=1000, window=30, top=0.05, seed=0,
+                            n_chunk=chunk_replicates, n_jobs=1):
+    '''Fraction of n_rep bootstrap replicates in which each source is in the top fraction at each sample
+    kernel should be computed with nave=len(epochs); samples index epochs.times
+    Returns (n_sources, len(samples))'''
+    windows=latency_windows(len(epochs.times),samples,window)
+    picks=kernel_picks(kernel,epochs.ch_names)
+    data=epochs.get_data()[:,picks][:,:,np.concatenate(windows)].astype(kernel['kernel'].dtype)
+    sizes=[min(n_chunk,n_rep-first) for first in range(0,n_rep,n_chunk)]
+    seeds=np.random.SeedSequence(seed).spawn(len(sizes))
+    count_chunk=partial(bootstrap_counts,data=data,kernel=kernel,n_samples=[len(w) for w in windows],top=top)
+    if n_jobs == 1:
+        counts=sum(count_chunk(s,size) for s,size in zip(seeds,sizes))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            counts=sum(pool.map(count_chunk,seeds,sizes))
+    return counts/n_rep
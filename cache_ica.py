@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache of the fitted ICA of the dSPM stage, and fits on sampled data
+
+cached_ica saves the fitted ICA (with its excluded components, see
+save_ica_exclude) as a .fif file named by a hash of what the fit depends on:
+    the CTF run (res4 contents, names, sizes and modification times of the meg4 files)
+    the fitted channels and their bads, sampling rate and filter band
+    the BAD annotations, the ICA parameters and the sampling of the fit
+and reuses it while these are unchanged.
+
+With decim and/or n_segments the ICA is fit on a sample of the recording
+instead of all of it: every decim-th sample, of n_segments windows of
+segment_length seconds spread evenly over the run. The sample is gathered one
+chunk at a time, so the full data are never copied. The fit time and peak
+memory are measured (tracemalloc) and reported next to the full fit; the full
+fit is estimated in proportion to the number of samples unless compare_full
+is set, in which case it is also run and the components are matched.
+Keep sfreq/decim above twice the low-pass frequency (600 Hz and 50 Hz: decim <= 6).
+
+Usage:
+    ica,ica_file,report=cached_ica(raw, meg_run, os.path.join(out_dir,'ica_cache'), n_components=30, method='fastica', random_state=97, decim=3)
+    ...select components...
+    save_ica_exclude(ica, ica_file)
+"""
+import glob
+import hashlib
+import json
+import os
+import time
+import tracemalloc
+import numpy as np
+import mne
+from mne.preprocessing import ICA
+from cache_mne_models import cached_file, evict_cache, default_max_bytes
+from read_ctf_ds import ds_file
+
+#Length (seconds) of the chunks read when gathering a decimated sample
+chunk_time=60.
+
+def hash_ctf_run(ds_dir, file_hash):
+    '''Add the CTF run to file_hash without reading its data: res4 contents and the meg4 names, sizes and times'''
+    with open(ds_file(ds_dir,'res4'),'rb') as fid:
+        file_hash.update(fid.read())
+    for meg4 in sorted(glob.glob(os.path.join(ds_dir,'*meg4'))):
+        stat=os.stat(meg4)
+        file_hash.update('{} {} {}'.format(os.path.basename(meg4),stat.st_size,stat.st_mtime_ns).encode())
+
+def hash_raw_state(raw, file_hash):
+    '''Add the channels, bads, sampling, filter band and BAD annotations of raw to file_hash'''
+    info=raw.info
+    file_hash.update(json.dumps([info['ch_names'],sorted(info['bads']),float(info['sfreq']),float(info['highpass']),float(info['lowpass']),
+                                 int(raw.first_samp),int(raw.n_times)]).encode())
+    for annot in raw.annotations:
+        if annot['description'].lower().startswith('bad'):
+            file_hash.update('{:.6f} {:.6f} {}'.format(annot['onset'],annot['duration'],annot['description']).encode())
+
+def fit_windows(raw, n_segments=None, segment_length=10.):
+    '''Sample (start, stop) windows of the fit: the whole run in chunks, or n_segments evenly spread windows'''
+    sfreq=raw.info['sfreq']
+    if n_segments is None:
+        step=int(round(chunk_time*sfreq))
+        return [(start,min(start+step,raw.n_times)) for start in range(0,raw.n_times,step)]
+    length=int(round(segment_length*sfreq))
+    if n_segments*length >= raw.n_times:
+        return [(0,raw.n_times)]
+    starts=np.linspace(0,raw.n_times-length,n_segments).astype(int)
+    return [(start,start+length) for start in starts]
+
+def sample_raw(raw, decim=1, n_segments=None, segment_length=10.):
+    '''Raw of every decim-th sample of the fit windows of raw (BAD annotated spans omitted)'''
+    picks=mne.pick_types(raw.info,meg=True,ref_meg=False,exclude='bads')
+    data=[raw.get_data(picks=picks,start=start,stop=stop,reject_by_annotation='omit')[:,::decim]
+          for start,stop in fit_windows(raw,n_segments,segment_length)]
+    info=mne.pick_info(raw.info,picks)
+    with info._unlock():
+        info['sfreq']=raw.info['sfreq']/decim
+    return mne.io.RawArray(np.concatenate(data,axis=1),info,verbose=False)
+
+def measured_fit(ica, inst, **fit_kwargs):
+    '''Fit ica on inst; returns (seconds, peak bytes allocated during the fit)'''
+    tracemalloc.start()
+    start=time.perf_counter()
+    ica.fit(inst,**fit_kwargs)
+    seconds=time.perf_counter()-start
+    peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+def match_components(ica, full_ica):
+    '''Absolute correlation of each component's mixing pattern with its best match in full_ica'''
+    mixing=ica.get_components()
+    full_mixing=full_ica.get_components()
+    corr=np.abs(np.corrcoef(mixing.T,full_mixing.T)[:mixing.shape[1],mixing.shape[1]:])
+    return corr.max(axis=1)
+
+def fit_sampled_ica(raw, ica_kwargs, decim=1, n_segments=None, segment_length=10., compare_full=False):
+    '''Fit an ICA on a sample of raw (all of it if decim is 1 and n_segments None)
+    Returns the ICA and a report of the fit time and memory against the full fit'''
+    if raw.info['sfreq']/decim < 2*raw.info['lowpass']:
+        print('Warning: decimating by {} aliases the {} Hz band'.format(decim,raw.info['lowpass']))
+    full_samples=int(raw.n_times)
+    ica=ICA(**ica_kwargs)
+    if decim == 1 and n_segments is None:
+        seconds,peak=measured_fit(ica,raw,reject_by_annotation=True)
+        return ica,{'fit_samples':full_samples,'full_samples':full_samples,'fit_seconds':seconds,'fit_peak_bytes':peak}
+    tracemalloc.start()
+    sampled=sample_raw(raw,decim,n_segments,segment_length)
+    sample_peak=tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    seconds,peak=measured_fit(ica,sampled,reject_by_annotation=False)
+    ratio=full_samples/sampled.n_times
+    report={'fit_samples':int(sampled.n_times),'full_samples':full_samples,'fit_seconds':seconds,
+            'fit_peak_bytes':max(peak,sample_peak)+8*len(sampled.ch_names)*sampled.n_times,
+            'full_seconds':seconds*ratio,'full_peak_bytes':peak*ratio,'full_estimated':True}
+    del sampled
+    if compare_full:
+        full_ica=ICA(**ica_kwargs)
+        report['full_seconds'],report['full_peak_bytes']=measured_fit(full_ica,raw,reject_by_annotation=True)
+        report['full_estimated']=False
+        report['component_match']=match_components(ica,full_ica).tolist()
+    report['seconds_saved']=report['full_seconds']-report['fit_seconds']
+    report['bytes_saved']=report['full_peak_bytes']-report['fit_peak_bytes']
+    print('ICA fit on {} of {} samples: {:.1f} s and {:.0f} MB, {} full fit {:.1f} s and {:.0f} MB'.format(
+        report['fit_samples'],full_samples,seconds,report['fit_peak_bytes']/1e6,
+        'estimated' if report['full_estimated'] else 'measured',report['full_seconds'],report['full_peak_bytes']/1e6))
+    return ica, report
+
+def cached_ica(raw, ds_dir, cache_dir, n_components=30, method='fastica', random_state=97, decim=1, n_segments=None,
+               segment_length=10., compare_full=False, max_bytes=default_max_bytes):
+    '''Return (ica, ica_file, report) for the filtered raw of the CTF run ds_dir, reusing the cached
+    ICA (with its excluded components) whenever the run, channels, filtering and fit settings are unchanged
+    report is None when the cached ICA is used; cache_dir must not be inside ds_dir, which is only read'''
+    if os.path.commonpath([os.path.abspath(cache_dir),os.path.abspath(ds_dir)]) == os.path.abspath(ds_dir):
+        raise ValueError('ICA cache {} is inside the CTF run {}; choose a folder outside the acquisition'.format(cache_dir,ds_dir))
+    os.makedirs(cache_dir,exist_ok=True)
+    ica_kwargs=dict(method=method,random_state=random_state,n_components=n_components)
+    key=hashlib.sha1(b'ica')
+    hash_ctf_run(ds_dir,key)
+    hash_raw_state(raw,key)
+    key.update(json.dumps([ica_kwargs,decim,n_segments,segment_length]).encode())
+    ica_file=os.path.join(cache_dir,'{}-ica.fif'.format(key.hexdigest()[:16]))
+    reports=[]
+    def compute():
+        ica,report=fit_sampled_ica(raw,ica_kwargs,decim,n_segments,segment_length,compare_full)
+        reports.append(report)
+        return ica
+    ica=cached_file(ica_file,compute,mne.preprocessing.read_ica,
+                    lambda fname,ica: ica.save(fname,overwrite=True),
+                    validate=lambda ica: ica.ch_names == [raw.ch_names[idx] for idx in mne.pick_types(raw.info,meg=True,ref_meg=False,exclude='bads')])
+    if reports:
+        with open(ica_file[:-len('-ica.fif')]+'-report.json','w') as fid:
+            json.dump(reports[0],fid,indent=2,default=float)
+    evict_cache(cache_dir,max_bytes,keep=(os.path.abspath(ica_file),))
+    return ica, ica_file, reports[0] if reports else None
+
+def save_ica_exclude(ica, ica_file):
+    '''Write the ICA back to its cache file with the current excluded components'''
+    tmp_file=os.path.join(os.path.dirname(ica_file),'tmp{}-{}'.format(os.getpid(),os.path.basename(ica_file)))
+    ica.save(tmp_file,overwrite=True)
+    os.replace(tmp_file,ica_file)
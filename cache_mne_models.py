@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of the BEM solution, source space and forward solution
+
+Each artifact is written as a .fif file named by a hash of everything it is
+computed from, so it is reused as long as the inputs are unchanged:
+    BEM solution:   the Freesurfer bem/*.surf surfaces, conductivity and ico
+    source space:   the hemisphere surfaces and spheres, spacing and add_dist
+    forward:        the BEM and source space hashes, the trans matrix and the
+                    channel layout (names, coil types, positions, dev_head_t,
+                    compensation grade)
+A cached file that cannot be read, or whose forward channels do not match the
+measurement, is recomputed. The cache folder is kept below max_bytes by
+evicting the least recently used files.
+
+Usage:
+    forward=cached_forward_model(subj, fs_dir, raw.info, trans_file, spacing='ico4',
+                                 conductivity=[0.3], cache_dir=cache_dir, n_jobs=4)
+"""
+import glob
+import hashlib
+import os
+import numpy as np
+import mne
+
+#Default size limit (bytes) of a cache folder
+default_max_bytes=20e9
+
+def hash_files(paths, file_hash):
+    '''Add the names and contents of paths (following links) to file_hash'''
+    for path in sorted(paths):
+        file_hash.update(os.path.basename(path).encode())
+        with open(os.path.realpath(path),'rb') as fid:
+            for block in iter(lambda: fid.read(1<<20), b''):
+                file_hash.update(block)
+
+def hash_info(info, file_hash):
+    '''Add the channel layout relevant to the forward solution to file_hash'''
+    for ch in info['chs']:
+        file_hash.update(ch['ch_name'].encode())
+        file_hash.update(np.array([ch['coil_type'],ch['kind']],dtype=np.int64).tobytes())
+        file_hash.update(np.asarray(ch['loc'],dtype=np.float64).tobytes())
+    if info['dev_head_t'] is not None:
+        file_hash.update(np.asarray(info['dev_head_t']['trans'],dtype=np.float64).tobytes())
+    # CTF compensation grade is stored in the upper bits of the coil type, already hashed above
+    file_hash.update(str(len(info['comps'])).encode())
+
+def hash_trans(trans, file_hash):
+    '''Add the head<->MRI transform (file or Transform) to file_hash'''
+    if not isinstance(trans,mne.transforms.Transform):
+        trans=mne.read_trans(trans)
+    file_hash.update(np.asarray(trans['trans'],dtype=np.float64).tobytes())
+
+def evict_cache(cache_dir, max_bytes, keep=()):
+    '''Remove the least recently used .fif files until the folder is below max_bytes'''
+    entries=sorted(glob.glob(os.path.join(cache_dir,'*.fif')),key=os.path.getmtime)
+    total=sum(os.path.getsize(f) for f in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if os.path.abspath(entry) in keep:
+            continue
+        total-=os.path.getsize(entry)
+        os.remove(entry)
+
+def cached_file(cache_file, compute, read, write, validate=None):
+    '''Read cache_file if it exists and is valid, otherwise compute and write it
+    The file is written under a temporary name first so parallel runs never see partial files'''
+    if os.path.exists(cache_file):
+        try:
+            result=read(cache_file)
+            if validate is None or validate(result):
+                os.utime(cache_file)  #Mark as recently used
+                return result
+        except Exception as err:
+            print('Recomputing unreadable cache file {}: {}'.format(cache_file,err))
+        os.remove(cache_file)
+    result=compute()
+    tmp_file=os.path.join(os.path.dirname(cache_file),'tmp{}-{}'.format(os.getpid(),os.path.basename(cache_file)))
+    write(tmp_file,result)
+    os.replace(tmp_file,cache_file)
+    return result
+
+def cached_forward_model(subject, subjects_dir, info, trans, spacing='ico4', surface='white', conductivity=(0.3,),
+                         ico=4, add_dist=True, cache_dir=None, max_bytes=default_max_bytes, n_jobs=1):
+    '''Return the MEG forward solution of subject, reusing the cached BEM solution,
+    source space and forward solution whenever their inputs are unchanged
+    cache_dir defaults to <subjects_dir>/<subject>/bem/mne_cache'''
+    subject_dir=os.path.join(subjects_dir,subject)
+    if cache_dir is None:
+        cache_dir=os.path.join(subject_dir,'bem','mne_cache')
+    os.makedirs(cache_dir,exist_ok=True)
+
+    bem_hash=hashlib.sha1(b'bem')
+    hash_files(glob.glob(os.path.join(subject_dir,'bem','*.surf')),bem_hash)
+    bem_hash.update(np.asarray(conductivity,dtype=np.float64).tobytes())
+    bem_hash.update(str(ico).encode())
+    bem_file=os.path.join(cache_dir,'{}-{}-bem-sol.fif'.format(subject,bem_hash.hexdigest()[:16]))
+    bem_sol=cached_file(bem_file,
+                        lambda: mne.make_bem_solution(mne.make_bem_model(subject=subject,subjects_dir=subjects_dir,conductivity=conductivity,ico=ico)),
+                        mne.read_bem_solution,
+                        lambda fname,bem: mne.write_bem_solution(fname,bem,overwrite=True))
+
+    src_hash=hashlib.sha1(b'src')
+    hash_files([os.path.join(subject_dir,'surf',hemi+'.'+name) for hemi in ('lh','rh') for name in (surface,'sphere')],src_hash)
+    src_hash.update('{} {} {}'.format(spacing,surface,add_dist).encode())
+    src_file=os.path.join(cache_dir,'{}-{}-{}-src.fif'.format(subject,spacing,src_hash.hexdigest()[:16]))
+    src=cached_file(src_file,
+                    lambda: mne.setup_source_space(subject=subject,surface=surface,spacing=spacing,subjects_dir=subjects_dir,add_dist=add_dist,n_jobs=n_jobs),
+                    mne.read_source_spaces,
+                    lambda fname,src: mne.write_source_spaces(fname,src,overwrite=True))
+
+    fwd_hash=hashlib.sha1(b'fwd')
+    fwd_hash.update(bem_hash.digest())
+    fwd_hash.update(src_hash.digest())
+    hash_trans(trans,fwd_hash)
+    hash_info(info,fwd_hash)
+    fwd_file=os.path.join(cache_dir,'{}-{}-fwd.fif'.format(subject,fwd_hash.hexdigest()[:16]))
+    meg_names=set(info['ch_names'][idx] for idx in mne.pick_types(info,meg=True,ref_meg=False,exclude=[]))
+    forward=cached_file(fwd_file,
+                        lambda: mne.make_forward_solution(info=info,trans=trans,src=src,bem=bem_sol,meg=True,eeg=False,n_jobs=n_jobs),
+                        mne.read_forward_solution,
+                        lambda fname,fwd: mne.write_forward_solution(fname,fwd,overwrite=True),
+                        validate=lambda fwd: set(fwd['info']['ch_names']) == meg_names and fwd['nsource'] == sum(s['nuse'] for s in src))
+
+    evict_cache(cache_dir,max_bytes,keep=(os.path.abspath(bem_file),os.path.abspath(src_file),os.path.abspath(fwd_file)))
+    return forward
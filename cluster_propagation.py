@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time-resolved cluster propagation of the dSPM maps
+
+Every sample of a latency window (e.g. first to peak of dipole_timing.txt) goes
+through the clustering stage of do_dspm_clustering.py: mapping to the SUMA
+vertices, heat-kernel smoothing to 20 mm, projection into the SurfVol grid and
+clustering at the 95th percentile of the sample (see suma_mapping.py,
+surface_smoothing.py, surf2vol.py and cluster_volumes.py). Samples are read
+from the source store and processed chunk_samples at a time, so memory is
+bounded by the chunk whatever the length of the window.
+
+Outputs:
+    label_file      4D NIFTI (grid x samples, int16) of the cluster numbers,
+                    written chunk by chunk into a memory-mapped file
+    clusters        table of every cluster at every sample (see cluster_maps)
+                    with the sample and its time
+    trajectory      the largest cluster at every sample: centroid path (step
+                    from the previous sample and distance from the first),
+                    volume and its growth from the previous sample
+
+Usage:
+    clusters,trajectory=cluster_propagation(stcs, samples, suma_index, smoothwm, projections, surfvol_file,
+                                            os.path.join(out_dir,'propagation_clust.nii'))
+"""
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from suma_mapping import map_to_suma
+from surface_smoothing import heat_smooth
+from surf2vol import project_surface
+from cluster_volumes import combine_hemispheres, surface_thresholds, cluster_maps
+
+#Samples processed together; bounds the (vertices or voxels, samples) working arrays
+chunk_samples=16
+
+def open_label_volume(fname, grid_file, n_samples, tstep=1., dtype=np.int16):
+    '''Create a 4D NIFTI of the grid of grid_file with n_samples volumes and return it memory-mapped
+    as (x, y, z, sample), each sample a contiguous block'''
+    grid=nib.load(grid_file)
+    header=nib.Nifti1Header()
+    header.set_data_shape(tuple(grid.shape[:3])+(n_samples,))
+    header.set_data_dtype(dtype)
+    header.set_sform(grid.affine,code='scanner')
+    header.set_qform(grid.affine,code='scanner')
+    header.set_zooms(tuple(grid.header.get_zooms()[:3])+(tstep,))
+    header.set_xyzt_units('mm','sec')
+    header['vox_offset']=352
+    with open(fname,'wb') as fid:
+        fid.write(header.binaryblock)
+        fid.write(b'\x00'*(352-len(header.binaryblock)))
+        fid.truncate(352+int(np.prod(grid.shape[:3]))*n_samples*header.get_data_dtype().itemsize)
+    return np.memmap(fname,dtype=header.get_data_dtype(),mode='r+',offset=352,
+                     shape=tuple(grid.shape[:3])+(n_samples,),order='F')
+
+def cluster_trajectory(clusters):
+    '''Path and growth of the largest cluster (cluster 1) over the samples of a clusters table'''
+    largest=clusters[clusters['cluster'] == 1].sort_values('sample').reset_index(drop=True)
+    centroids=largest[['centroid_x','centroid_y','centroid_z']].to_numpy()
+    trajectory=largest[['sample','time','n_voxels','volume','mean','peak','centroid_x','centroid_y','centroid_z']].copy()
+    # No sample may keep a cluster; the trajectory is then empty, with the same columns
+    trajectory['step']=np.linalg.norm(centroids-np.concatenate([centroids[:1],centroids[:-1]]),axis=1)
+    trajectory['distance']=np.linalg.norm(centroids-centroids[:1],axis=1)
+    trajectory['growth']=trajectory['volume'].diff().fillna(0.)
+    return trajectory
+
+def cluster_propagation(stcs, samples, suma_index, smoothwm, projections, grid_file, label_file,
+                        target_fwhm=20., percentile=95, rmm=5., vmul=75., chunk=chunk_samples):
+    '''Clusters of every sample (index into stcs.times) of a window
+    suma_index, smoothwm and projections are dictionaries by hemisphere ('rh', 'lh') of the compiled
+    suma2mne index, the smooth white matter surface and the surf2vol projection
+    Writes the 4D cluster label volume to label_file; returns the clusters and trajectory tables'''
+    samples=np.asarray(samples)
+    hemis=sorted(projections)
+    grid=nib.load(grid_file)
+    labels_4d=open_label_volume(label_file,grid_file,len(samples),tstep=stcs.tstep)
+    tables=[]
+    for first in range(0,len(samples),chunk):
+        block=samples[first:first+chunk]
+        data=stcs.timepoints(block)
+        smoothed={hemi:heat_smooth(smoothwm[hemi],map_to_suma(suma_index[hemi],data),target_fwhm=target_fwhm) for hemi in hemis}
+        voxels,combined=combine_hemispheres([projections[hemi] for hemi in hemis],
+                                            [project_surface(projections[hemi],smoothed[hemi]) for hemi in hemis])
+        thresholds=surface_thresholds([smoothed[hemi] for hemi in hemis],percentile)
+        labels,table=cluster_maps(voxels,combined,thresholds,grid.shape[:3],grid.affine,rmm=rmm,vmul=vmul)
+        ijk=np.unravel_index(voxels,grid.shape[:3])
+        for idx in range(len(block)):
+            labels_4d[ijk+(first+idx,)]=labels[:,idx]
+        table.insert(0,'sample',block[table['map'].to_numpy()])
+        table.insert(1,'time',stcs.times[table['sample'].to_numpy()])
+        tables.append(table.drop(columns='map'))
+        print('Clustered samples {} to {} of {}'.format(first+1,first+len(block),len(samples)))
+    labels_4d.flush()
+    del labels_4d
+    clusters=pd.concat(tables,ignore_index=True)
+    return clusters, cluster_trajectory(clusters)
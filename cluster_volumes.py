@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Connected-component clustering of projected dSPM maps (replaces 3dcalc and 3dclust -1clip <p95> 5 75)
+
+The maps stay in the sparse voxel form of surf2vol.py: the two hemispheres are
+combined on the union of their voxels as step(a)*a+step(b)*b, and the
+threshold of every map is the 95th percentile of the larger of the two
+smoothed surface values, computed for all maps at once.
+
+Clusters follow 3dclust: voxels at or above the threshold (-1clip) are
+connected when their centres are at most rmm millimetres apart, and clusters
+smaller than vmul microlitres are dropped. With rmm=0, or a radius reaching no
+further than the 26 neighbours of a voxel, the components are found with
+scipy.ndimage.label on the bounding box of the voxels. Larger radii (such as
+rmm=5) label with the 26 neighbours first, then join the components whose
+boundary voxels are within rmm with a KD-tree, which is exact and never
+enumerates the voxel pairs inside a component. Clusters are numbered by
+decreasing size, as in the 3dclust -savemask output, and reported in a table:
+    cluster, n_voxels, volume (mm^3), mean, peak, peak_x/y/z, centroid_x/y/z (mm)
+Any number of maps (e.g. every timepoint of a window) is clustered in one call.
+
+Usage:
+    voxels,values=combine_hemispheres([projections['rh'],projections['lh']], [rh_values, lh_values])
+    thresholds=surface_thresholds([smoothed['rh'], smoothed['lh']], 95)
+    labels,table=cluster_maps(voxels, values, thresholds, grid_shape, affine, rmm=5, vmul=75)
+"""
+import numpy as np
+import pandas as pd
+import scipy.ndimage
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+import nibabel as nib
+
+def combine_hemispheres(projections, values):
+    '''Union of the voxels of the projections and the sum of the positive values projected into each,
+    as (voxels, (n_voxels,) or (n_voxels, n_maps))'''
+    voxels=np.unique(np.concatenate([projection.voxels for projection in projections]))
+    values=[np.asarray(v) for v in values]
+    combined=np.zeros((len(voxels),)+values[0].shape[1:],dtype=np.float64)
+    for projection,value in zip(projections,values):
+        combined[np.searchsorted(voxels,projection.voxels)]+=np.maximum(value,0)
+    return voxels, combined
+
+def surface_thresholds(surface_values, percentile=95):
+    '''Percentile, over vertices, of the largest of the hemisphere surface values (n_nodes,) or (n_nodes, n_maps)'''
+    return np.nanpercentile(np.maximum.reduce([np.asarray(v) for v in surface_values]),percentile,axis=0)
+
+def join_components(xyz, components, boundary, rmm):
+    '''Merge the components (0, 1, ...) of the voxels at xyz (mm) that have boundary voxels at most rmm apart'''
+    n_components=components.max()+1
+    pairs=[]
+    for component in range(n_components):
+        own=boundary & (components == component)
+        # Only later components whose boundary lies in the bounding box of this one, widened by rmm
+        low,high=xyz[own].min(axis=0)-rmm,xyz[own].max(axis=0)+rmm
+        other=np.flatnonzero(boundary & (components > component) & np.all((xyz >= low) & (xyz <= high),axis=1))
+        if len(other) == 0:
+            continue
+        distance,_=cKDTree(xyz[own]).query(xyz[other],distance_upper_bound=rmm*(1+1e-6))
+        for linked in np.unique(components[other[np.isfinite(distance)]]):
+            pairs.append((component,linked))
+    pairs=np.array(pairs,dtype=np.int64).reshape(-1,2)
+    graph=scipy.sparse.coo_matrix((np.ones(len(pairs),dtype=bool),(pairs[:,0],pairs[:,1])),shape=(n_components,n_components))
+    return connected_components(graph,directed=False)[1][components]
+
+def voxel_components(ijk, voxel_size, rmm=5.):
+    '''Component label (0, 1, ...) of every voxel (n_voxels, 3) for a connection radius rmm (mm)'''
+    if len(ijk) == 0:
+        return np.zeros(0,dtype=np.int64)
+    offsets=np.array([(i,j,k) for i in (-1,0,1) for j in (-1,0,1) for k in (-1,0,1)])
+    distances=np.linalg.norm(offsets*voxel_size,axis=1)
+    if 0 < rmm < distances.max() and rmm >= 2*np.min(voxel_size):
+        # Strongly anisotropic voxels: join every pair within rmm
+        pairs=cKDTree(ijk*voxel_size).query_pairs(rmm*(1+1e-6),output_type='ndarray')
+        graph=scipy.sparse.coo_matrix((np.ones(len(pairs),dtype=bool),(pairs[:,0],pairs[:,1])),shape=(len(ijk),len(ijk)))
+        return connected_components(graph,directed=False)[1]
+    # Neighbours within rmm in the 3x3x3 block; rmm=0 means faces only, as in 3dclust
+    structure=(distances <= rmm*(1+1e-6)).reshape(3,3,3) if rmm > 0 else scipy.ndimage.generate_binary_structure(3,1)
+    origin=ijk.min(axis=0)-1
+    mask=np.zeros(ijk.max(axis=0)-origin+2,dtype=bool)
+    index=tuple((ijk-origin).T)
+    mask[index]=True
+    labels,_=scipy.ndimage.label(mask,structure=structure)
+    components=labels[index]-1
+    if rmm < 2*np.min(voxel_size):
+        return components
+    # Larger radii: every voxel in the 3x3x3 block is connected, so a pair of components within rmm always has a
+    # pair of boundary voxels (voxels next to an empty one) within rmm; only those are compared
+    boundary=mask & ~scipy.ndimage.binary_erosion(mask,structure=np.ones((3,3,3),bool))
+    return join_components(ijk*voxel_size,components,boundary[index],rmm)
+
+def cluster_map(ijk, values, affine, rmm=5., vmul=75.):
+    '''Clusters of the voxels ijk (n_voxels, 3) with values above threshold
+    Returns the cluster number of every voxel (0 outside clusters, 1 for the largest) and the cluster table'''
+    voxel_size=np.sqrt((np.asarray(affine)[:3,:3]**2).sum(axis=0))
+    components=voxel_components(ijk,voxel_size,rmm)
+    sizes=np.bincount(components,minlength=0)
+    keep=np.flatnonzero(sizes*np.prod(voxel_size) >= vmul)
+    # Number the kept clusters by decreasing size
+    order=keep[np.argsort(-sizes[keep],kind='stable')]
+    numbers=np.zeros(len(sizes),dtype=np.int32)
+    numbers[order]=np.arange(1,len(order)+1)
+    labels=numbers[components]
+    xyz=nib.affines.apply_affine(affine,ijk)
+    rows=[]
+    for number in range(1,len(order)+1):
+        member=labels == number
+        peak=np.argmax(np.where(member,values,-np.inf))
+        centroid=xyz[member].mean(axis=0)
+        rows.append({'cluster':number,'n_voxels':int(member.sum()),'volume':float(member.sum()*np.prod(voxel_size)),
+                     'mean':float(values[member].mean()),'peak':float(values[peak]),
+                     'peak_x':xyz[peak,0],'peak_y':xyz[peak,1],'peak_z':xyz[peak,2],
+                     'centroid_x':centroid[0],'centroid_y':centroid[1],'centroid_z':centroid[2]})
+    return labels, pd.DataFrame(rows,columns=['cluster','n_voxels','volume','mean','peak','peak_x','peak_y','peak_z',
+                                              'centroid_x','centroid_y','centroid_z'])
+
+def cluster_maps(voxels, values, thresholds, grid_shape, affine, rmm=5., vmul=75.):
+    '''Clusters of every map (column of values, (n_voxels,) or (n_voxels, n_maps)) at or above its threshold
+    voxels are flat indices into grid_shape. Returns the cluster labels (same shape as values, int32) and
+    one table with a map column (index of the map)'''
+    values=np.asarray(values)
+    squeeze=values.ndim == 1
+    values=values.reshape(len(values),-1)
+    thresholds=np.broadcast_to(np.asarray(thresholds,dtype=np.float64),values.shape[1:])
+    ijk=np.stack(np.unravel_index(voxels,grid_shape[:3]),axis=1)
+    labels=np.zeros(values.shape,dtype=np.int32)
+    tables=[]
+    for idx in range(values.shape[1]):
+        above=np.flatnonzero((np.abs(values[:,idx]) >= thresholds[idx]) & (values[:,idx] != 0))
+        labels[above,idx],table=cluster_map(ijk[above],values[above,idx],affine,rmm,vmul)
+        table.insert(0,'map',idx)
+        tables.append(table)
+    return (labels[:,0] if squeeze else labels), pd.concat(tables,ignore_index=True)
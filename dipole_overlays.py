@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Place dipoles from the dfit results onto the grid of the subject's MRI
+
+The dipole LPI coordinates (xLPI, yLPI, zLPI, in mm) are mapped through the
+inverse affine of the MRI in one matrix product, and a cube of 2*fill_vox
+voxels around each dipole is counted into the output in one vectorized pass.
+Only the MRI header is read; the header is cached per file.
+
+All volumes are written in process to a single 4D NIfTI whose sub-bricks carry
+AFNI labels (BRICK_LABS in the AFNI NIfTI extension), so no 3dcopy is needed.
+
+Usage:
+    dipole_mat=transform_dipole_LPI_to_voxel(mri_dir, dipole_dframe)
+
+    or, for many dipoles split over several output volumes,
+    shape,affine,header=read_mri_header(mri_file)
+    counts=voxelize_dipoles(dipole_dframe, shape, affine, volume=labels, sparse=True)
+    write_dipole_overlays(counts_dense, mri_file, 'dipoles.nii', labels=['first','peak'])
+"""
+import os
+from xml.sax.saxutils import quoteattr
+from functools import lru_cache
+import nibabel as nb
+import numpy as np
+import scipy.sparse
+
+#Number of dipoles voxelized at once; bounds the size of the neighbourhood index arrays
+chunk_dipoles=2048
+
+@lru_cache(maxsize=16)
+def read_mri_header(mri_file):
+    '''Return the volume shape, affine and header of an MRI without loading its data'''
+    mri=nb.load(mri_file)
+    return tuple(mri.shape[0:3]), mri.affine, mri.header
+
+def dipoles_to_voxels(dipole_dframe, affine):
+    '''Map the rounded LPI dipole coordinates to (rounded) voxel indices with the inverse affine'''
+    lpi=np.round(dipole_dframe[['xLPI','yLPI','zLPI']].to_numpy(dtype=float))
+    affine_inv=np.linalg.inv(affine)
+    ijk=lpi @ affine_inv[0:3,0:3].T + affine_inv[0:3,3]
+    return np.round(ijk).astype(int)
+
+def voxelize_dipoles(dipole_dframe, shape, affine, fill_vox=4, volume=None, n_volumes=None, dtype=np.uint16, sparse=False):
+    '''Count the padded neighbourhood of every dipole into a volume
+    The neighbourhood is voxels i-fill_vox to i+fill_vox-1 along each axis (a single
+    voxel if fill_vox is None), clipped at the volume boundaries
+    volume gives the output volume index of every dipole (default: all in volume 0)
+    Returns a dense array of shape shape+(n_volumes,) with the requested dtype, or with
+    sparse=True a scipy.sparse csr matrix of n_voxels x n_volumes (C ordered voxels)
+    Raises ValueError if a count does not fit an integer dtype'''
+    shape=tuple(int(s) for s in shape[0:3])
+    ijk=dipoles_to_voxels(dipole_dframe, affine)
+    if volume is None:
+        volume=np.zeros(len(ijk),dtype=int)
+    volume=np.asarray(volume,dtype=int)
+    if n_volumes is None:
+        n_volumes=int(volume.max())+1 if len(volume) else 1
+    if fill_vox is None:
+        steps=np.zeros(1,dtype=int)
+    else:
+        steps=np.arange(-int(fill_vox),int(fill_vox))
+    n_vox=int(np.prod(shape))
+    flat=[]
+    for start in np.arange(0,len(ijk),chunk_dipoles):
+        # Neighbourhood coordinates and boundary masks are separable along the three axes
+        i,j,k=[ijk[start:start+chunk_dipoles,axis,None]+steps for axis in range(3)]
+        inside=((i >= 0) & (i < shape[0]))[:,:,None,None] & ((j >= 0) & (j < shape[1]))[:,None,:,None] & ((k >= 0) & (k < shape[2]))[:,None,None,:]
+        idx=((i[:,:,None,None]*shape[1]+j[:,None,:,None])*shape[2]+k[:,None,None,:])*n_volumes+volume[start:start+chunk_dipoles,None,None,None]
+        flat.append(idx[inside])
+    # Only the filled voxels are counted, so memory scales with the dipoles rather than the volume
+    flat,counts=np.unique(np.concatenate(flat+[np.zeros(0,dtype=int)]),return_counts=True)
+    if np.issubdtype(dtype,np.integer) and len(counts) and counts.max() > np.iinfo(dtype).max:
+        raise ValueError('{} overlapping dipoles in a voxel do not fit {}; use a wider dtype'.format(counts.max(),np.dtype(dtype).name))
+    if sparse:
+        return scipy.sparse.csr_matrix((counts.astype(dtype),(flat//n_volumes,flat%n_volumes)),shape=(n_vox,n_volumes))
+    dipole_matrix=np.zeros(shape+(n_volumes,),dtype=dtype)
+    dipole_matrix.reshape(-1)[flat]=counts
+    return dipole_matrix
+
+def transform_dipole_LPI_to_voxel(mri_dir,final_dipole_dframe, fill_vox=4, dtype=np.float64):
+    '''The MRI dataset is in LPI space Use the inverse affine matrix to map the LPI dipoles to the voxel coordinates
+    Overlapping neighbourhoods are incremented; returns a 4D array with a single volume'''
+    shape,affine,header=read_mri_header(os.path.join(mri_dir,'ortho+orig.HEAD'))
+    return voxelize_dipoles(final_dipole_dframe, shape, affine, fill_vox=fill_vox, dtype=dtype)
+
+def afni_extension(img, labels):
+    '''AFNI NIfTI extension holding the sub-brick labels of img
+    NIfTI_nums lets AFNI check that the extension belongs to this header'''
+    dims=img.header['dim']
+    nifti_nums=','.join(str(int(d)) for d in list(dims[1:6])+[img.header['datatype']])
+    brick_labs='"'+'~'.join(str(label).replace('~','_').replace('"','') for label in labels)+'~"'
+    xml=('<?xml version=\'1.0\' ?>\n'
+         '<AFNI_attributes\n  NIfTI_nums={}\n  ni_form="ni_group" >\n'
+         '<AFNI_atr\n  ni_type="String"\n  ni_dimen="1"\n  atr_name="BRICK_LABS" >\n {}\n</AFNI_atr>\n'
+         '</AFNI_attributes>\n').format(quoteattr(nifti_nums),brick_labs)
+    return nb.nifti1.Nifti1Extension('afni',xml.encode()+b'\x00')
+
+def write_dipole_overlays(dipole_mats, mri_file, out_file, labels=None):
+    '''Write all dipole volumes (shape+(n_volumes,)) into one 4D NIfTI on the grid of mri_file
+    Sub-bricks are labelled with labels so AFNI shows e.g. first and peak by name'''
+    shape,affine,header=read_mri_header(mri_file)
+    dipole_mats=np.asarray(dipole_mats)
+    if dipole_mats.ndim == 3:
+        dipole_mats=dipole_mats[...,None]
+    if tuple(dipole_mats.shape[0:3]) != shape:
+        raise ValueError('Dipole volumes do not match the MRI grid of ' + mri_file)
+    img=nb.Nifti1Image(dipole_mats, affine)
+    img.header.set_xyzt_units('mm')
+    if labels is not None:
+        if len(labels) != dipole_mats.shape[3]:
+            raise ValueError('Expected one label per dipole volume')
+        img.header.extensions.append(afni_extension(img, labels))
+    img.to_filename(out_file)
+    return out_file
@@ -1,10 +1,14 @@
-import glob
-import nibabel as nb
 import numpy as np
 import os
 import pandas as pd
 import subprocess
 from read_dip_results import *
+from read_ctf_ds import read_ds_info
+from average_ctf_ds import average_ds, grand_average_ds
+from select_dipole_latency import select_first_peak
+from fit_dipoles import fit_moving_dipoles
+from dipole_overlays import read_mri_header, voxelize_dipoles, write_dipole_overlays
+from stage_config import override_globals
 
 subj='' # Put your subject code here
 run='' # Put the path to the subject's MEG run here
@@ -13,57 +17,30 @@ run='' # Put the path to the subject's MEG run here
 latency=25
 error=70
 
+# Set to False to average and resample with the CTF tools (averageDs, addMarker, newDs) instead of in Python
+average_in_python=True
+# In the very limited cases that multiple runs are needed to obtain enough spikes, put the other runs' .ds paths here;
+# the dipole is then fit on the grand average of all runs
+extra_run_dirs=[]
+n_jobs=4
+
+# Moving dipole fit: 'dfit' (CTF) or 'mne' (MNE-Python sphere model fit, parallel over samples)
+dipole_engine='dfit'
+
+# Set to True to also write a dipole sub-brick for every sample in the latency window, after first and peak
+write_all_samples=False
+
 # Set main directory here
 ctf_run_dir = '' # Put path to CTF .ds file here
-ctf_dir = ctf_run_dir.split('/'+(ctf_run_dir.split('/')[-1]))[0] # Get directory with CTF file in it
 project_dir = '' # Folder with patient's MRI, and to write out project files
 
+# Settings passed in by run_pipeline.py replace the values above
+override_globals(globals())
+ctf_dir = ctf_run_dir.split('/'+(ctf_run_dir.split('/')[-1]))[0] # Get directory with CTF file in it
+
 #====================================================================================================================
 # DEFINE FUNCTIONS
 
-def write_dipole_overlays(dipole_mat=None, mri_dir=None, open_afni=False, index=None, mark=None):
-    # Set Filenames
-    os.chdir(mri_dir)
-    mri_input_filename=os.path.join(mri_dir,'ortho+orig.HEAD')
-    dipole_mri_output_filename='DIPOLE_NII.nii'
-    # Load MRI header
-    mri=nb.load(mri_input_filename)
-    # Dipole NIFTI image
-    dipole_nii_output=nb.Nifti1Image(dipole_mat, mri.affine, header=mri.header)
-    dipole_nii_output.to_filename(dipole_mri_output_filename)
-    base='_dipole+orig'
-    name=str(index)+base
-    # Generate an afni readable file
-    subprocess.run(('3dcopy {} {}'.format(dipole_mri_output_filename,name)),shell=True)
-    os.remove('DIPOLE_NII.nii')
-
-def transform_dipole_LPI_to_voxel(mri_dir,final_dipole_dframe):
-    '''The MRI dataset is in LPI space Use the inverse affine matrix to map the LPI dipoles to the voxel coordinates'''
-    ortho_mri=os.path.join(mri_dir,'ortho+orig.HEAD')
-    mri=nb.load(ortho_mri)
-    mri_matrix=mri.get_fdata()
-    affine_inv=np.linalg.inv(mri.affine)
-    # Create empty dipole array
-    dipole_matrix=np.zeros(mri_matrix.shape[0:3]) #, dtype=np.int8
-    # Loop over dipoles and write to the matrix.  Incrementing in overlapping areas
-    for index,row in final_dipole_dframe.iterrows():
-        x,y,z=row[['xLPI','yLPI','zLPI']]
-        x,y,z=np.round(x),np.round(y),np.round(z)
-        i,j,k=np.sum(affine_inv*(x,y,z,1),axis=1)[0:3]
-        dipole_matrix[vox_fill(i,j,k, fill_vox=4)]+=1
-    # May or may not be necessary to expand dimensions to 4
-    dipole_matrix=np.expand_dims(dipole_matrix,axis=3)
-    return dipole_matrix
-
-def vox_fill(i,j,k, fill_vox=None): 
-    '''Create padding around the dipoles for display'''
-    i,j,k=np.round([i,j,k]).astype(int)
-    if fill_vox==None:
-        return i,j,k
-    else:
-        fill_vox=int(fill_vox)
-        return slice(i-fill_vox, i+fill_vox,1),slice(j-fill_vox, j+fill_vox,1), slice(k-fill_vox, k+fill_vox,1) 
-
 def get_dipole_idx(label):
     '''Return the dipole index from file fits
     This is important to track if multiple markers are present per run'''
@@ -82,72 +59,78 @@ subprocess.run(("3dcopy {}/t1.nii {}/ortho+orig".format(project_dir,project_dir)
 ctf_avg_dir = (ctf_run_dir.strip('.ds'))+'-avg.ds'
 os.chdir(ctf_dir)
 
-# Write average spike from all epochs
-cmd="averageDs -marker S -includeBad -overlap 2.0 -time -1.5 0.5 {} {}"
-cmd=cmd.format(ctf_run_dir,ctf_avg_dir)
-subprocess.run(cmd,shell=True)
-
-# Add a marker in the averaged epoch at the peak of the spike (0)
-cmd="addMarker -n avgspike -t 0.0 {}"
-cmd=cmd.format(ctf_avg_dir)
-subprocess.run(cmd,shell=True)
-
-# Check if file needs to be resampled to 600 Hz
-os.chdir(ctf_avg_dir)
-resampled_file=ctf_avg_dir.strip('-avg.ds')+'_resampled-avg.ds'
-for file in os.listdir(os.getcwd()):
-    hist_file=glob.glob('*hist')[0]
-    d=open(hist_file)
-    lines=d.readlines()
-    for line in lines:
-        line=line.strip()
-        if 'Sample rate:' in line:
-            sample_rate=line
-    sample_rate=int((sample_rate.strip()).split(' ')[2])
+if average_in_python:
+    # Average the spike epochs (-1.5 to 0.5 s around S), resample to 600 Hz and mark the peak (avgspike at 0 s) in one pass
+    resampled_file=ctf_avg_dir.strip('-avg.ds')+'_resampled-avg.ds'
+    if not os.path.exists(resampled_file):
+        if len(extra_run_dirs) > 0:
+            # Each run is averaged in its own process, then the runs are combined weighted by their number of spikes
+            grand_average_ds([ctf_run_dir]+extra_run_dirs,resampled_file,marker='S',tmin=-1.5,tmax=0.5,sample_rate=600,n_jobs=n_jobs)
+        else:
+            average_ds(ctf_run_dir,resampled_file,marker='S',tmin=-1.5,tmax=0.5,sample_rate=600)
+    ctf_avg_dir=resampled_file
+else:
+    # Write average spike from all epochs
+    cmd="averageDs -marker S -includeBad -overlap 2.0 -time -1.5 0.5 {} {}"
+    cmd=cmd.format(ctf_run_dir,ctf_avg_dir)
+    subprocess.run(cmd,shell=True)
+
+    # Add a marker in the averaged epoch at the peak of the spike (0)
+    cmd="addMarker -n avgspike -t 0.0 {}"
+    cmd=cmd.format(ctf_avg_dir)
+    subprocess.run(cmd,shell=True)
+
+    # Check if file needs to be resampled to 600 Hz; the sample rate is read once from the dataset header
+    resampled_file=ctf_avg_dir.strip('-avg.ds')+'_resampled-avg.ds'
+    sample_rate=read_ds_info(ctf_avg_dir).sample_rate
     factor=int(sample_rate/600)
     # If the file needs to be resampled to 600, create a new resampled dataset
     if factor != 1 and not os.path.exists(resampled_file):
-        subprocess.run(("newDs -resample {} {} {}".factor,ctf_avg_dir,resampled_file),shell=True)
+        subprocess.run(("newDs -resample {} {} {}".format(factor,ctf_avg_dir,resampled_file)),shell=True)
 
-# If we created a resampled file, reset the averaged directory to the resampled file
-if os.path.exists(resampled_file):
-    ctf_avg_dir=(resampled_file)
+    # If we created a resampled file, reset the averaged directory to the resampled file
+    if os.path.exists(resampled_file):
+        ctf_avg_dir=(resampled_file)
 
-## In the very limited cases that multiple runs were needed, each run was resampled and averaged, as above
-## Then, the following lines of code were used to average the runs together, and the dipole was fit on the grand averaged run.
-# cmd="grandAverageDs{} grandAv-c.ds"
-# cmd=cmd.format(averaged_dsets)
-# subprocess.run(cmd,shell=True)
+    ## With the CTF tools, multiple runs were each resampled and averaged, as above, and then averaged together:
+    # cmd="grandAverageDs{} grandAv-c.ds"
+    # cmd=cmd.format(averaged_dsets)
+    # subprocess.run(cmd,shell=True)
 
-# Write dipole over the course of the selected latency of the avgspike mark
 os.chdir(ctf_avg_dir)
-subprocess.run(("dfit -a -z -b -{} -e 0.001 -i 4 -h {}/default.hdm -f {}/default.dip -p /home/jstout/processing.cfg -m avgspike {} avgspike.dip".format((latency/1000),ctf_avg_dir,ctf_avg_dir,ctf_avg_dir)),shell=True)
+if dipole_engine == 'mne':
+    # Fit every sample of the latency window of the avgspike mark with MNE, spread over n_jobs processes
+    dipole_dframe=fit_moving_dipoles(ctf_avg_dir,marker='avgspike',tmin=-latency/1000,tmax=0.001,n_jobs=n_jobs)
+    dipole_dframe.to_csv(os.path.join(ctf_avg_dir,'avgspike_mne_dipoles.csv'),index=False)
+else:
+    # Write dipole over the course of the selected latency of the avgspike mark
+    subprocess.run(("dfit -a -z -b -{} -e 0.001 -i 4 -h {}/default.hdm -f {}/default.dip -p /home/jstout/processing.cfg -m avgspike {} avgspike.dip".format((latency/1000),ctf_avg_dir,ctf_avg_dir,ctf_avg_dir)),shell=True)
 
-# Assemble a dipole dataframe of position and error over the moving dipole fit
-os.chdir(ctf_avg_dir)
-dipole_dframe=read_dip_results.assemble_dipole_dframe('avgspike.dip')
+    # Assemble a dipole dataframe of position and error over the moving dipole fit; parsed results are cached in the .ds
+    dipole_dframe=cached_dipole_dframe('avgspike.dip')
 dipole_dframe['Run']=ctf_avg_dir.split('/')[7]
 dipole_dframe['Dipole_idx']=dipole_dframe.Label.apply(get_dipole_idx)
 
 # Find dipole localizations with an error above 70%; get rid of sample after peak
-filtered=(dipole_dframe[dipole_dframe['Err(%)']<(100-error)][0:-1]).reset_index(inplace=False)
-if not filtered.empty == True:
-    first_lat=float(filtered['Sample'][0])
-    peak_lat=float(((filtered)[-1:])['Sample'])
-else:
-    first_lat=np.nan
-    peak_lat=np.nan
+timing,selected_dipoles=select_first_peak(dipole_dframe,group_cols=['Run'],error=error)
+first_lat=timing['first'][0]
+peak_lat=timing['peak'][0]
 
 # Write out a text file containing the selected dipole timing
 out_df=pd.DataFrame({"dipole":'avg',"first":first_lat,"peak":peak_lat},index=[0])
 out_df.to_csv(os.path.join(project_dir,'dipole_timing.txt'),header=True)
 
-# Write out dipoles for analysis
-for metric in "first","peak":
-    time=out_df[metric][0]
-    for a in np.arange(0,len(dipole_dframe)):
-        test=float(dipole_dframe['Sample'][a])
-        if test == time:
-            dip_disp=dipole_dframe[a:(a+1)]
-            dipole_mat=transform_dipole_LPI_to_voxel(project_dir,final_dipole_dframe=dip_disp)
-            write_dipole_overlays(dipole_mat=dipole_mat,mri_dir=project_dir,open_afni=False,index=metric,mark='avgspike')
+# Write out dipoles for analysis; all timepoints go to labelled sub-bricks of one 4D file on the cached MRI header
+labels=["first","peak"]
+dip_disp=[]
+for index,metric in enumerate(labels):
+    dip_disp.append(selected_dipoles[selected_dipoles['metric'] == metric].assign(volume=index))
+if write_all_samples:
+    samples=dipole_dframe.drop_duplicates('Sample')
+    dip_disp.append(samples.assign(volume=np.arange(len(labels),len(labels)+len(samples))))
+    labels=labels+['sample_'+str(sample) for sample in samples['Sample']]
+dip_disp=pd.concat(dip_disp)
+mri_file=os.path.join(project_dir,'ortho+orig.HEAD')
+mri_shape,mri_affine,mri_header=read_mri_header(mri_file)
+dipole_mats=voxelize_dipoles(dip_disp,mri_shape,mri_affine,fill_vox=4,volume=dip_disp['volume'],n_volumes=len(labels),dtype=np.int16)
+write_dipole_overlays(dipole_mats,mri_file,os.path.join(project_dir,'avgspike_dipoles.nii'),labels=labels)
@@ -4,7 +4,16 @@ import pandas as pd
 import mne
 mne.set_log_level(False)
 import mne.channels
-from mne.preprocessing import ICA
+from read_ctf_ds import read_ds_info
+from smooth_stcs import moving_average
+from cache_mne_models import cached_forward_model
+from replay_review import load_review, save_review, replay_value, ica_fingerprint, user_dropped_epochs, drop_replayed_epochs
+from stage_config import override_globals
+from cache_ica import cached_ica, save_ica_exclude
+from stream_preprocess import stream_preprocess_ctf, apply_ica_chunked
+from inverse_kernel import compute_inverse_kernel, check_inverse_kernel, save_inverse_kernel, single_trial_peaks
+from bootstrap_dspm import bootstrap_top_frequency
+from stc_store import write_stc_store
 
 # User inputs
 subj = '' # Put subject code here
@@ -16,32 +25,80 @@ baseline_mark = '' # Put the mark designated by a clinician as a "quiet period"
 trans_file = '' # Put path to MNE transformation file here 
 out_dir = '' # Put path to desired dSPM output directory here
 fs_dir = '' # Put path to folder with Freesurfer reconstructions for all subects
+model_cache_dir = None # Folder for cached BEM, source space and forward solutions; None uses <fs_dir>/<subj>/bem/mne_cache
+ica_cache_dir = None # Folder for cached ICA fits and their excluded components; None uses <out_dir>/ica_cache
+
+# Fit the ICA on every ica_decim-th sample and/or on ica_segments 10 s segments spread over the run instead of the
+# whole run; the saved fit time and memory are printed and written next to the cached ICA
+ica_decim = 1
+ica_segments = None
+
+# Set to True for long recordings: pick, resample and filter the run chunk by chunk into a float32 buffer on disk
+# (preprocessed_raw.dat in out_dir) that the rest of the stage reads on demand, keeping the working memory below
+# max_memory bytes. A full ICA fit still reads all the data; set ica_segments and/or ica_decim to bound it as well
+stream_preprocessing = False
+max_memory = 4e9
+
+# Localize every spike epoch with the precomputed single-trial dSPM kernel, epoch_chunk epochs per matrix product, and
+# write the source peak of each between peak_window seconds around the mark to single_trial_peaks.csv
+localize_single_trials = True
+peak_window = (-0.1, 0.1)
+epoch_chunk = 32
+
+# Set bootstrap_replicates above 0 to resample the spike epochs that many times and write, for every source, how often it
+# is in the top 5% at the first and peak samples of timing_file (dipole_timing.txt, written by do_ECD_analysis.py)
+bootstrap_replicates = 0
+timing_file = ''
+
+# The source time courses are stored once, as float32 in stcs.npy/stcs.json; the .stc files are only needed by stc2gii_hack
+write_stc_files = True
+
+# Set to False to run without plots or prompts, replaying the decisions recorded in review_file by an interactive run
+interactive = True
+n_jobs = 4
+
+# Settings passed in by run_pipeline.py replace the values above
+override_globals(globals())
+review_file = os.path.join(out_dir, 'review_decisions.json')
 
 # Set output directory
 if not os.path.exists(out_dir):
     os.makedirs(out_dir)
+review = load_review(review_file)
+
+# Read the run's sample rate and marks from the dataset header before loading it
+ds_info = read_ds_info(meg_run)
+for mark in spike_mark, baseline_mark:
+    if mark not in ds_info.markers:
+        raise ValueError(f'Mark {mark} not found in {meg_run}; available marks: {list(ds_info.markers)}')
+print(f'{len(ds_info.markers[spike_mark])} spike and {len(ds_info.markers[baseline_mark])} baseline marks')
 
 # Load specified run into mne
-raw = mne.io.read_raw_ctf(meg_run, system_clock = 'ignore', preload = False) # reading in CTF file that has been marked for defined subject
+if stream_preprocessing:
+    # Pick meg channels, downsample to 600 Hz and filter from 5-50 Hz in chunks, into a buffer read on demand
+    raw = stream_preprocess_ctf(meg_run, os.path.join(out_dir,'preprocessed_raw.dat'), sfreq = 600, l_freq = 5, h_freq = 50, max_bytes = max_memory)
+    Fs = raw.info['sfreq']
+else:
+    raw = mne.io.read_raw_ctf(meg_run, system_clock = 'ignore', preload = False) # reading in CTF file that has been marked for defined subject
 
-if raw:
-    print(f'{subj} exists with run {meg_run}') # change to get run number with split 
+    if raw:
+        print(f'{subj} exists with run {meg_run}') # change to get run number with split 
 
-# Begin preprocess - pick meg channels, downsamples, filters, and plots for bad channels:
-raw.load_data() 
-# Picks only meg channels
-raw.pick_types(meg = True, 
-            eeg = False, 
-            ref_meg = False
-            ) 
+    # Begin preprocess - pick meg channels, downsamples, filters, and plots for bad channels:
+    raw.load_data() 
+    # Picks only meg channels
+    raw.pick_types(meg = True, 
+                eeg = False, 
+                ref_meg = False
+                ) 
 
-# Downsample to 600 Hz, if needed
-if not raw.info['sfreq'] == 600:
-    raw.resample(600) 
-Fs = raw.info['sfreq']
+    # Downsample to 600 Hz, if needed
+    if not ds_info.sample_rate == 600:
+        raw.resample(600) 
+    Fs = raw.info['sfreq']
 
-# Apply bandpass filter from 5-50 Hz
-raw.filter(5,50) 
+    # Apply bandpass filter from 5-50 Hz
+    raw.filter(5,50) 
 
 ## In the limited cases that we required multiple runs to obtain at least 10 spikes, we ran the following line of code on the the second run to obtain the same head position as in the first run
 ## Spiking and baseline epochs from each run were then concatenated and used to compute the noise covariance matrix and averaged to create the source timecourse
@@ -49,64 +106,73 @@ raw.filter(5,50)
 
 # Read in marks
 events, event_id = mne.events_from_annotations(raw) # adding in events from marker files, if no events exist will get error
-raw.plot(clipping = None, n_channels = 50) # plot to remove channels - manually select them
-out_text=input("Check raw for bad channels and press enter when finished.")
+if interactive:
+    raw.plot(clipping = None, n_channels = 50) # plot to remove channels - manually select them
+    out_text=input("Check raw for bad channels and press enter when finished.")
+    review['bads'] = list(raw.info['bads'])
+    save_review(review_file, review)
+else:
+    raw.info['bads'] = replay_value(review, 'bads', review_file)
 
 # Store bad meg channels that were manually chosen above into bad_meg structure for future reference
 if len(raw.info['bads']) >= 1:
     bad_meg = raw.info['bads'] # store bad channels so they can be applied to patient's recording 
     raw.pick_types(meg = True, exclude = bad_meg) # excludes bad meg channels 
 
-# Run ICA to remove artifact
-ica = ICA(method = 'fastica',
-    random_state = 97,
-    n_components = 30,
-    verbose=True
+# Run ICA to remove artifact; the fit is reused from the cache while the run, channels and filter are unchanged
+ica, ica_file, ica_report = cached_ica(raw, 
+    meg_run, 
+    ica_cache_dir if ica_cache_dir is not None else os.path.join(out_dir, 'ica_cache'), 
+    n_components = 30, 
+    method = 'fastica', 
+    random_state = 97, 
+    decim = ica_decim, 
+    n_segments = ica_segments
     )
-ica.fit(raw,
-    verbose = True,
-    reject_by_annotation = True)
 
 # Plot ICA components and manually select components containing phyiologic or other artifact 
-ica.plot_sources(raw,title='ICA') # plots ICA component activitations as time series 
-out_text=input('Select the components that you wish to exclude from analysis and type enter when finished.')
-ica.apply(raw)
-
-# Read in previously created BEM model; looks for folder named 'bem' within this folder that contains all bem model data
-# Bem model is expected to be previously created by mne.make_bem_model
-bem = mne.make_bem_model(
-                        subject = subj, 
-                        subjects_dir = fs_dir, 
-                        conductivity = [0.3]
-                        ) 
-bem_sol = mne.make_bem_solution(bem) # Creates a solution that will return the input model
-
-# Set up source space with all candidate dipole locations, created by dividing the Freesurfer model as an icosahedron 4 times (ico4)
-src = mne.setup_source_space(
-                            subject = subj, 
-                            surface = 'white', 
-                            spacing = 'ico4', # USER INPUT - change based on desired resolution of source space
-                            subjects_dir = fs_dir, 
-                            add_dist = True
-                            ) 
-
-# Using the file containing the transformation matrix, create the forward solution
-n_jobs = 4
-forward = mne.make_forward_solution(
-                                    info = raw.info, 
-                                    trans = trans_file, 
-                                    src = src, 
-                                    bem = bem_sol, 
-                                    meg = True, 
-                                    eeg = False, 
-                                    # ignore_ref=True
-                                    )
+if interactive:
+    ica.plot_sources(raw,title='ICA') # plots ICA component activitations as time series 
+    out_text=input('Select the components that you wish to exclude from analysis and type enter when finished.')
+    review['ica_exclude'] = [int(comp) for comp in ica.exclude]
+    review['ica_fingerprint'] = ica_fingerprint(ica)
+    save_review(review_file, review)
+    save_ica_exclude(ica, ica_file)
+else:
+    ica.exclude = replay_value(review, 'ica_exclude', review_file)
+    if review.get('ica_fingerprint') != ica_fingerprint(ica):
+        print('Warning: the ICA fit differs from the reviewed one; check that the replayed components are still artifacts')
+if stream_preprocessing:
+    apply_ica_chunked(ica, raw, max_bytes = max_memory)
+else:
+    ica.apply(raw)
+
+# Create the BEM solution (single layer, inner skull from the Freesurfer 'bem' folder), the source space with all candidate
+# dipole locations, created by dividing the Freesurfer model as an icosahedron 4 times (ico4), and, using the file containing
+# the transformation matrix, the forward solution. Each is cached in the model cache folder and reused while its inputs are unchanged
+forward = cached_forward_model(
+                                subject = subj, 
+                                subjects_dir = fs_dir, 
+                                info = raw.info, 
+                                trans = trans_file, 
+                                spacing = 'ico4', # USER INPUT - change based on desired resolution of source space
+                                surface = 'white', 
+                                conductivity = [0.3], 
+                                add_dist = True, 
+                                cache_dir = model_cache_dir, 
+                                n_jobs = n_jobs
+                                )
 print(forward)
 src = forward['src']
 
 # Manually check alignment of model before computing outputs
-mne.viz.plot_alignment(raw.info, trans=trans_file, subject=subj, subjects_dir=fs_dir, surfaces='outer_skin', show_axes=True, dig=True, eeg=[], meg='sensors',coord_frame='meg')
-out_text = input('If bem looks good, hit return.')
+if interactive:
+    mne.viz.plot_alignment(raw.info, trans=trans_file, subject=subj, subjects_dir=fs_dir, surfaces='outer_skin', show_axes=True, dig=True, eeg=[], meg='sensors',coord_frame='meg')
+    out_text = input('If bem looks good, hit return.')
+    review['alignment_ok'] = True
+    save_review(review_file, review)
+elif not replay_value(review, 'alignment_ok', review_file):
+    raise ValueError('Alignment was not approved for ' + meg_run)
 
 # Create spike epochs from 1.5 seconds before your mark to 0.5 seconds after the marked peak
 epochs = mne.Epochs(raw, 
@@ -121,8 +187,13 @@ epochs = mne.Epochs(raw,
                 ) 
 
 # Inspect all spiking epochs and click to remove if they contain significant artifact
-epochs.plot()
-out_text = input('Remove any bad epochs and hit return when finished.')
+if interactive:
+    epochs.plot()
+    out_text = input('Remove any bad epochs and hit return when finished.')
+    review['dropped_epochs'] = user_dropped_epochs(epochs)
+    save_review(review_file, review)
+else:
+    drop_replayed_epochs(epochs, replay_value(review, 'dropped_epochs', review_file))
 
 # Create baseline epochs from 1.5 seconds before your mark to 0.5 seconds after the marked peak
 baseline_epochs = mne.Epochs(raw, 
@@ -156,31 +227,43 @@ avg_epoch=epochs.average()
 # Apply the dSPM inverse solution to the averaged epoch to obtain the source timecourse
 stc=mne.minimum_norm.apply_inverse(avg_epoch,inv,lambda2,method,label=None)
 
-# Create moving average of the averaged epoch
+# Create moving average of the averaged epoch; centered 30 sample window, shortened at the edges
 window=30
-smoothed_stcs = np.zeros((1,1201)) 
-data_arr=stc.data
-row,column=data_arr.shape
-for tp in np.arange(0,row):
-    tp_data=pd.DataFrame(stc.data[tp])
-    moving_avg_source=[]
-    moving_avg_source = tp_data.rolling(window = window, min_periods = 1, center = True).mean()
-    moving_avg_source = moving_avg_source.to_numpy().T
-    if tp == 0:
-        smoothed_stcs=moving_avg_source
-    else:
-        smoothed_stcs = np.vstack([smoothed_stcs, moving_avg_source])
+smoothed_stcs=moving_average(stc.data, window=window)
 
 # Save moving average to source timecourse
 stc.data=smoothed_stcs
 
-# Save source timecourse array for analysis
-np.save(os.path.join(out_dir,'stc_array'),smoothed_stcs)
-stc.save('full-stcs', overwrite=True)
+# Save the noise-normalized single-trial (nave = 1) kernel and localize all spike epochs with it in batched products
+if localize_single_trials:
+    kernel = compute_inverse_kernel(inv, lambda2, method, nave = 1)
+    check_inverse_kernel(kernel, inv, avg_epoch) # same localization as apply_inverse
+    save_inverse_kernel(os.path.join(out_dir,'inverse_kernel.npz'), kernel)
+    trial_peaks = single_trial_peaks(kernel, epochs, tmin = peak_window[0], tmax = peak_window[1], window = window, n_chunk = epoch_chunk)
+    trial_peaks.to_csv(os.path.join(out_dir,'single_trial_peaks.csv'), index = False)
+
+# Bootstrap the spike average; replicates are localized in batches with the kernel of the average and spread over n_jobs processes
+# The bootstrap is skipped when no dipole passed the fit criteria, leaving the first or peak latency empty
+times_df = pd.read_csv(timing_file) if bootstrap_replicates > 0 else None
+if bootstrap_replicates > 0 and (len(times_df) == 0 or times_df[['first','peak']].iloc[0].isnull().any()):
+    print('No first or peak latency in {}; skipping the bootstrap'.format(timing_file))
+elif bootstrap_replicates > 0:
+    samples = [int(times_df[a][0])-1 for a in ('first','peak')] # CTF samples are 1-based
+    avg_kernel = compute_inverse_kernel(inv, lambda2, method, nave = len(epochs))
+    check_inverse_kernel(avg_kernel, inv, avg_epoch)
+    top_freq = bootstrap_top_frequency(avg_kernel, epochs, samples, n_rep = bootstrap_replicates, window = window, top = 0.05, n_jobs = n_jobs)
+    np.save(os.path.join(out_dir,'bootstrap_top5'), top_freq)
+    boot_stc = mne.SourceEstimate(top_freq, avg_kernel['vertices'], tmin = 0, tstep = 1, subject = subj) # time points: first, peak
+    boot_stc.save(os.path.join(out_dir,'bootstrap-top5'), overwrite = True)
+
+# Save source timecourses for analysis, time-major so that single timepoints can be read without loading the array
+write_stc_store(os.path.join(out_dir,'stcs'), smoothed_stcs, stc.vertices, stc.tmin, stc.tstep, subject = subj)
+if write_stc_files:
+    stc.save(os.path.join(out_dir,'full-stcs'), overwrite=True)
 src = inv['src']
 
 # Save model for conversion to AFNI surface
-mne.write_source_spaces(fname = 'mymodel.fif', 
+mne.write_source_spaces(fname = os.path.join(out_dir,'mymodel.fif'), 
                         src = src, 
                         overwrite = True
                     )
@@ -1,9 +1,17 @@
 import os
-import subprocess
+import sys
 import pandas as pd
-import shutil
 import numpy as np
-from sh import gunzip
+import nibabel as nib
+from stage_config import override_globals
+from stc_store import read_stc_store
+from suma_mapping import mesh_n_nodes, compile_suma2mne, map_to_suma
+from surface_smoothing import heat_smooth
+from surf2vol import surf2vol_projection, project_surface, to_volume, voxels_to_volume
+from cluster_volumes import combine_hemispheres, surface_thresholds, cluster_maps
+from cluster_propagation import cluster_propagation
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'utilities'))
+from stc2gii_align import align_source_space
 
 # Set variables 
 subj = '' # Set subject code here 
@@ -13,7 +21,6 @@ fs_dir = '' # Set path to subject's Freesurfer reconstruction here
 trans_file = '' # Set path to transformation matrix, typically in the FS folder
 dspm_dir = '' # Set path to subject's stc array 
 out_dir = '' # Set path to desired output directory; ideally, this is the directory that you wrote the dipole timing file into
-utilities_dir = os.path.join(os.getcwd(),'utilities')
 
 # Gather all necessary surface reconstruction files from the patient's SUMA directory in a standard mesh
 surfvol_file = '' # Set path to subject's SurfVol file, created by Freesurfer
@@ -21,136 +28,84 @@ rh_pial = '' # Set path to subject's right hemisphere pial surface reconstructio
 rh_smoothwm = '' # Set path to subject's right hemisphere white matter surface reconstruction
 lh_pial = '' # Set path to subject's left hemisphere pial surface reconstruction
 lh_smoothwm = '' # Set path to subject's left hemisphere white matter surface reconstruction
-rh_specfile = '' # Set path to subject's right hemisphere .spec file
-lh_specfile = '' # Set path to subject's left hemisphere .spec file
+brain_mask_file = '' # Set path to a brain mask on the SurfVol grid (e.g. aparc+aseg.nii in the SUMA folder); hole filling stays inside it
+
+# Set to True to interpolate every SUMA vertex from the three virtual sensors SurfToSurf relates it to, instead of the first
+suma_all_nodes = False
+
+# Set to True to also cluster every sample from first to peak (written to propagation_clust.nii, propagation_clusters.csv
+# and propagation_trajectory.csv); samples are processed propagation_chunk at a time
+propagation = False
+propagation_chunk = 16
+
+# Settings passed in by run_pipeline.py replace the values above
+override_globals(globals())
 
 # Read in selected timepoints, created by do_ECD_analysis.py
 times_df=pd.read_csv(os.path.join(out_dir,'dipole_timing.txt'))
 
-# Read in stc file, created by do_dspm_analysis.py
-data_array=np.load(os.path.join(dspm_dir,'stc_array.npy'))
+# Open the source time courses, created by do_dspm_analysis.py; only the selected timepoints are read from disk
+stcs=read_stc_store(os.path.join(dspm_dir,'stcs'))
 
 #====================================================================================================================
 #====================================================================================================================
 # START SCRIPT
 
-# Send dSPM outputs to surface
-
-os.chdir(utilities_dir)
-subprocess.run(("./get_new_stc2gii.sh {} {} {} {}".format(subj,fs_dir,dspm_dir,trans_file)),shell=True)
+# Send dSPM outputs to surface: align the source space with the standard mesh and relate every SUMA vertex to its virtual sensors
+align_source_space(subj,fs_dir,dspm_dir,trans_file)
+
+# Compile the binary suma2mne indices, relating VS and SUMA nodes, once per hemisphere into the virtual sensor of every vertex
+# of the mesh (or the interpolation from its three virtual sensors)
+suma_index={}
+for hemi,smoothwm in ('rh',rh_smoothwm),('lh',lh_smoothwm):
+    suma_index[hemi]=compile_suma2mne(os.path.join(dspm_dir,subj+'_'+hemi+'_suma2mne.npz'),mesh_n_nodes(smoothwm),
+                                      all_nodes=suma_all_nodes,n_sources=stcs.data.shape[1])
+
+# Take the dSPM value of the virtual sensor related to every SUMA vertex at the first and peak timepoints (0 where there is none)
+# Get the timepoints from the dipole writing; subtract 1, for the difference in sampling points between CTF and MNE
+timepoints=['first','peak']
+select_tps=[int(times_df[a][0])-1 for a in timepoints]
+
+# Smooth dSPM values on the white matter surface, both timepoints at once, until they reach a FWHM of 20 mm
+smoothed={}
+for hemi,smoothwm in ('rh',rh_smoothwm),('lh',lh_smoothwm):
+    smoothed[hemi]=heat_smooth(smoothwm,map_to_suma(suma_index[hemi],stcs.timepoints(select_tps)),target_fwhm=20)
+
+# Send the surface dSPM values to the volume between the pial and white matter surfaces, averaging non-zero values and filling
+# holes with two steps of growth inside the brain mask; the projection of each hemisphere is computed once per subject and reused
+surfvol=nib.load(surfvol_file)
+volume_values={}
+projections={}
+for hemi,pial,smoothwm in ('rh',rh_pial,rh_smoothwm),('lh',lh_pial,lh_smoothwm):
+    projections[hemi]=surf2vol_projection(pial,smoothwm,surfvol_file,f_steps=15,n_grow=2,mask_file=brain_mask_file or None,cache_dir=out_dir)
+    volume_values[hemi]=project_surface(projections[hemi],smoothed[hemi])
 
 #====================================================================================================================
 # Create clusters
 
-os.chdir(dspm_dir)
-for a in 'first','peak':
-    for hemi in "rh","lh":
+# Combine the left and right halves to get the entire brain, and threshold every timepoint at the 95th percentile of the larger
+# of the two smoothed surface values
+voxels,combined=combine_hemispheres([projections['rh'],projections['lh']],[volume_values['rh'],volume_values['lh']])
+percentiles=surface_thresholds([smoothed['rh'],smoothed['lh']],95)
+
+# Create clusters from the volumetric dSPM values, with the chosen percentile as the threshold (as 3dclust -1clip <p95> 5 75)
+labels,clusters=cluster_maps(voxels,combined,percentiles,surfvol.shape[:3],surfvol.affine,rmm=5,vmul=75)
+clusters.insert(0,'timepoint',[timepoints[idx] for idx in clusters['map']])
+clusters.drop(columns='map').to_csv(os.path.join(out_dir,'clusters.csv'),index=False)
 
-        # Read in suma2mne file to relate VS and SUMA nodes
-        infile=subj+'_'+hemi+'_suma2mne.csv'
-        master_df=pd.read_csv(os.path.join(dspm_dir,infile),delimiter=' ')
-
-        # Add an empty column to the suma2mne dataframe to contain the dSPM values
-        zeros_df=pd.DataFrame(np.zeros(len(master_df)))
-        print('Now clustering at '+a)
-        master_df=pd.concat([master_df,zeros_df],axis=1)
-        # Rename the column to the timepointg and hemisphere
-        in_col = a+'_'+hemi
-        master_df=master_df.rename(columns={0:a+'_'+hemi})
-
-        # Get the timepoint from the dipole writing; subtract 1, for the difference in sampling points between CTF and MNE
-        select_tp=int(times_df[a][0])-1
-        
-        # Make a new array that contains the dSPM value for every virtual sensor at that timepoint
-        vs_df=pd.DataFrame((np.arange(len(data_array[:,select_tp])))) # Get index for every virtual sensor
-        tmp_df=pd.DataFrame(data_array[:,select_tp]) # Get the dSPM values for every virtual sensor at that timepoint
-        tp_df=(pd.concat([vs_df,tmp_df],axis=1,ignore_index=True)).rename(columns={0:'vs',1:'val'})
-
-        # For each virtual sensor, find the instances of it being related to a SUMA vertex and insert its dSPM value there
-        for vs in tp_df['vs']:
-            indices=master_df[master_df['virtual_sensor_node'] == vs].index.tolist()
-            for index in indices:
-                master_df[in_col][index] = tp_df['val'][vs]
-        
-        # Make a new empty dataframe with each of the dSPM values for the SUMA vertices
-        tmp_df=(pd.DataFrame(np.arange(0,36002))).rename(columns={0:'SUMA_vertex'})
-        new_df=(pd.concat([tmp_df,pd.DataFrame(np.zeros(36002))],axis=1)).rename(columns={0:'val'})
-        for x in tmp_df['SUMA_vertex']:
-            indices=master_df[master_df['SUMA_vertex'] == x].index.to_list() 
-            if len(indices) != 0:
-                new_df['val'][x] = master_df[in_col][indices[0]]
-
-        # Write out the dataframe with the dSPM value for every SUMA vertex
-        new_df['val'].to_csv(os.path.join(fs_dir,'SUMA','tp.1D.dset'),sep=' ',index=False,header=False)
-        os.chdir(os.path.join(fs_dir,'SUMA'))
-
-        # Smooth dSPM values on the white matter surface
-        smooth_cmd="SurfSmooth -spec {} -surf {} -input tp.1D.dset -met HEAT_07 -target_fwhm 20 -Niter -1 -output {}/tp_smoothed_{}.niml.dset"
-        if hemi == 'rh':
-            smooth_cmd=smooth_cmd.format(rh_specfile,rh_smoothwm,out_dir,hemi)
-        else:
-            smooth_cmd=smooth_cmd.format(lh_specfile,lh_smoothwm,out_dir,hemi)
-        subprocess.run(smooth_cmd,shell=True)
-
-        # Convert the values to a 1D for each hemisphere
-        subprocess.run(("ConvertDset -o_1D -input {}/tp_smoothed_{}.niml.dset -prefix {}_tp_smoothed".format(out_dir,hemi,hemi)),shell=True)
-        
-        # Remove the index column so AFNI can read the file
-        nodes=pd.read_csv(os.path.join(fs_dir,'SUMA',hemi+'_tp_smoothed.1D.dset'),skiprows=5,header=None,sep=' ',names=['val'],nrows=36002)
-        nodes.reset_index(inplace=True)
-        nodes=nodes.drop(columns=['index'])
-        nodes.to_csv('temp_write.1D',sep=' ',header=False)
-        
-        # Send the surface dSPM values to the volume on the pial surface
-        cmd="3dSurf2Vol -surf_A {} -surf_B {} -sv {} -spec {} -sdata_1D temp_write.1D -grid_parent {} -map_func nzave -f_steps 15 -prefix {}"
-        if hemi == 'rh':
-            cmd=cmd.format(rh_pial,rh_smoothwm,surfvol_file,rh_specfile,surfvol_file,'temp_out.nii')
-        elif hemi == 'lh':
-            cmd=cmd.format(lh_pial,lh_smoothwm,surfvol_file,lh_specfile,surfvol_file,'temp_out.nii')
-        subprocess.run(cmd,shell=True)
-
-        # Move the file to the out directory
-        for file in os.listdir(os.getcwd()):
-            if 'temp_out.nii' in file:
-                shutil.move(file,os.path.join(out_dir,file))
-        
-        #Expand into the volume to remove any holes from 3dSurf2Vol
-        subprocess.run(("@ROI_modal_grow -input {}/temp_out.nii -outdir {}/temp_grow -niters 2 -mask {}/temp_out.nii -prefix tmp".format(out_dir,out_dir,out_dir),shell=True)
-        
-        # Only take the level 2 expansion; remove all other files
-        for file in os.listdir(os.path.join(out_dir,'temp_grow')):
-            if 'rm_rgm_02.nii.gz' in file:
-                gunzip(os.path.join(out_dir,'temp_grow',file))
-                os.rename(os.path.join(out_dir,'temp_grow',file[:-3]),os.path.join(out_dir,a+'_'+hemi+'.nii'))
-        shutil.rmtree(os.path.join(out_dir,'temp_grow'))
-        os.remove(os.path.join(fs_dir,'SUMA','temp_write.1D'))
-        
-        # Clean up other files
-        for file in os.listdir(out_dir):
-            if 'temp_out.nii' in file:
-                os.remove(os.path.join(out_dir,file))
-    
-    # Combine masks on either side
-    os.chdir(out_dir)
-    cmd="3dcalc -a {} -b {} -expr '(step(a)*a)+(step(b)*b)' -prefix {}"
-    lh=a+'_lh.nii'
-    rh=a+'_rh.nii'
-    out=a+'.nii'
-    cmd=cmd.format(lh,rh,out)
-    subprocess.run(cmd,shell=True)
-
-    # Read in the smoothed files 
-    lh_tp_df=pd.read_csv(os.path.join(fs_dir,'SUMA','lh_tp_smoothed.1D.dset'),header=None,delim_whitespace=True,skiprows=5,nrows=36002)
-    rh_tp_df=pd.read_csv(os.path.join(fs_dir,'SUMA','rh_tp_smoothed.1D.dset'),header=None,delim_whitespace=True,skiprows=5,nrows=36002)
-    
-    # Combine the left and right halves to get the entire brain; take the larger value of the two 
-    combined=pd.DataFrame(np.arange(0,36002))
-    for x in np.arange(len(combined)):
-        lh=lh_tp_df[0][x]
-        rh=rh_tp_df[0][x]
-        val=max(rh,lh)
-        combined[0][x] = val
-    percentile=np.nanpercentile([combined],[95])[0]
-
-    # Create clusters from the volumetric dSPM mask, with the chosen percentile as the threshold
-    subprocess.run(("3dclust -savemask {} -1clip {} 5 75 {}".format(os.path.join(out_dir,a+'_clust.nii'),percentile,os.path.join(out_dir,a+'.nii'))),shell=True)
+for col,a in enumerate(timepoints):
+    print('Now writing clusters at '+a)
+    for hemi in "rh","lh":
+        nib.save(nib.Nifti1Image(to_volume(projections[hemi],volume_values[hemi][:,col]),surfvol.affine),os.path.join(out_dir,a+'_'+hemi+'.nii'))
+    nib.save(nib.Nifti1Image(voxels_to_volume(voxels,surfvol.shape[:3],combined[:,col]),surfvol.affine),os.path.join(out_dir,a+'.nii'))
+    nib.save(nib.Nifti1Image(voxels_to_volume(voxels,surfvol.shape[:3],labels[:,col],dtype=np.int16),surfvol.affine),os.path.join(out_dir,a+'_clust.nii'))
+
+# Cluster every sample from the first to the peak timepoint, to follow the propagation of the spike
+if propagation:
+    print('Now clustering every sample from first to peak')
+    propagation_clusters,trajectory=cluster_propagation(stcs,np.arange(select_tps[0],select_tps[1]+1),suma_index,
+                                                        {'rh':rh_smoothwm,'lh':lh_smoothwm},projections,surfvol_file,
+                                                        os.path.join(out_dir,'propagation_clust.nii'),
+                                                        target_fwhm=20,percentile=95,rmm=5,vmul=75,chunk=propagation_chunk)
+    propagation_clusters.to_csv(os.path.join(out_dir,'propagation_clusters.csv'),index=False)
+    trajectory.to_csv(os.path.join(out_dir,'propagation_trajectory.csv'),index=False)
@@ -1,21 +1,27 @@
 import os
 import subprocess
 import shutil
-import pandas as pd
+import numpy as np
+from stage_config import override_globals
+from niml_io import read_niml_dset, node_values, read_label_table
 
 # Set variables
 subj = '' # Set subject of interest
 surfvol_file = '' # Set name of SurfVol file used in Freesurfer reconstruction
+std_mesh = '' # Set to the standard mesh used for this project; ex. 20, 60, or 141
 
 # Set directories
 fs_dir = '' # Set path to all freesurfer reconstructions; should contain fsaverage
-subj_fs_dir = os.path.join(fs_dir,subj) # Set path to subject's freesurfer reconstruction
 mri_surf_dir = ''
 scripts_dir = os.getcwd()
-files_dir = os.path.join(scripts_dir,'files')
 t1_dir = '' # Set path to project t1; ideally, already-axialized scan used for freesurfer
 project_dir = '' # Set path to project directory
 
+# Settings passed in by run_pipeline.py replace the values above
+override_globals(globals())
+subj_fs_dir = os.path.join(fs_dir,subj) # Set path to subject's freesurfer reconstruction
+files_dir = os.path.join(scripts_dir,'files')
+
 if not os.path.exists(os.path.join(t1_dir,'anat+orig.HEAD')):
     subprocess.run(("3dcopy t1.nii {}/t1+orig".format(project_dir)),shell=True)
 
@@ -27,7 +33,6 @@ subprocess.run(("@SUMA_Make_Spec_FS -NIFTI -sid {} -fspath {} -make_rank_dsets -
 
 # Get paths to subsequent files
 surfvol_file = os.path.join(subj_fs_dir,'SUMA',subj+'_SurfVol.nii')
-std_mesh = '' # Set to the standard mesh used for this project; ex. 20, 60, or 141
 
 # Set spec files
 lh_specfile = 'std.'+std_mesh+'.'+subj+'_lh.spec' # Set path to the left hemisphere spec file; make sure this is the same standard mesh as the surfaces
@@ -44,17 +49,15 @@ rh_pial = 'std.'+std_mesh+'.rh.pial.gii'
 
 os.chdir(os.path.join(subj_fs_dir,'SUMA'))
 for hemi in "lh","rh":
-    # Get the label file and convert it to a 1D file
+    # Read the parcel of every node from the label file (cached as .npy next to the Freesurfer reconstructions)
     file=os.path.join(files_dir,'std.'+std_mesh+'.'+hemi+'.Schaefer2018_400Parcels_7Networks_order.smooth3mm.lbl.niml.dset') # We are only providing the file for the 141 standard mesh. Please email if you need other files.
-    convert_cmd="ConvertDset -o_1D -input {} -prefix {}/{}_schaefer_parcels.1D".format(file,os.path.join(subj_fs_dir,'SUMA'),hemi)
-    subprocess.run(convert_cmd,shell=True)
+    parcels=read_niml_dset(file,cache_dir=os.path.join(fs_dir,'niml_cache'))
 
-    # Edit files to be AFNI-readable by removing excess rows
-    file=pd.read_csv(os.path.join(subj_fs_dir,'SUMA',hemi+'_schaefer_parcels.1D.dset'),delim_whitespace=True,skiprows=5,nrows=198812,header=None)
-    file.to_csv(os.path.join(subj_fs_dir,'SUMA','final_'+filename),header=None,index=False,sep=' ')
+    # Write the parcels as an AFNI-readable 1D file, one row per node
+    final_filename=os.path.join(subj_fs_dir,'SUMA','final_'+hemi+'_schaefer_parcels.1D.dset')
+    np.savetxt(final_filename,node_values(parcels),fmt='%d')
 
     # Send the parcels into the volume using @surf_to_vol_spackle
-    final_filename=os.path.join(subj_fs_dir,'SUMA','final_'+hemi+'_schaefer_parcels.1D.dset')
     surfvol_cmd="@surf_to_vol_spackle -maskset {} -spec {} -surfA {} -surfB {} -surfset {} -prefix {}"
     if hemi == 'lh':
         surfvol_cmd=surfvol_cmd.format(surfvol_file,lh_specfile,lh_white,lh_pial,final_filename,hemi+'_schaefer_parcels+orig')
@@ -70,29 +73,16 @@ for hemi in 'lh','rh':
     os.remove(os.path.join(subj_fs_dir,'SUMA','temp_'+hemi+'_schaefer_parcels.nii'))
 
 # Write a new table that contains the information for the header
-with open(os.path.join(files_dir,'rh_annot.niml.lt')) as rh_file:
-    rh_lines=rh_file.readlines()
-with open(os.path.join(files_dir,'lh_annot.niml.lt')) as lh_file:
-    lh_lines=lh_file.readlines()
+rh_table=read_label_table(os.path.join(files_dir,'rh_annot.niml.lt'))
+lh_table=read_label_table(os.path.join(files_dir,'lh_annot.niml.lt'))
 
-# Combine left and right hemispheres
+# Combine left and right hemispheres; right hemisphere parcels start at 200 and its background (0) is left to the left hemisphere
+rh_table=rh_table[rh_table['key'] != 0].assign(key=lambda table: table['key']+200)
+combined=[(key,name) for table in (rh_table,lh_table) for key,name in zip(table['key'],table['name'])]
 with open('final_annot.niml.lt','w') as new_file:
-    header='<VALUE_LABEL_DTABLE\nni_type="2*String"\nni_dimen="801" >'
-    new_file.write(header)
-    for line in rh_lines:
-        if line != ' ':
-            line=line.strip()
-            parts=line.split(' ')
-            new_line='"'+str(int(parts[0])+200)+'" "'+parts[2]+'"'
-        new_file.write("\n")
-        new_file.write(new_line)
-    for line in lh_lines:
-        if line != ' ':
-            line=line.strip()
-            parts=line.split(' ')
-            new_line='"'+parts[0]+'" "'+parts[2]+'"'
-        new_file.write("\n")
-        new_file.write(new_line)
+    new_file.write('<VALUE_LABEL_DTABLE\nni_type="2*String"\nni_dimen="{}" >'.format(len(combined)))
+    for key,name in combined:
+        new_file.write('\n"{}" "{}"'.format(key,name))
     new_file.write("\n</VALUE_LABEL_DTABLE>")
 
 # Write the parcel key into the file header
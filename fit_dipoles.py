@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Moving dipole fit of the averaged spike with MNE-Python, as an alternative to dfit
+
+Every sample from tmin to tmax around the mark is fit independently with
+mne.fit_dipole in a single sphere model, and the samples are spread over a
+process pool. The output has the columns of read_dip_results.assemble_dipole_dframe,
+so the first/peak selection on Err(%) works unchanged:
+    positions and orientations are in CTF head coordinates (cm), via the
+    ctf_head_t transform MNE keeps for CTF data
+    Err(%) and MEG Err(%) are 100 - goodness of fit
+    Sample counts from the start of the averaged trial starting at 1, like dfit,
+    so Sample-1 is the column of the stc array in do_dspm_clustering.py
+    ox, oy, oz hold the sphere origin; conf(%) and the ellipse axes are not computed
+
+Usage:
+    dipole_dframe=fit_moving_dipoles(ctf_avg_dir, marker='avgspike', tmin=-0.025, tmax=0.001, n_jobs=4)
+
+The sphere origin is read from default.hdm in the dataset (ORIGIN_X/Y/Z, cm)
+unless r0 (head coordinates, m) is given.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import mne
+from read_ctf_ds import read_ds_info
+from read_dip_results import dip_columns, PRI_to_LPI_scale
+
+def read_hdm_origin(hdm_file):
+    '''Single sphere origin (cm, CTF head coordinates) of a CTF head model file, or None'''
+    origin={}
+    with open(hdm_file,'r',errors='replace') as fid:
+        for line in fid:
+            parts=line.replace(':',' ').split()
+            if len(parts) >= 2 and parts[0] in ('ORIGIN_X','ORIGIN_Y','ORIGIN_Z') and parts[0] not in origin:
+                origin[parts[0]]=float(parts[1])
+    if len(origin) != 3:
+        return None
+    return np.array([origin['ORIGIN_X'],origin['ORIGIN_Y'],origin['ORIGIN_Z']])
+
+def read_avg_evoked(ds_dir):
+    '''Read the averaged (one trial) dataset as an Evoked of its MEG channels, 0 s at the trigger'''
+    ds_info=read_ds_info(ds_dir)
+    raw=mne.io.read_raw_ctf(ds_dir, system_clock='ignore', preload=True, verbose=False)
+    raw.pick_types(meg=True, eeg=False, ref_meg=False)
+    return mne.EvokedArray(raw.get_data(), raw.info, tmin=-ds_info.pre_trig_pts/ds_info.sample_rate, nave=max(ds_info.n_averaged,1))
+
+def fit_dipole_samples(evoked, cov, sphere):
+    '''Fit one dipole per sample of evoked; returns times, positions, orientations, amplitudes and gof'''
+    dip,residual=mne.fit_dipole(evoked, cov, sphere, n_jobs=1, verbose=False)
+    return dip.times, dip.pos, dip.ori, dip.amplitude, dip.gof
+
+def dipoles_to_dframe(times, pos, ori, amplitude, gof, ctf_head_t, r0, first_time, sample_rate, marker):
+    '''Dataframe of the fitted dipoles with the columns of assemble_dipole_dframe'''
+    head_ctf_t=mne.transforms.invert_transform(ctf_head_t)
+    pos_ctf=mne.transforms.apply_trans(head_ctf_t, pos)*100.  #m to cm
+    ori_ctf=mne.transforms.apply_trans(head_ctf_t, ori, move=False)
+    r0_ctf=mne.transforms.apply_trans(head_ctf_t, r0)*100.
+    n_dip=len(times)
+    dframe=pd.DataFrame(np.full((n_dip,len(dip_columns)),np.nan),columns=dip_columns)
+    dframe['//']=''
+    dframe['Trial']=0
+    dframe['Sample']=np.round((times-first_time)*sample_rate).astype(int)+1
+    dframe['Latency (s)']=times
+    dframe[['xp','yp','zp']]=pos_ctf
+    dframe[['xo','yo','zo']]=ori_ctf
+    dframe['Mom(nAm)']=amplitude*1e9
+    dframe[['ox','oy','oz']]=r0_ctf
+    dframe['Err(%)']=100.-gof
+    dframe['MEG Err(%)']=100.-gof
+    dframe['Label']=marker
+    dframe=dframe.drop('fit_idx',axis=1)
+    dframe.insert(0,'fit_seq_idx',np.arange(n_dip))
+    dframe['xLPI'],dframe['yLPI'],dframe['zLPI']=PRI_to_LPI_scale(dframe['xp'],dframe['yp'],dframe['zp'])
+    return dframe
+
+def fit_moving_dipoles(ds_dir, marker='avgspike', tmin=-0.025, tmax=0.001, r0=None, n_jobs=None):
+    '''Fit a dipole at every sample from tmin to tmax (s) around the first mark of marker
+    Samples are split into n_jobs contiguous chunks, each fit in its own process'''
+    ds_info=read_ds_info(ds_dir)
+    if marker not in ds_info.markers:
+        raise ValueError('Mark {} not found in {}'.format(marker,ds_dir))
+    evoked=read_avg_evoked(ds_dir)
+    mark_time=float(ds_info.markers[marker]['time'][0])
+    ctf_head_t=evoked.info['ctf_head_t']
+    if r0 is None:
+        hdm_file=os.path.join(ds_dir,'default.hdm')
+        origin=read_hdm_origin(hdm_file) if os.path.exists(hdm_file) else None
+        r0=mne.transforms.apply_trans(ctf_head_t, origin/100.) if origin is not None else np.array([0.,0.,0.04])
+    sphere=mne.make_sphere_model(r0=r0, head_radius=None, verbose=False)
+    cov=mne.make_ad_hoc_cov(evoked.info, verbose=False)
+    first_time=evoked.times[0]
+    window=evoked.copy().crop(mark_time+tmin, mark_time+tmax)
+    n_jobs=min(n_jobs or os.cpu_count(), len(window.times))
+    bounds=np.linspace(0,len(window.times),n_jobs+1).astype(int)
+    chunks=[mne.EvokedArray(window.data[:,start:stop],window.info,tmin=window.times[start],nave=window.nave) for start,stop in zip(bounds[:-1],bounds[1:]) if stop > start]
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        results=list(pool.map(fit_dipole_samples,chunks,[cov]*len(chunks),[sphere]*len(chunks)))
+    times,pos,ori,amplitude,gof=[np.concatenate(values) for values in zip(*results)]
+    return dipoles_to_dframe(times,pos,ori,amplitude,gof,ctf_head_t,r0,first_time,ds_info.sample_rate,marker)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Precomputed inverse kernel and batched single-trial source localization
+
+dSPM (like MNE and sLORETA) is linear in the data up to the combination of
+the three orientations of free/loose sources, so the whole inverse reduces to
+one sources x channels matrix. compute_inverse_kernel assembles it once, with
+the noise normalization folded into its rows:
+    fixed orientation:       stc = kernel @ data
+    free/loose orientation:  stc = norm over x,y,z of (kernel @ data), the
+                             kernel holding 3 rows per source
+which is what apply_inverse gives with pick_ori=None. The kernel is built from
+the public fields of prepare_inverse_operator (as apply_inverse assembles it),
+and check_inverse_kernel compares it with apply_inverse on an evoked response.
+The kernel depends on nave (the noise covariance is scaled by 1/nave), so
+single trials use nave=1. It is saved with its channel names, vertices and
+settings as an .npz file.
+
+apply_kernel_epochs localizes all epochs (or chunks of chunk_epochs epochs)
+with a single matrix product over channels x (epochs*times), and
+single_trial_peaks reduces each epoch to its source peak.
+
+Usage:
+    kernel=compute_inverse_kernel(inv, lambda2=1/9, method='dSPM', nave=1)
+    check_inverse_kernel(kernel, inv, evoked)
+    save_inverse_kernel(os.path.join(out_dir,'inverse_kernel.npz'), kernel)
+    peaks=single_trial_peaks(kernel, epochs, tmin=-0.1, tmax=0.1, window=30)
+"""
+import numpy as np
+import pandas as pd
+from mne.io.constants import FIFF
+from mne.minimum_norm import prepare_inverse_operator, apply_inverse
+from smooth_stcs import moving_average
+
+#Epochs localized per matrix product by default; bounds the (sources, epochs*times) result
+chunk_epochs=32
+
+def compute_inverse_kernel(inv, lambda2=1./9, method='dSPM', nave=1, dtype=np.float32):
+    '''Noise-normalized inverse kernel of an inverse operator as a dictionary with
+    kernel (n_sources or 3*n_sources, n_channels), ch_names, vertices, free_ori and the settings'''
+    prepared=prepare_inverse_operator(inv,nave,lambda2,method,verbose=False)
+    # Whitening, projection and regularized eigenfields, then the (weighted) eigenleads
+    trans=prepared['eigen_fields']['data'] @ (prepared['whitener'] @ prepared['proj'])
+    kernel=prepared['eigen_leads']['data'] @ (prepared['reginv'][:,np.newaxis]*trans)
+    if not prepared['eigen_leads_weighted']:
+        kernel*=np.sqrt(prepared['source_cov']['data'])[:,np.newaxis]
+    free_ori=bool(prepared['source_ori'] == FIFF.FIFFV_MNE_FREE_ORI)
+    if method in ('dSPM','sLORETA'):
+        # The norm is positive, so it can scale the rows before the x,y,z combination
+        kernel*=np.repeat(np.ravel(prepared['noisenorm']),3 if free_ori else 1)[:,np.newaxis]
+    return {'kernel':kernel.astype(dtype),'ch_names':list(prepared['noise_cov'].ch_names),
+            'vertices':[np.asarray(s['vertno']) for s in prepared['src']],'free_ori':free_ori,
+            'method':method,'lambda2':float(lambda2),'nave':int(nave)}
+
+def check_inverse_kernel(kernel, inv, evoked, rtol=1e-3):
+    '''Raise ValueError unless the kernel localizes evoked (taken with the nave of the kernel)
+    as apply_inverse does, within rtol of the largest source value'''
+    evoked=evoked.copy()
+    evoked.nave=kernel['nave']
+    expected=apply_inverse(evoked,inv,kernel['lambda2'],kernel['method'],pick_ori=None,verbose=False).data
+    sol=apply_kernel(kernel,evoked.data[kernel_picks(kernel,evoked.ch_names)])
+    error=np.abs(sol-expected).max()/np.abs(expected).max()
+    if error > rtol:
+        raise ValueError('The inverse kernel differs from apply_inverse by {:.2g} of the peak; check the MNE version'.format(error))
+    return error
+
+def save_inverse_kernel(fname, kernel):
+    '''Write a kernel from compute_inverse_kernel to an .npz file'''
+    np.savez(fname,kernel=kernel['kernel'],ch_names=np.array(kernel['ch_names']),
+             n_vertices=np.array([len(v) for v in kernel['vertices']]),vertices=np.concatenate(kernel['vertices']),
+             free_ori=kernel['free_ori'],method=kernel['method'],lambda2=kernel['lambda2'],nave=kernel['nave'])
+
+def read_inverse_kernel(fname):
+    '''Read a kernel written by save_inverse_kernel'''
+    with np.load(fname) as npz:
+        bounds=np.cumsum(np.concatenate([[0],npz['n_vertices']]))
+        return {'kernel':npz['kernel'],'ch_names':npz['ch_names'].tolist(),
+                'vertices':[npz['vertices'][start:stop] for start,stop in zip(bounds[:-1],bounds[1:])],
+                'free_ori':bool(npz['free_ori']),'method':str(npz['method']),
+                'lambda2':float(npz['lambda2']),'nave':int(npz['nave'])}
+
+def kernel_picks(kernel, ch_names):
+    '''Indices of the kernel channels in ch_names'''
+    missing=sorted(set(kernel['ch_names'])-set(ch_names))
+    if missing:
+        raise ValueError('The inverse kernel was computed with channels missing from the data: {}'.format(missing))
+    return [ch_names.index(name) for name in kernel['ch_names']]
+
+def apply_kernel(kernel, data):
+    '''Source estimates of data (n_channels, ...) already restricted to the kernel channels;
+    returns (n_sources, ...)'''
+    shape=data.shape[1:]
+    sol=kernel['kernel'] @ data.reshape(len(data),-1).astype(kernel['kernel'].dtype,copy=False)
+    if kernel['free_ori']:
+        sol=np.sqrt((sol.reshape(-1,3,sol.shape[1])**2).sum(axis=1))
+    return sol.reshape((len(sol),)+shape)
+
+def apply_kernel_epochs(kernel, epochs_data, ch_names, n_chunk=chunk_epochs):
+    '''Source estimates of all epochs (n_epochs, n_channels, n_times), n_chunk epochs per matrix product
+    (all at once if n_chunk is None); yields (first epoch index, (n_chunk, n_sources, n_times) array)'''
+    picks=kernel_picks(kernel,ch_names)
+    n_chunk=n_chunk or len(epochs_data)
+    for first in range(0,len(epochs_data),n_chunk):
+        chunk=np.asarray(epochs_data[first:first+n_chunk])[:,picks]
+        sol=apply_kernel(kernel,chunk.transpose(1,0,2))
+        yield first, np.ascontiguousarray(sol.transpose(1,0,2))
+
+def source_labels(kernel):
+    '''Hemisphere (or source space index) and vertex number of every kernel source'''
+    hemis=np.concatenate([np.full(len(v),('lh','rh')[idx] if len(kernel['vertices']) == 2 else str(idx)) for idx,v in enumerate(kernel['vertices'])])
+    return hemis, np.concatenate(kernel['vertices'])
+
+def single_trial_peaks(kernel, epochs, tmin=None, tmax=None, window=None, n_chunk=chunk_epochs):
+    '''Source peak of every epoch between tmin and tmax (the whole epoch by default)
+    window smooths each source time course with the moving average of the averaged stage first
+    Returns a dataframe with one row per epoch: epoch (index into the events), source (row of the
+    source estimate), hemi, vertex, time and value of the largest source value'''
+    times=epochs.times
+    in_window=np.ones(len(times),bool)
+    if tmin is not None:
+        in_window&=times >= tmin
+    if tmax is not None:
+        in_window&=times <= tmax
+    # Only localize the window, plus the samples the moving average reaches into
+    first_sample=np.argmax(in_window)
+    stop_sample=len(times)-np.argmax(in_window[::-1])
+    margin=window or 0
+    start,stop=max(first_sample-margin,0),min(stop_sample+margin,len(times))
+    keep=slice(first_sample-start,stop_sample-start)
+    hemis,vertices=source_labels(kernel)
+    rows=[]
+    for first,sol in apply_kernel_epochs(kernel,epochs.get_data()[:,:,start:stop],epochs.ch_names,n_chunk):
+        if window:
+            sol=moving_average(sol,window=window,out=sol)
+        sol=sol[:,:,keep]
+        flat=sol.reshape(len(sol),-1).argmax(axis=1)
+        source,sample=np.unravel_index(flat,sol.shape[1:])
+        rows.append(pd.DataFrame({'epoch':epochs.selection[first:first+len(sol)],'source':source,
+                                  'hemi':hemis[source],'vertex':vertices[source],
+                                  'time':times[first_sample:stop_sample][sample],'value':sol[np.arange(len(sol)),source,sample]}))
+    return pd.concat(rows,ignore_index=True)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reader for AFNI/SUMA NIML and .1D datasets (replaces ConvertDset -o_1D and skiprows parsing)
+
+NIML files are parsed into elements, <name attr="value" ...>data</name>, with
+groups (ni_form="ni_group") holding child elements. The data of an element are
+ni_dimen rows of ni_type columns (e.g. "int" or "4*float,int,String") written
+as text, as binary (ni_form="binary.lsbfirst" / "binary.msbfirst") or as
+base64 (ni_form="base64..."). Every column is returned as a NumPy array.
+
+read_niml_dset gathers what the stages need from a surface dataset
+(e.g. files/std.141.lh.Schaefer2018_400Parcels_7Networks_order.smooth3mm.lbl.niml.dset):
+    data          (n_rows, n_columns) values of the SPARSE_DATA element
+    node_index    node of every row (INDEX_LIST), None if absent
+    column_labels COLMS_LABS of the dataset
+    label_table   key, name, R, G, B, A of the embedded label table (labels
+                  datasets), None if absent
+With cache_dir, data and node_index are stored as .npy files named by a hash
+of the dataset and returned memory-mapped on later reads.
+
+read_1d reads .1D/.1D.dset text (comment lines start with #) and
+read_label_table the label tables (.niml.lt), either as NIML or as the
+whitespace "key name R G B A" text of lh_annot.niml.lt/rh_annot.niml.lt.
+
+Usage:
+    parcels=read_niml_dset(os.path.join(files_dir,'std.141.lh.Schaefer2018_400Parcels_7Networks_order.smooth3mm.lbl.niml.dset'))
+    values=node_values(parcels)          # (n_nodes,) value of every node, 0 where absent
+    labels=read_label_table(os.path.join(files_dir,'lh_annot.niml.lt'))
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+from typing import NamedTuple
+import numpy as np
+import pandas as pd
+from cache_mne_models import hash_files
+
+#NIML column types and their NumPy equivalents
+niml_types={'byte':np.uint8,'short':np.int16,'int':np.int32,'float':np.float32,'double':np.float64}
+
+header_re=re.compile(rb'<([A-Za-z_][\w.:-]*)((?:\s+[\w.:-]+(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s>/]+))?)*)\s*(/?)>')
+attr_re=re.compile(r'([\w.:-]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>/]+)))?')
+token_re=re.compile(r'"([^"]*)"|\'([^\']*)\'|(\S+)')
+
+class NimlElement(NamedTuple):
+    name: str
+    attrs: dict
+    columns: list       # one array per column of a data element, [] for groups
+    children: list      # child elements of a group
+
+    def find(self, name, **attrs):
+        '''Child elements (at any depth) called name, with the given attribute values'''
+        found=[]
+        for child in self.children:
+            if child.name == name and all(child.attrs.get(k) == v for k,v in attrs.items()):
+                found.append(child)
+            found.extend(child.find(name,**attrs))
+        return found
+
+class NimlDset(NamedTuple):
+    data: np.ndarray
+    node_index: np.ndarray
+    column_labels: list
+    label_table: pd.DataFrame
+
+def column_types(ni_type):
+    '''Column type names of an ni_type such as "4*float,int,String"'''
+    types=[]
+    for part in ni_type.split(','):
+        count,_,name=part.strip().rpartition('*')
+        types.extend([name]*(int(count) if count else 1))
+    return types
+
+def parse_attrs(text):
+    '''Attribute dictionary of an element header; attributes without a value are None'''
+    return {m.group(1):next((g for g in m.group(2,3,4) if g is not None),None) for m in attr_re.finditer(text)}
+
+def decode_data(raw, attrs, n_rows):
+    '''Columns of the data of an element (bytes between its header and closing tag)'''
+    types=column_types(attrs.get('ni_type','String'))
+    form=attrs.get('ni_form','text')
+    if form.startswith('binary') or form.startswith('base64'):
+        if 'String' in types:
+            raise ValueError('String columns cannot be read from {} data'.format(form))
+        if form.startswith('base64'):
+            raw=base64.b64decode(b''.join(raw.split()))
+        order='>' if 'msbfirst' in form else '<'
+        row=np.dtype([('c{}'.format(idx),np.dtype(niml_types[t]).newbyteorder(order)) for idx,t in enumerate(types)])
+        records=np.frombuffer(raw,dtype=row,count=n_rows)
+        return [records[name].astype(niml_types[t]) for name,t in zip(row.names,types)]
+    tokens=[next(g for g in m.groups() if g is not None) for m in token_re.finditer(raw.decode('utf-8',errors='replace'))]
+    if len(tokens) != n_rows*len(types):
+        raise ValueError('Expected {} values for {} rows of {}, found {}'.format(n_rows*len(types),n_rows,attrs.get('ni_type'),len(tokens)))
+    return [np.array(tokens[idx::len(types)],dtype=object if t == 'String' else niml_types[t]) for idx,t in enumerate(types)]
+
+def parse_elements(buffer, start=0, end_name=None):
+    '''Elements of buffer from start up to the closing tag of end_name; returns (elements, position after it)'''
+    elements=[]
+    pos=start
+    while True:
+        match=header_re.search(buffer,pos)
+        close=buffer.find(b'</',pos)
+        if close != -1 and (match is None or close < match.start()):
+            stop=buffer.index(b'>',close)
+            if end_name is not None and buffer[close+2:stop].strip().decode() != end_name:
+                raise ValueError('Unexpected closing tag {} in {}'.format(buffer[close:stop+1],end_name))
+            return elements, stop+1
+        if match is None:
+            if end_name is not None:
+                raise ValueError('Missing closing tag of {}'.format(end_name))
+            return elements, len(buffer)
+        name=match.group(1).decode()
+        attrs=parse_attrs(match.group(2).decode())
+        pos=match.end()
+        if match.group(3):
+            elements.append(NimlElement(name,attrs,[],[]))
+        elif attrs.get('ni_form') == 'ni_group':
+            children,pos=parse_elements(buffer,pos,name)
+            elements.append(NimlElement(name,attrs,[],children))
+        else:
+            n_rows=int(np.prod([int(n) for n in attrs.get('ni_dimen','1').split(',')]))
+            form=attrs.get('ni_form','text')
+            if form.startswith('binary'):
+                row_size=sum(np.dtype(niml_types[t]).itemsize for t in column_types(attrs['ni_type']))
+                stop=pos+n_rows*row_size
+            else:
+                stop=buffer.index(('</'+name).encode(),pos)
+            elements.append(NimlElement(name,attrs,decode_data(buffer[pos:stop],attrs,n_rows),[]))
+            pos=buffer.index(b'>',buffer.index(('</'+name).encode(),stop))+1
+
+def read_niml(fname):
+    '''Top-level elements of a NIML file'''
+    with open(fname,'rb') as fid:
+        return parse_elements(fid.read())[0]
+
+def atr_value(group, atr_name):
+    '''Value of the AFNI_atr element atr_name directly in group, None if absent'''
+    for child in group.children:
+        if child.name == 'AFNI_atr' and child.attrs.get('atr_name') == atr_name and child.columns:
+            return child.columns[0][0] if len(child.columns[0]) == 1 else child.columns[0]
+    return None
+
+def niml_to_dset(elements):
+    '''NimlDset of the AFNI_dataset among elements'''
+    dataset=next((e for e in elements if e.name == 'AFNI_dataset'),None)
+    if dataset is None:
+        raise ValueError('No AFNI_dataset element found')
+    data=[child for child in dataset.children if child.name == 'SPARSE_DATA']
+    if not data:
+        raise ValueError('No SPARSE_DATA element in the dataset')
+    values=np.column_stack(data[0].columns)
+    index=[child for child in dataset.children if child.name == 'INDEX_LIST']
+    labels=atr_value(dataset,'COLMS_LABS')
+    label_table=None
+    tables=dataset.find('AFNI_labeltable')
+    if tables:
+        table=[child for child in tables[0].children if child.name == 'SPARSE_DATA'][0]
+        r,g,b,a,key,name=table.columns
+        label_table=pd.DataFrame({'key':key.astype(int),'name':name.astype(str),'R':r,'G':g,'B':b,'A':a})
+    return NimlDset(values,index[0].columns[0].astype(np.int64) if index else None,
+                    [l for l in labels.split(';') if l] if isinstance(labels,str) else [],label_table)
+
+def read_niml_dset(fname, cache_dir=None):
+    '''Data, node indices, column labels and label table of a NIML surface dataset, reused as memory-mapped
+    .npy files from cache_dir (if given) as long as the dataset is unchanged'''
+    if cache_dir is None:
+        return niml_to_dset(read_niml(fname))
+    file_hash=hashlib.sha1(b'niml')
+    hash_files([fname],file_hash)
+    prefix=os.path.join(cache_dir,'{}-{}'.format(os.path.basename(fname),file_hash.hexdigest()[:16]))
+    if not os.path.exists(prefix+'.json'):
+        dset=niml_to_dset(read_niml(fname))
+        os.makedirs(cache_dir,exist_ok=True)
+        tmp_prefix=os.path.join(cache_dir,'tmp{}-{}'.format(os.getpid(),os.path.basename(prefix)))
+        np.save(tmp_prefix+'-data.npy',dset.data)
+        os.replace(tmp_prefix+'-data.npy',prefix+'-data.npy')
+        if dset.node_index is not None:
+            np.save(tmp_prefix+'-index.npy',dset.node_index)
+            os.replace(tmp_prefix+'-index.npy',prefix+'-index.npy')
+        meta={'column_labels':dset.column_labels,'node_index':dset.node_index is not None,
+              'label_table':None if dset.label_table is None else dset.label_table.to_dict(orient='list')}
+        with open(tmp_prefix+'.json','w') as fid:
+            json.dump(meta,fid,default=float)
+        os.replace(tmp_prefix+'.json',prefix+'.json')
+    with open(prefix+'.json','r') as fid:
+        meta=json.load(fid)
+    return NimlDset(np.load(prefix+'-data.npy',mmap_mode='r'),
+                    np.load(prefix+'-index.npy',mmap_mode='r') if meta['node_index'] else None,
+                    meta['column_labels'],None if meta['label_table'] is None else pd.DataFrame(meta['label_table']))
+
+def node_values(dset, n_nodes=None, column=0, fill=0):
+    '''Value of column for every node 0..n_nodes-1 (default: up to the largest node), fill where absent'''
+    values=np.asarray(dset.data)[:,column]
+    index=np.arange(len(values)) if dset.node_index is None else np.asarray(dset.node_index)
+    if n_nodes is None:
+        n_nodes=int(index.max())+1 if len(index) else 0
+    out=np.full(n_nodes,fill,dtype=values.dtype)
+    out[index]=values
+    return out
+
+def read_1d(fname):
+    '''Numeric columns of a .1D or .1D.dset file as (n_rows, n_columns); comment lines start with #'''
+    return np.loadtxt(fname,comments='#',ndmin=2)
+
+def read_label_table(fname):
+    '''Label table of a .niml.lt file as a dataframe with key and name (and R, G, B, A when given)'''
+    with open(fname,'rb') as fid:
+        raw=fid.read()
+    if raw.lstrip().startswith(b'<'):
+        element=parse_elements(raw)[0][0]
+        keys,names=element.columns[:2]
+        return pd.DataFrame({'key':keys.astype(int),'name':names.astype(str)})
+    rows=[line.split() for line in raw.decode().splitlines() if line.strip()]
+    table=pd.DataFrame({'key':[int(row[0]) for row in rows],'name':[row[1] for row in rows]})
+    if all(len(row) >= 5 for row in rows):
+        for idx,color in enumerate(('R','G','B','A')):
+            if all(len(row) > idx+2 for row in rows):
+                table[color]=[int(row[idx+2]) for row in rows]
+    return table
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Read the metadata of a CTF .ds dataset without the CTF tools
+
+The sample rate and trial layout come from the binary res4 header, the marks
+from MarkerFile.mrk and the processing history from the *.hist file. Each
+dataset is read once into a DsInfo object; later calls return the cached
+object until one of the files changes.
+
+Usage:
+    ds_info=read_ds_info(ds_dir)
+    ds_info.sample_rate
+    ds_info.marker_samples('S')   # absolute sample of every S mark
+
+res4 offsets follow the CTF MEG4 file format (big endian):
+    1288 no_samples (int32), 1292 no_channels (int16), 1296 sample_rate (float64),
+    1304 epoch_time (float64), 1312 no_trials (int16), 1316 preTrigPts (int32),
+    776 no_trials_avgd (int16)
+"""
+import glob
+import os
+from functools import lru_cache
+from typing import NamedTuple
+import numpy as np
+
+res4_fields={'n_averaged':(776,'>i2'),
+             'n_samples':(1288,'>i4'),
+             'n_channels':(1292,'>i2'),
+             'sample_rate':(1296,'>f8'),
+             'epoch_time':(1304,'>f8'),
+             'n_trials':(1312,'>i2'),
+             'pre_trig_pts':(1316,'>i4')}
+
+#Dtype of the trial/time pairs of each mark
+marker_dtype=np.dtype([('trial',int),('time',float)])
+
+class DsInfo(NamedTuple):
+    '''Metadata of a CTF dataset'''
+    ds_dir: str
+    sample_rate: float
+    n_samples: int
+    n_channels: int
+    n_trials: int
+    pre_trig_pts: int
+    n_averaged: int
+    markers: dict
+    hist: str
+
+    def marker_times(self, name):
+        '''Time of each mark in seconds from the start of the recording'''
+        marks=self.markers[name]
+        return marks['trial']*self.n_samples/self.sample_rate + self.pre_trig_pts/self.sample_rate + marks['time']
+
+    def marker_samples(self, name):
+        '''Absolute sample index (over concatenated trials) of each mark'''
+        marks=self.markers[name]
+        return marks['trial']*self.n_samples + self.pre_trig_pts + np.round(marks['time']*self.sample_rate).astype(int)
+
+def ds_file(ds_dir, extension):
+    '''Path of the standard file <name>.<extension> inside the dataset'''
+    ds_dir=os.path.normpath(ds_dir)
+    return os.path.join(ds_dir,os.path.basename(ds_dir)[:-3]+'.'+extension)
+
+def read_res4(res4_file):
+    '''Read the general setup values of the res4 header'''
+    with open(res4_file,'rb') as fid:
+        header=fid.read(1320)
+    if not header.startswith(b'MEG4') or len(header) < 1320:
+        raise ValueError(res4_file + ' is not a CTF res4 file')
+    return {key:np.frombuffer(header,dtype=dtype,count=1,offset=offset)[0].item() for key,(offset,dtype) in res4_fields.items()}
+
+def read_marker_file(mrk_file):
+    '''Return a dictionary of mark name to an array of (trial, time) pairs'''
+    markers={}
+    if not os.path.exists(mrk_file):
+        return markers
+    with open(mrk_file,'r') as fid:
+        lines=[line.strip() for line in fid]
+    index=0
+    name=None
+    while index < len(lines):
+        line=lines[index]
+        if line.startswith('NAME:'):
+            name=lines[index+1]
+            index+=1
+        elif line.startswith('NUMBER OF SAMPLES:'):
+            n_marks=int(lines[index+1])
+            index+=1
+        elif line.startswith('LIST OF SAMPLES:'):
+            # Skip the column header; one "trial time" pair per line
+            rows=[lines[index+2+row].split() for row in range(n_marks)]
+            markers[name]=np.array([(int(float(trial)),float(time)) for trial,time in rows],dtype=marker_dtype)
+            index+=1+n_marks
+        index+=1
+    return markers
+
+def read_hist_sample_rate(hist):
+    '''Sample rate from the "Sample rate:" line of the history text, or None'''
+    sample_rate=None
+    for line in hist.splitlines():
+        line=line.strip()
+        if 'Sample rate:' in line:
+            sample_rate=float(line.split('Sample rate:')[1].split()[0])
+    return sample_rate
+
+def ds_stamp(ds_dir):
+    '''Modification times of the metadata files, used to invalidate the cache'''
+    files=[ds_file(ds_dir,'res4'),os.path.join(ds_dir,'MarkerFile.mrk')]+sorted(glob.glob(os.path.join(ds_dir,'*hist')))
+    return tuple((f,os.stat(f).st_mtime_ns) for f in files if os.path.exists(f))
+
+@lru_cache(maxsize=64)
+def read_ds_info_cached(ds_dir, stamp):
+    '''Read the dataset metadata; stamp only serves as part of the cache key'''
+    hist=''
+    hist_files=sorted(glob.glob(os.path.join(ds_dir,'*hist')))
+    if len(hist_files) > 0:
+        with open(hist_files[0],'r',errors='replace') as fid:
+            hist=fid.read()
+    res4_file=ds_file(ds_dir,'res4')
+    if os.path.exists(res4_file):
+        setup=read_res4(res4_file)
+    else:
+        sample_rate=read_hist_sample_rate(hist)
+        if sample_rate is None:
+            raise ValueError('No res4 file or sample rate in the history of ' + ds_dir)
+        setup=dict.fromkeys(res4_fields,0)
+        setup['sample_rate']=sample_rate
+    setup.pop('epoch_time')
+    return DsInfo(ds_dir=ds_dir,
+                  markers=read_marker_file(os.path.join(ds_dir,'MarkerFile.mrk')),
+                  hist=hist,
+                  **setup)
+
+def read_ds_info(ds_dir):
+    '''Return the (cached) DsInfo of a .ds directory'''
+    ds_dir=os.path.abspath(ds_dir)
+    if not os.path.isdir(ds_dir):
+        raise ValueError(ds_dir + ' does not exist')
+    return read_ds_info_cached(ds_dir, ds_stamp(ds_dir))
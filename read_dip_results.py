@@ -11,7 +11,9 @@ The dipole fit results are then stripped of a header and the dipole matrix
 is converted to a dataframe
 
 The function assemble_dipole_dframe will iterate over the different latency
-marks in the data file and concatenate the results into a single dataframe
+marks in the data file and concatenate the results into a single dataframe.
+It reads the file in a single streaming pass (read_dipole_dframe); the original
+dictionary based path is kept as assemble_dipole_dframe_from_dict
 
 Usage:
     assemble_dipole_dframe(dipole_fit_results_filename)
@@ -23,12 +25,15 @@ Original locations [xp,yp,zp] are converted to
 
 """
 import sys,os
+import hashlib
 import pandas as pd
 import numpy as np
 
 #Dipole column information for dataframe
 dip_columns='fit_idx,//,Trial,Sample,Latency (s),xp,yp,zp,xo,yo,zo,Mom(nAm),ax,ay,az,bx,by,bz,cx,cy,cz,ox,oy,oz,conf(%),Err(%),MEG Err(%),EEG Err(%),Label'
 dip_columns=dip_columns.split(',')
+#Numeric columns (everything between the '//' marker and the Label)
+dip_num_columns=dip_columns[2:-1]
 
 ########################### Helper Functions #################################
 def read_chunk(index, text_list):
@@ -115,8 +120,8 @@ def set_column_types(dframe):
                  'Latency (s)']     
      val_ints=['Trial',
                'Sample']
-     dframe[val_floats]=dframe[val_floats].astype(np.float)
-     dframe[val_ints]=dframe[val_ints].astype(np.float).astype(np.int)  #Stackoverflow suggests casting as float then int.  Caused error before
+     dframe[val_floats]=dframe[val_floats].astype(float)
+     dframe[val_ints]=dframe[val_ints].astype(float).astype(int)  #Stackoverflow suggests casting as float then int.  Caused error before
      return dframe
 
 def save_dframe(dframe, dsName):
@@ -124,9 +129,82 @@ def save_dframe(dframe, dsName):
     denoted dipoles in the top subject directory'''
     dipole_folder=os.path.abspath(os.path.join(dsName, 'dipoles'))
     if not os.path.exists(dipole_folder):
-        os.path.mkdir(dipole_folder)
-    dframe.to_csv(os.path.join(dipole_folder,'ds_name'[:-3]+'.csv'))
-    dframe.to_pickle(os.path.join(dipole_folder,'ds_name'[:-3]+'.pkl'))
+        os.makedirs(dipole_folder)
+    ds_name=os.path.basename(os.path.normpath(dsName))
+    dframe.to_csv(os.path.join(dipole_folder,ds_name[:-3]+'.csv'))
+    dframe.to_pickle(os.path.join(dipole_folder,ds_name[:-3]+'.pkl'))
+
+########################### Dipole cache #####################################
+def dipole_cache_key(filename):
+    '''Hash of the file contents and modification time used to name cache entries'''
+    file_hash=hashlib.sha1()
+    with open(filename,'rb') as fid:
+        for block in iter(lambda: fid.read(1<<20), b''):
+            file_hash.update(block)
+    file_hash.update(str(os.stat(filename).st_mtime_ns).encode())
+    return file_hash.hexdigest()[:20]
+
+def save_dframe_npz(dframe, filename):
+    '''Save the dataframe column by column to an uncompressed npz file (name or open binary file)
+    Text columns are stored as unicode arrays with a mask for missing values'''
+    arrays={'columns':np.array(dframe.columns,dtype=str)}
+    for idx,col in enumerate(dframe.columns):
+        values=dframe[col]
+        if values.dtype.kind in 'biuf':
+            arrays['col'+str(idx)]=values.to_numpy()
+        else:
+            missing=values.isnull().to_numpy()
+            arrays['col'+str(idx)]=np.array(['' if m else str(v) for v,m in zip(values,missing)],dtype=str)
+            arrays['missing'+str(idx)]=missing
+    np.savez(filename,**arrays)
+
+def load_dframe_npz(filename):
+    '''Load a dataframe written by save_dframe_npz'''
+    with np.load(filename) as arrays:
+        dframe={}
+        for idx,col in enumerate(arrays['columns']):
+            values=arrays['col'+str(idx)]
+            if 'missing'+str(idx) in arrays.files and arrays['missing'+str(idx)].any():
+                values=values.astype(object)
+                values[arrays['missing'+str(idx)]]=None
+            dframe[str(col)]=values
+    return pd.DataFrame(dframe)
+
+def evict_dipole_cache(cache_dir, max_bytes, keep=None):
+    '''Remove the least recently used cache entries until the folder is below max_bytes'''
+    entries=[os.path.join(cache_dir,f) for f in os.listdir(cache_dir) if f.endswith('.npz')]
+    entries=sorted(entries,key=os.path.getmtime)
+    total=sum(os.path.getsize(f) for f in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if keep is not None and os.path.samefile(entry,keep):
+            continue
+        total-=os.path.getsize(entry)
+        os.remove(entry)
+
+def cached_dipole_dframe(filename, cache_dir=None, max_bytes=500e6):
+    '''Return assemble_dipole_dframe(filename), reusing a parsed copy when available
+    Parsed tables are stored as npz files in a dipoles folder next to the results
+    file (inside the .ds), named by the hash of the file contents and mtime
+    The folder is kept below max_bytes by evicting the least recently used tables'''
+    if not os.path.exists(filename):
+        raise ValueError(filename + ' does not exist')
+    if cache_dir is None:
+        cache_dir=os.path.join(os.path.dirname(os.path.abspath(filename)),'dipoles')
+    cache_file=os.path.join(cache_dir,os.path.basename(filename)+'.'+dipole_cache_key(filename)+'.npz')
+    if os.path.exists(cache_file):
+        os.utime(cache_file)  #Mark as recently used
+        return load_dframe_npz(cache_file)
+    dipole_dframe=assemble_dipole_dframe(filename)
+    os.makedirs(cache_dir,exist_ok=True)
+    # Written under a temporary name and renamed, so a crash or a concurrent run never leaves a partial entry
+    tmp_file='{}.tmp{}'.format(cache_file,os.getpid())
+    with open(tmp_file,'wb') as fid:
+        save_dframe_npz(dipole_dframe,fid)
+    os.replace(tmp_file,cache_file)
+    evict_dipole_cache(cache_dir,max_bytes,keep=cache_file)
+    return dipole_dframe
     
 def PRI_to_LPI_scale(p,r,i):
     '''Converts the PRI CTF coordinates to LPI nifti coordinates
@@ -136,7 +214,76 @@ def PRI_to_LPI_scale(p,r,i):
 
 ############################ Main #############################################
 
-def assemble_dipole_dframe(filename):
+def read_dipole_dframe(filename, chunk_rows=4096):
+    '''Single pass reader for the dfit results file
+    Streams the file line by line and writes the numeric columns of every
+    Fit_Results block straight into a preallocated array of chunk_rows rows, doubled when full
+    Returns the same dataframe as assemble_dipole_dframe_from_dict, including the
+    block ordering and the header/closing line handling of read_chunk'''
+    if not os.path.exists(filename):
+        raise ValueError(filename + ' does not exist')
+    n_num=len(dip_num_columns)
+    values=np.empty((chunk_rows,n_num))
+    seq_idx=np.empty(chunk_rows,dtype=int)
+    markers=[]
+    labels=[]
+    blocks=[]
+    n_rows=0
+    prev=None
+    key=None
+    with open(filename,'r') as fid:
+        for line in fid:
+            if key is None:
+                if line[:1]=='{' and prev is not None:
+                    key=prev.rstrip('\n')
+                    fit_block='Fit_Results' in key
+                    line_idx=1
+                    pending=None
+                    block_start=n_rows
+                prev=line
+                continue
+            if line[:1]=='}':
+                # read_chunk stops one line short of the closing brace, so pending is dropped
+                if fit_block:
+                    blocks.append((block_start,n_rows))
+                key=None
+                prev=line
+                continue
+            line_idx+=1
+            if not fit_block:
+                continue
+            if pending is not None and line_idx>=16:
+                fields=pending.rstrip('\n').split('\t')
+                if len(fields)>=3:
+                    if n_rows==len(values):
+                        values=np.concatenate([values,np.empty_like(values)])
+                        seq_idx=np.concatenate([seq_idx,np.empty_like(seq_idx)])
+                    nums=fields[2:2+n_num]
+                    if len(nums)<n_num:
+                        nums=nums+[np.nan]*(n_num-len(nums))
+                    values[n_rows]=nums
+                    seq_idx[n_rows]=line_idx-16  #Line index after the 15 header lines
+                    markers.append(fields[1])
+                    labels.append(fields[2+n_num] if len(fields)>2+n_num else None)
+                    n_rows+=1
+            pending=line
+    if len(blocks)==0:
+        raise ValueError('No Fit_Results found in ' + filename)
+    # Same ordering as the dictionary path: last block first, then the remaining blocks in order
+    blocks=blocks[-1:]+blocks[:-1]
+    order=np.concatenate([np.arange(start,stop) for start,stop in blocks])
+    values=values[order]
+    dipole_dframe=pd.DataFrame(values,columns=dip_num_columns)
+    dipole_dframe.insert(0,'//',[markers[i] for i in order])
+    dipole_dframe.insert(0,'fit_seq_idx',seq_idx[order])
+    dipole_dframe['Label']=[labels[i] for i in order]
+    dipole_dframe[['Trial','Sample']]=dipole_dframe[['Trial','Sample']].astype(int)
+    dipole_dframe['xLPI']=10*-dipole_dframe['yp']   #PRI to LPI  >> -R,P,I
+    dipole_dframe['yLPI']=10*dipole_dframe['xp']
+    dipole_dframe['zLPI']=10*dipole_dframe['zp']
+    return dipole_dframe
+
+def assemble_dipole_dframe_from_dict(filename):
     '''Generates the dipole dictionary
     Loops over all fit_result keys and creates a dataframe
     Concatenates each dipole fit dataframe to the larger'''
@@ -154,6 +301,10 @@ def assemble_dipole_dframe(filename):
     dipole_dframe['zLPI']=10*dipole_dframe['zp']       
     return dipole_dframe 
 
+def assemble_dipole_dframe(filename):
+    '''Dataframe of all Fit_Results blocks in the dfit results file'''
+    return read_dipole_dframe(filename)
+
 ########### TESTING
 def plot_dframe(dframe, thresh=None):
     tmp_dframe=dframe[dframe['MEG Err(%)']<thresh]
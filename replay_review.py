@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Record the manual review decisions of the dSPM stage and replay them headless
+
+do_dspm_analysis.py stops four times for a reviewer: bad channels after
+raw.plot, excluded ICA components after ica.plot_sources, the BEM/sensor
+alignment check, and bad spike epochs after epochs.plot. In interactive mode
+the decisions are written to a JSON sidecar next to the dSPM output:
+    bads            info['bads']
+    ica_exclude     ica.exclude (with a fingerprint of the ICA unmixing matrix)
+    alignment_ok    the alignment approval
+    dropped_epochs  spike events (indices into the events array) dropped by hand
+In non-interactive mode the same decisions are read back and applied, so the
+stage can rerun unattended with other filter, SNR or window settings.
+
+Usage:
+    review=load_review(review_file)
+    bads=replay_value(review, 'bads', review_file)
+"""
+import hashlib
+import json
+import os
+import numpy as np
+
+def load_review(review_file):
+    '''Return the recorded decisions, or an empty record if none were saved yet'''
+    if not os.path.exists(review_file):
+        return {}
+    with open(review_file,'r') as fid:
+        return json.load(fid)
+
+def save_review(review_file, review):
+    '''Write the decisions, replacing the file atomically'''
+    tmp_file=review_file+'.tmp'
+    with open(tmp_file,'w') as fid:
+        json.dump(review,fid,indent=2,sort_keys=True)
+    os.replace(tmp_file,review_file)
+
+def replay_value(review, key, review_file):
+    '''Recorded decision for key; raises if it was never recorded'''
+    if key not in review:
+        raise ValueError('No recorded "{}" decision in {}; run the stage interactively first'.format(key,review_file))
+    return review[key]
+
+def ica_fingerprint(ica):
+    '''Short hash of the ICA unmixing matrix, to check that replayed exclusions refer to the same components'''
+    return hashlib.sha1(np.round(ica.unmixing_matrix_,4).tobytes()).hexdigest()[:16]
+
+def user_dropped_epochs(epochs):
+    '''Indices (into the events array) of the epochs dropped by hand in epochs.plot'''
+    return [idx for idx,log in enumerate(epochs.drop_log) if 'USER' in log]
+
+def drop_replayed_epochs(epochs, dropped_epochs):
+    '''Drop the epochs whose event indices were recorded as dropped by hand'''
+    drop=np.where(np.isin(epochs.selection,dropped_epochs))[0]
+    return epochs.drop(drop,reason='USER')
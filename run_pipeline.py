@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run the analysis stages for a cohort of subjects
+
+Each stage script runs in its own process with the settings of its subject
+(see stage_config.py), so subjects and independent stages run side by side on a
+bounded pool of max_workers processes. The stages depend on each other as:
+    ecd          do_ECD_analysis.py
+    dspm         do_dspm_analysis.py (headless, replaying the recorded review),
+                 after ecd (the bootstrap reads dipole_timing.txt)
+    parcels      do_get_parcels.py
+    clustering   do_dspm_clustering.py, after ecd, dspm and parcels (which
+                 rebuilds the SUMA folder the clustering reads)
+When a stage finishes, a completion marker with a hash of its inputs is written
+to <work_dir>/markers/<subject>/<stage>.done. The hash covers the stage script and
+the local modules it imports or runs (directly or through other local modules,
+in this folder or in utilities/), its settings, and the markers of the stages it
+depends on, so a stage is run again only when one of them changed (or when it
+is forced), and then every stage after it is run again as well.
+
+The cores are shared between the workers: each stage gets cpu_count/max_workers
+threads for BLAS/OpenMP (AFNI reads OMP_NUM_THREADS) and the same n_jobs for MNE,
+unless the manifest sets n_jobs.
+
+The cohort manifest is a JSON file:
+    {"work_dir": "/data/ied/pipeline",
+     "defaults": {"fs_dir": "/data/freesurfer", "dspm": {"spike_mark": "S"}},
+     "subjects": {"subj1": {"subj": "subj1", "stages": ["ecd", "dspm", "clustering"],
+                            "ecd": {"ctf_run_dir": "...", "project_dir": "..."},
+                            "dspm": {"meg_run": "...", "out_dir": "..."}, ...}}}
+The settings of a stage are the top-level defaults, then the defaults of the
+stage, then the subject's top-level values, then the subject's stage values.
+work_dir (default: the folder of the manifest) also holds the settings files and
+a log of every stage run.
+
+Usage:
+    python run_pipeline.py cohort.json [--max-workers 4] [--force dspm] [--dry-run]
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from stage_config import config_env
+
+scripts_dir=os.path.dirname(os.path.abspath(__file__))
+
+#Stage name: (script, stages it depends on)
+stages={'ecd':('do_ECD_analysis.py',()),
+        'dspm':('do_dspm_analysis.py',('ecd',)),
+        'parcels':('do_get_parcels.py',()),
+        'clustering':('do_dspm_clustering.py',('ecd','dspm','parcels'))}
+
+#Folders searched for the local modules and scripts of a stage
+module_dirs=(scripts_dir,os.path.join(scripts_dir,'utilities'))
+
+#Settings added to every stage unless the manifest sets them
+stage_defaults={'dspm':{'interactive':False}}
+
+#Thread pools limited to the per-stage share of the cores
+thread_vars=('OMP_NUM_THREADS','OPENBLAS_NUM_THREADS','MKL_NUM_THREADS','NUMEXPR_NUM_THREADS','VECLIB_MAXIMUM_THREADS')
+
+def read_manifest(manifest_file):
+    '''Read the cohort manifest; work_dir defaults to the folder of the manifest'''
+    with open(manifest_file,'r') as fid:
+        manifest=json.load(fid)
+    if 'subjects' not in manifest:
+        raise ValueError('No subjects in ' + manifest_file)
+    manifest.setdefault('work_dir',os.path.dirname(os.path.abspath(manifest_file)))
+    manifest.setdefault('defaults',{})
+    return manifest
+
+def subject_stages(subject):
+    '''Stages requested for a subject, with the stages they depend on, in dependency order'''
+    requested=set(subject.get('stages',stages.keys()))
+    unknown=requested-set(stages)
+    if unknown:
+        raise ValueError('Unknown stages {}; available stages: {}'.format(sorted(unknown),list(stages)))
+    needed=set()
+    def add(stage):
+        if stage not in needed:
+            needed.add(stage)
+            for dep in stages[stage][1]:
+                add(dep)
+    for stage in requested:
+        add(stage)
+    return [stage for stage in stages if stage in needed]
+
+def stage_settings(manifest, subj, stage, n_threads):
+    '''Settings of one stage of one subject (see the module docstring for the order)'''
+    defaults=manifest['defaults']
+    subject=manifest['subjects'][subj]
+    settings=dict(stage_defaults.get(stage,{}))
+    settings['n_jobs']=n_threads
+    for level in defaults,subject:
+        settings.update({key:value for key,value in level.items() if key not in stages and key != 'stages'})
+        settings.update(level.get(stage,{}))
+    return settings
+
+def local_module(name):
+    '''Path of the local module or script name (without .py), None if it is not one'''
+    for folder in module_dirs:
+        path=os.path.join(folder,name+'.py')
+        if os.path.exists(path):
+            return path
+    return None
+
+def local_imports(script):
+    '''The local modules imported by script, and the local scripts it runs, followed through those modules'''
+    found=set()
+    todo=[script]
+    while todo:
+        with open(todo.pop(),'r') as fid:
+            text=fid.read()
+        # Imports, and scripts run as "python <script>.py" or named in a '<script>.py' string
+        names=(re.findall(r'^\s*(?:from|import)\s+(\w+)',text,flags=re.M)+re.findall(r'python3?\s+\S*?(\w+)\.py\b',text)
+               +re.findall(r'[\'"/](\w+)\.py[\'"]',text))
+        for path in filter(None,map(local_module,names)):
+            if path not in found and path != script:
+                found.add(path)
+                todo.append(path)
+    return sorted(found)
+
+def stage_key(script, settings, dep_markers):
+    '''Hash of everything a stage run depends on'''
+    key=hashlib.sha1()
+    for path in [script]+local_imports(script):
+        with open(path,'rb') as fid:
+            key.update(os.path.basename(path).encode())
+            key.update(fid.read())
+    key.update(json.dumps(settings,sort_keys=True).encode())
+    for marker in dep_markers:
+        key.update(json.dumps(marker,sort_keys=True).encode())
+    return key.hexdigest()
+
+def read_marker(marker_file):
+    '''Contents of a completion marker, or None if the stage has not completed'''
+    if not os.path.exists(marker_file):
+        return None
+    with open(marker_file,'r') as fid:
+        return json.load(fid)
+
+def write_marker(marker_file, key):
+    '''Write a completion marker atomically'''
+    os.makedirs(os.path.dirname(marker_file),exist_ok=True)
+    tmp_file=marker_file+'.tmp'
+    with open(tmp_file,'w') as fid:
+        json.dump({'key':key,'finished':time.time()},fid)
+    os.replace(tmp_file,marker_file)
+
+def thread_env(n_threads):
+    '''Environment of a stage process with the thread pools limited to n_threads'''
+    env=dict(os.environ)
+    env.update({var:str(n_threads) for var in thread_vars})
+    return env
+
+def run_stage(script, config_file, log_file, n_threads):
+    '''Run a stage script in a new process with its settings file; returns the exit code'''
+    env=thread_env(n_threads)
+    env[config_env]=config_file
+    with open(log_file,'w') as log:
+        return subprocess.run([sys.executable,script],cwd=scripts_dir,env=env,stdout=log,stderr=subprocess.STDOUT).returncode
+
+def run_pipeline(manifest, max_workers=None, force=(), dry_run=False):
+    '''Run all stages of all subjects of the manifest that are not up to date
+    force is a list of stages to run again for every subject
+    Returns a dictionary of {(subject, stage): 'done', 'up to date', 'failed' or 'skipped'}
+    ('would run' instead of running with dry_run)'''
+    max_workers=max_workers or os.cpu_count()
+    n_threads=max(1,os.cpu_count()//max_workers)
+    work_dir=manifest['work_dir']
+    for folder in 'markers','configs','logs':
+        os.makedirs(os.path.join(work_dir,folder),exist_ok=True)
+
+    pending={(subj,stage) for subj in manifest['subjects'] for stage in subject_stages(manifest['subjects'][subj])}
+    status={}
+    markers={}
+    running={}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            # Stages are visited in dependency order, so a stage whose inputs are up to date unblocks the next in the same pass
+            for subj,stage in sorted(pending,key=lambda task: (list(stages).index(task[1]),task[0])):
+                script,deps=stages[stage]
+                dep_status=[status.get((subj,dep)) for dep in deps]
+                if any(s in ('failed','skipped') for s in dep_status):
+                    status[(subj,stage)]='skipped'
+                    pending.discard((subj,stage))
+                    continue
+                if any(s is None for s in dep_status):
+                    continue
+                pending.discard((subj,stage))
+                script=os.path.join(scripts_dir,script)
+                settings=stage_settings(manifest,subj,stage,n_threads)
+                key=stage_key(script,settings,[markers[(subj,dep)] for dep in deps])
+                marker_file=os.path.join(work_dir,'markers',subj,stage+'.done')
+                marker=read_marker(marker_file)
+                if marker is not None and marker['key'] == key and stage not in force:
+                    markers[(subj,stage)]=marker
+                    status[(subj,stage)]='up to date'
+                    continue
+                if dry_run:
+                    print('Would run {} for {}'.format(stage,subj))
+                    markers[(subj,stage)]={'key':key,'finished':None}
+                    status[(subj,stage)]='would run'
+                    continue
+                config_file=os.path.join(work_dir,'configs','{}.{}.json'.format(subj,stage))
+                with open(config_file,'w') as fid:
+                    json.dump(settings,fid,indent=2,sort_keys=True)
+                log_file=os.path.join(work_dir,'logs','{}.{}.log'.format(subj,stage))
+                print('Running {} for {} (log: {})'.format(stage,subj,log_file))
+                running[pool.submit(run_stage,script,config_file,log_file,n_threads)]=(subj,stage,key,marker_file)
+            if not running:
+                if pending:
+                    # Only reached if the remaining stages wait on stages that were never scheduled
+                    raise ValueError('Cannot schedule stages {}'.format(sorted(pending)))
+                break
+            finished,_=wait(running,return_when=FIRST_COMPLETED)
+            for future in finished:
+                subj,stage,key,marker_file=running.pop(future)
+                if future.result() == 0:
+                    write_marker(marker_file,key)
+                    markers[(subj,stage)]=read_marker(marker_file)
+                    status[(subj,stage)]='done'
+                else:
+                    print('{} failed for {}; see {}'.format(stage,subj,os.path.join(work_dir,'logs','{}.{}.log'.format(subj,stage))))
+                    status[(subj,stage)]='failed'
+    return status
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description='Run the analysis stages for a cohort of subjects')
+    parser.add_argument('manifest',help='cohort manifest (JSON)')
+    parser.add_argument('--max-workers',type=int,default=None,help='stages run at the same time (default: number of cores)')
+    parser.add_argument('--force',default='',help='comma-separated stages to run again for every subject')
+    parser.add_argument('--dry-run',action='store_true',help='only list the stages that would run')
+    args=parser.parse_args()
+    status=run_pipeline(read_manifest(args.manifest),max_workers=args.max_workers,
+                        force=[stage for stage in args.force.split(',') if stage],dry_run=args.dry_run)
+    for (subj,stage),result in sorted(status.items()):
+        print('{}\t{}\t{}'.format(subj,stage,result))
+    sys.exit(int(any(result == 'failed' for result in status.values())))
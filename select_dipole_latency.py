@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+First and peak dipole latencies for many dipole tables at once
+
+Applies the selection of do_ECD_analysis.py to every group (run, marker,
+subject, ...) of a concatenated dipole table in one groupby pass:
+    keep the fits with Err(%) below 100-error (optionally inside a latency window)
+    drop the last kept fit of each group (the sample after the peak)
+    first is the Sample of the first remaining fit, peak the Sample of the last
+and returns the dipole row matching each latency (the first row with that Sample).
+
+Usage:
+    summary,dipoles=select_first_peak({('subj1','run1'):dframe1, ...}, group_cols=['Subject','Run'], error=70)
+    summary=cohort_latency_table(dip_files, error=[60,70,80])
+
+or from the command line, for a cohort of dfit results files:
+    python select_dipole_latency.py 70 subj1.dip subj2.dip ... > latencies.csv
+"""
+import sys
+import numpy as np
+import pandas as pd
+from read_dip_results import cached_dipole_dframe
+
+def concat_dipole_dframes(dipole_dframes, group_cols):
+    '''Concatenate a dictionary of {group key: dipole dataframe} with the keys as group columns'''
+    keys=list(dipole_dframes.keys())
+    for key in keys:
+        key=key if isinstance(key,tuple) else (key,)
+        if len(key) != len(group_cols):
+            raise ValueError('Group key {} does not match group columns {}'.format(key,group_cols))
+    dframe=pd.concat([dipole_dframes[key] for key in keys],keys=keys,names=group_cols)
+    dframe=dframe.reset_index(level=list(range(len(group_cols))))
+    return dframe.reset_index(drop=True)
+
+def select_first_peak(dipole_dframes, group_cols=None, error=70, tmin=None, tmax=None, drop_last=True):
+    '''Return the first/peak summary per group and the matching dipole rows
+    dipole_dframes is a dictionary of {group key: dipole dataframe} or a single dataframe
+    with the group_cols already present (the whole frame is one group if group_cols is None)
+    tmin/tmax restrict the fits to a window of Latency (s) before the error threshold
+    summary has one row per group with first, peak, their latencies and the number of good fits;
+    dipoles has one row per group and metric ('first'/'peak') with the dipole columns'''
+    if isinstance(dipole_dframes,dict):
+        group_cols=list(group_cols) if group_cols is not None else ['group']
+        dframe=concat_dipole_dframes(dipole_dframes,group_cols)
+    else:
+        dframe=dipole_dframes.reset_index(drop=True)
+        if group_cols is None:
+            group_cols=['group']
+            dframe=dframe.assign(group=0)
+        group_cols=list(group_cols)
+    groups=dframe[group_cols].drop_duplicates()
+    keep=dframe['Err(%)'].to_numpy() < (100-error)
+    if tmin is not None:
+        keep&=dframe['Latency (s)'].to_numpy() >= tmin
+    if tmax is not None:
+        keep&=dframe['Latency (s)'].to_numpy() <= tmax
+    good=dframe[keep]
+    if drop_last:
+        good=good[good.groupby(group_cols,sort=False).cumcount(ascending=False).to_numpy() > 0]
+    by_group=good.groupby(group_cols,sort=False)
+    summary=pd.DataFrame({'first':by_group['Sample'].first(),
+                          'peak':by_group['Sample'].last(),
+                          'first_latency':by_group['Latency (s)'].first(),
+                          'peak_latency':by_group['Latency (s)'].last(),
+                          'n_good':by_group.size()}).reset_index()
+    summary=groups.merge(summary,on=group_cols,how='left')
+    summary['n_good']=summary['n_good'].fillna(0).astype(int)
+    summary[['first','peak']]=summary[['first','peak']].astype(float)
+    dipoles=[]
+    for metric in 'first','peak':
+        targets=summary[group_cols+[metric]].dropna().rename(columns={metric:'Sample'})
+        matched=dframe.merge(targets,on=group_cols+['Sample'],how='inner',sort=False)
+        dipoles.append(matched.drop_duplicates(group_cols,keep='first').assign(metric=metric))
+    dipoles=pd.concat(dipoles,ignore_index=True)
+    return summary, dipoles
+
+def cohort_latency_table(dip_files, error=70, tmin=None, tmax=None, group_cols=None):
+    '''First/peak summary of a cohort of dfit results files in one table
+    dip_files is a dictionary of {group key: .dip filename} (or a list of filenames, keyed by
+    filename); parsed tables come from the dipole cache. error may be a list of thresholds,
+    in which case one summary per threshold is stacked with an error column'''
+    if not isinstance(dip_files,dict):
+        dip_files={filename:filename for filename in dip_files}
+        group_cols=['dip_file']
+    group_cols=list(group_cols) if group_cols is not None else ['group']
+    dframes={key:cached_dipole_dframe(filename) for key,filename in dip_files.items()}
+    dframe=concat_dipole_dframes(dframes,group_cols)
+    summaries=[]
+    for threshold in np.atleast_1d(error):
+        summary,dipoles=select_first_peak(dframe,group_cols=group_cols,error=threshold,tmin=tmin,tmax=tmax)
+        summaries.append(summary.assign(error=threshold))
+    return pd.concat(summaries,ignore_index=True)
+
+if __name__=='__main__':
+    if len(sys.argv) <= 2:
+        raise ValueError('Usage: select_dipole_latency.py error dipole_file [dipole_file ...]')
+    errors=[float(e) for e in sys.argv[1].split(',')]
+    cohort_latency_table(sys.argv[2:],error=errors).to_csv(sys.stdout,index=False)
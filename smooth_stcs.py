@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Centered moving average of source time courses along the time axis
+
+moving_average works on the whole sources x time matrix at once and gives the
+same result as pandas rolling(window, center=True, min_periods=1).mean() on
+every row: the window of sample i covers samples i-window//2 to
+i+window-window//2-1, truncated (and renormalized) at the edges.
+The boxcar uses cumulative sums; other kernels (any scipy.signal window name,
+or an array of weights) use a normalized correlation with the same alignment.
+
+Rows are processed in chunks of chunk_rows with float64 accumulation, and the
+result can be written in place (out=data), e.g. on float32 data.
+
+Usage:
+    stc.data=moving_average(stc.data, window=30)
+    moving_average(data, window=30, kernel='hann', out=data)
+"""
+import numpy as np
+from scipy.ndimage import correlate1d
+from scipy.signal import get_window
+
+#Number of sources smoothed at once; bounds the float64 working memory
+chunk_rows=4096
+
+def window_weights(kernel, window):
+    '''Weights of the smoothing kernel; kernel is 'boxcar', a scipy.signal window name or an array'''
+    if isinstance(kernel,str):
+        return get_window(kernel,window,fftbins=False).astype(np.float64)
+    weights=np.asarray(kernel,dtype=np.float64)
+    if len(weights) != window:
+        raise ValueError('Kernel length does not match the window')
+    return weights
+
+def moving_average(data, window=30, kernel='boxcar', out=None):
+    '''Centered moving average of data (..., n_times) along the last axis with min_periods=1 edges
+    Returns out (a new array of the dtype of data if out is None)'''
+    data=np.asarray(data)
+    if out is None:
+        out=np.empty(data.shape,dtype=data.dtype if data.dtype.kind == 'f' else np.float64)
+    n_times=data.shape[-1]
+    rows=data.reshape(-1,n_times)
+    out_rows=out.reshape(-1,n_times)
+    if isinstance(kernel,str) and kernel == 'boxcar':
+        left=window//2
+        right=window-left-1
+        stop=np.minimum(np.arange(n_times)+right+1,n_times)
+        start=np.maximum(np.arange(n_times)-left,0)
+        counts=(stop-start).astype(np.float64)
+        for first in range(0,len(rows),chunk_rows):
+            chunk=rows[first:first+chunk_rows]
+            cumsum=np.zeros((len(chunk),n_times+1))
+            np.cumsum(chunk,axis=1,dtype=np.float64,out=cumsum[:,1:])
+            out_rows[first:first+chunk_rows]=(cumsum[:,stop]-cumsum[:,start])/counts
+        return out
+    weights=window_weights(kernel,window)
+    # correlate1d centers the weights at window//2, so the window of sample i starts at i-window//2 as above
+    norm=correlate1d(np.ones(n_times),weights,mode='constant',cval=0.)
+    for first in range(0,len(rows),chunk_rows):
+        chunk=rows[first:first+chunk_rows].astype(np.float64)
+        out_rows[first:first+chunk_rows]=correlate1d(chunk,weights,axis=1,mode='constant',cval=0.)/norm
+    return out
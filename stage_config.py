@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Settings of a stage script passed in by the pipeline scheduler
+
+The stage scripts (do_ECD_analysis.py, do_dspm_analysis.py, ...) are configured
+through module-level globals. When run_pipeline.py starts a stage, it writes the
+settings of the subject to a JSON file and names it in the environment variable
+config_env; override_globals then replaces the globals the script has already
+defined with the values from that file. Without the variable nothing changes, so
+the scripts still run as before when edited and started by hand.
+
+Usage, after the user inputs of a stage script:
+    override_globals(globals())
+"""
+import json
+import os
+
+#Environment variable naming the JSON settings file of the running stage
+config_env='LOCALIZE_MEG_CONFIG'
+
+def read_stage_config():
+    '''Settings of the running stage, or an empty dictionary outside the scheduler'''
+    config_file=os.environ.get(config_env)
+    if not config_file:
+        return {}
+    with open(config_file,'r') as fid:
+        return json.load(fid)
+
+def override_globals(namespace):
+    '''Replace the variables of namespace (the globals() of a stage script) that are set
+    in the stage settings; settings for variables not defined yet are left for a later call'''
+    config=read_stage_config()
+    for key,value in config.items():
+        if key in namespace:
+            namespace[key]=value
+    return config
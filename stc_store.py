@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact, memory-mapped store of source time courses
+
+The dSPM source time courses are written once as float32 in a .npy file laid
+out time-major, (n_times, n_sources), so the values of all sources at one
+timepoint are contiguous and reading a few timepoints only touches those rows
+of the memory-mapped file. A JSON sidecar records what is needed to interpret
+the rows:
+    vertices      source space vertex numbers (lh, rh) in source order
+    tmin, tstep   sampling of the time axis (seconds)
+    subject, n_sources, n_times
+
+Usage:
+    write_stc_store(os.path.join(out_dir,'stcs'), stc.data, stc.vertices, stc.tmin, stc.tstep, subject=subj)
+    stcs=read_stc_store(os.path.join(dspm_dir,'stcs'))
+    values=stcs.timepoint(select_tp)          # (n_sources,)
+    values=stcs.timepoints([first, peak])     # (n_sources, 2)
+"""
+import json
+import os
+from typing import NamedTuple
+import numpy as np
+
+class StcStore(NamedTuple):
+    data: np.ndarray    # memory-mapped (n_times, n_sources) float32
+    vertices: list
+    tmin: float
+    tstep: float
+    subject: str
+
+    @property
+    def times(self):
+        '''Time (seconds) of every timepoint'''
+        return self.tmin+self.tstep*np.arange(len(self.data))
+
+    def timepoint(self, sample):
+        '''Values of all sources at one timepoint (index into times)'''
+        return np.asarray(self.data[sample],dtype=np.float64)
+
+    def timepoints(self, samples):
+        '''Values of all sources at several timepoints as (n_sources, len(samples))'''
+        return np.asarray(self.data[np.asarray(samples)],dtype=np.float64).T
+
+    def time_index(self, time):
+        '''Index of the timepoint closest to time (seconds)'''
+        return int(np.clip(round((time-self.tmin)/self.tstep),0,len(self.data)-1))
+
+def write_stc_store(prefix, data, vertices, tmin, tstep, subject=None):
+    '''Write source time courses data (n_sources, n_times) to prefix.npy (float32, time-major) and prefix.json'''
+    data=np.asarray(data)
+    if data.shape[0] != sum(len(v) for v in vertices):
+        raise ValueError('Data rows do not match the number of vertices')
+    tmp_file=prefix+'.tmp.npy'
+    store=np.lib.format.open_memmap(tmp_file,mode='w+',dtype=np.float32,shape=(data.shape[1],data.shape[0]))
+    store[:]=data.T
+    store.flush()
+    del store
+    os.replace(tmp_file,prefix+'.npy')
+    meta={'vertices':[np.asarray(v).tolist() for v in vertices],'tmin':float(tmin),'tstep':float(tstep),
+          'subject':subject,'n_sources':int(data.shape[0]),'n_times':int(data.shape[1])}
+    with open(prefix+'.json','w') as fid:
+        json.dump(meta,fid)
+
+def read_stc_store(prefix):
+    '''Open a store written by write_stc_store; the data stay on disk until indexed'''
+    with open(prefix+'.json','r') as fid:
+        meta=json.load(fid)
+    data=np.load(prefix+'.npy',mmap_mode='r')
+    if data.shape != (meta['n_times'],meta['n_sources']):
+        raise ValueError('{}.npy does not match its metadata'.format(prefix))
+    return StcStore(data,[np.array(v) for v in meta['vertices']],meta['tmin'],meta['tstep'],meta['subject'])
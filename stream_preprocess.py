@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Out-of-core preprocessing of long CTF runs into a float32 buffer on disk
+
+stream_preprocess_ctf does what the dSPM stage does after loading the run
+(pick the MEG channels, resample to 600 Hz, band-pass 5-50 Hz) one chunk at
+a time: each chunk is read with enough padding on both sides for the
+resampling (MNE polyphase) and FIR band-pass filters to settle, filtered,
+trimmed back and appended to a float32 file laid out as (time, channel).
+Chunks are sized so their float64 working copies stay below max_bytes.
+
+The result is a RawBuffer: an MNE Raw that is not preloaded and reads any
+time window from the buffer on demand, with the info and marks (annotations)
+of the run. Events, epochs, covariances and plots work on it as on a loaded
+Raw. ica.apply does not (it needs preloaded data), so use
+apply_ica_chunked, which cleans the buffer in place chunk by chunk. Note that
+a full ICA fit reads all the data; fit on a sample (cache_ica decim/n_segments)
+to keep memory bounded.
+
+Usage:
+    raw=stream_preprocess_ctf(meg_run, buffer_file, sfreq=600, l_freq=5, h_freq=50, max_bytes=4e9)
+    apply_ica_chunked(ica, raw, max_bytes=4e9)
+"""
+import os
+from fractions import Fraction
+import numpy as np
+import mne
+from mne.io import BaseRaw
+
+#Float64 copies of a chunk held at once while it is read, resampled and filtered
+working_copies=8
+
+class RawBuffer(BaseRaw):
+    '''Raw reading its data on demand from a float32 (time, channel) buffer file'''
+
+    def __init__(self, buffer_file, info, n_times, first_samp=0):
+        with info._unlock():
+            for ch in info['chs']:
+                ch['cal']=1.
+                ch['range']=1.
+        extras={'n_times':n_times,'n_channels':info['nchan'],'first_samp':first_samp,'ch_names':list(info['ch_names'])}
+        super().__init__(info,preload=False,first_samps=[first_samp],last_samps=[first_samp+n_times-1],
+                         filenames=[os.path.abspath(buffer_file)],raw_extras=[extras],orig_format='single')
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        '''Read samples start to stop (counted from first_samp) of the channels idx'''
+        extras=self._raw_extras[fi]
+        buffer=np.memmap(self._filenames[fi],dtype=np.float32,mode='r',shape=(extras['n_times'],extras['n_channels']))
+        one=np.asarray(buffer[start-extras['first_samp']:stop-extras['first_samp']].T,dtype=np.float64)
+        if mult is not None:
+            data[:]=mult @ one[idx]
+        else:
+            data[:]=one[idx]*cals
+
+def resample_fraction(sfreq, new_sfreq):
+    '''(up, down) of the resampling from sfreq to new_sfreq'''
+    ratio=Fraction(new_sfreq/sfreq).limit_denominator(1000)
+    return ratio.numerator, ratio.denominator
+
+def stream_preprocess_ctf(meg_run, buffer_file, sfreq=600., l_freq=5., h_freq=50., max_bytes=4e9):
+    '''Pick the MEG channels of a CTF run, resample them to sfreq and band-pass them, chunk by chunk,
+    into buffer_file; returns a RawBuffer of the result'''
+    raw=mne.io.read_raw_ctf(meg_run,system_clock='ignore',preload=False)
+    picks=mne.pick_types(raw.info,meg=True,eeg=False,ref_meg=False)
+    # Picking on the unloaded run drops the compensators that need the reference channels, as raw.pick_types does
+    info=raw.copy().pick(picks).info
+    up,down=resample_fraction(raw.info['sfreq'],sfreq)
+    n_times=raw.n_times
+    n_out=int(round(n_times*up/down))
+
+    # Padding (input samples) covering half the band-pass filter and the resampling filter, in whole resampling blocks
+    filter_len=len(mne.filter.create_filter(None,sfreq,l_freq,h_freq,verbose=False))
+    pad=int(np.ceil(filter_len*down/up))+20*max(up,down)//up+1
+    pad=-(-pad//down)*down
+    n_read=len(mne.pick_types(raw.info,meg=True,ref_meg=True))
+    chunk=int(max_bytes/(8*n_read*working_copies))-2*pad
+    chunk=(chunk//down)*down
+    if chunk <= 0:
+        raise ValueError('max_bytes is too small for the filter padding of {} samples'.format(pad))
+
+    print('Preprocessing {} samples in chunks of {} into {}'.format(n_times,chunk,buffer_file))
+    tmp_file=buffer_file+'.tmp'
+    written=0
+    with open(tmp_file,'wb') as fid:
+        for start in range(0,n_times,chunk):
+            stop=min(start+chunk,n_times)
+            read_start=max(start-pad,0)
+            data=raw.get_data(picks=picks,start=read_start,stop=min(stop+pad,n_times))
+            if (up,down) != (1,1):
+                data=mne.filter.resample(data,up=up,down=down,method='polyphase',verbose=False)
+            data=mne.filter.filter_data(data,sfreq,l_freq,h_freq,verbose=False)
+            first=(start-read_start)*up//down
+            n_keep=n_out-written if stop == n_times else (stop-start)*up//down
+            fid.write(np.ascontiguousarray(data[:,first:first+n_keep].T,dtype=np.float32).tobytes())
+            written+=n_keep
+    os.replace(tmp_file,buffer_file)
+
+    with info._unlock():
+        info['sfreq']=float(sfreq)
+        info['highpass']=float(l_freq)
+        info['lowpass']=float(h_freq)
+    out=RawBuffer(buffer_file,info,n_out,first_samp=int(round(raw.first_samp*up/down)))
+    out.set_annotations(raw.annotations)
+    return out
+
+def apply_ica_chunked(ica, raw, max_bytes=4e9):
+    '''Remove the excluded ICA components from the buffer of a RawBuffer in place, chunk by chunk
+    raw may have channels dropped (e.g. bads); only its channels are rewritten'''
+    extras=raw._raw_extras[0]
+    buffer=np.memmap(raw.filenames[0],dtype=np.float32,mode='r+',shape=(extras['n_times'],extras['n_channels']))
+    rows=[extras['ch_names'].index(name) for name in raw.ch_names]
+    chunk=max(int(max_bytes/(8*len(raw.ch_names)*working_copies)),1)
+    for start in range(0,raw.n_times,chunk):
+        stop=min(start+chunk,raw.n_times)
+        piece=mne.io.RawArray(raw.get_data(start=start,stop=stop),raw.info,verbose=False)
+        ica.apply(piece,verbose=False)
+        buffer[start:stop,rows]=piece.get_data().T
+    buffer.flush()
+    return raw
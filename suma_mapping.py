@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Values of the MNE virtual sensors on the vertices of a SUMA standard mesh
+
+The suma2mne table of a hemisphere (written by utilities/stc2gii_align.py) lists
+for each SUMA vertex the virtual sensor (row of the source time courses, with
+the right hemisphere after the left) closest to it. compile_suma2mne turns it
+into one integer index per vertex of the mesh (-1 where no virtual sensor is
+mapped; the first row wins if a vertex is listed twice), so the values of any
+number of timepoints are mapped with a single take:
+    suma_values=map_to_suma(index, data)    # (n_nodes,) or (n_nodes, n_times)
+Unmapped vertices get 0, as in the original table filling.
+
+The number of vertices is read from the mesh (GIFTI or Freesurfer surface).
+
+The binary index written next to the table (.npz) is read without parsing
+text. It also keeps the three nodes SurfToSurf relates to every vertex with
+their barycentric weights; with all_nodes=True the result is a sparse
+(n_nodes x n_sources) matrix interpolating the three virtual sensors (weights
+renormalized over the nodes that exist), used by map_to_suma in the same way.
+
+Usage:
+    index=compile_suma2mne(os.path.join(dspm_dir,subj+'_lh_suma2mne.npz'), mesh_n_nodes(lh_smoothwm))
+    values=map_to_suma(index, stcs.timepoints([first, peak]))
+"""
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import nibabel as nib
+
+def mesh_n_nodes(surf_file):
+    '''Number of vertices of a surface mesh (GIFTI or Freesurfer geometry)'''
+    if surf_file.endswith('.gii'):
+        img=nib.load(surf_file)
+        return len(img.get_arrays_from_intent('NIFTI_INTENT_POINTSET')[0].data)
+    return len(nib.freesurfer.read_geometry(surf_file)[0])
+
+def compile_suma2mne(suma2mne_file, n_nodes, all_nodes=False, n_sources=None):
+    '''Index (n_nodes,) of the virtual sensor of every SUMA vertex, -1 where there is none, from the
+    suma2mne table (.csv) or binary index (.npz); with all_nodes, the sparse interpolation matrix from
+    the three nodes of a binary index (n_sources defaults to the largest node + 1)'''
+    if suma2mne_file.endswith('.npz'):
+        with np.load(suma2mne_file) as npz:
+            vertex,node,weight=npz['vertex'],npz['node'],npz['weight']
+    elif all_nodes:
+        raise ValueError('All three nodes need the binary index (.npz), not {}'.format(suma2mne_file))
+    else:
+        table=pd.read_csv(suma2mne_file,delimiter=' ',usecols=['SUMA_vertex','virtual_sensor_node'])
+        vertex=table['SUMA_vertex'].to_numpy().astype(int)
+        node=table['virtual_sensor_node'].to_numpy().astype(int)[:,np.newaxis]
+        weight=np.ones(node.shape)
+    if len(vertex) > 0 and vertex.max() >= n_nodes:
+        raise ValueError('{} maps vertex {} beyond the {} vertices of the mesh'.format(suma2mne_file,vertex.max(),n_nodes))
+    if all_nodes:
+        if n_sources is None:
+            n_sources=int(node.max())+1 if node.size else 0
+        weight=np.where(node >= 0,weight,0.)
+        total=weight.sum(axis=1,keepdims=True)
+        weight=np.divide(weight,total,out=np.zeros_like(weight),where=total > 0)
+        valid=(node >= 0) & (weight > 0)
+        rows=np.broadcast_to(vertex[:,np.newaxis],node.shape)
+        # Keep the first row of a vertex listed twice
+        _,first=np.unique(vertex,return_index=True)
+        valid&=np.isin(np.arange(len(vertex)),first)[:,np.newaxis]
+        return scipy.sparse.csr_matrix((weight[valid],(rows[valid],node[valid])),shape=(n_nodes,n_sources))
+    # The first node of the first row of every vertex
+    keep=node[:,0] >= 0
+    vertex,node=vertex[keep],node[keep,0]
+    _,first=np.unique(vertex,return_index=True)
+    index=np.full(n_nodes,-1,dtype=np.int64)
+    index[vertex[first]]=node[first]
+    return index
+
+def map_to_suma(index, data):
+    '''Values of data (n_sources,) or (n_sources, n_times) on the SUMA vertices, 0 where unmapped
+    index is an index array or interpolation matrix from compile_suma2mne'''
+    data=np.asarray(data)
+    if scipy.sparse.issparse(index):
+        if index.shape[1] > len(data):
+            raise ValueError('The interpolation matrix reaches virtual sensor {} of {}'.format(index.shape[1]-1,len(data)))
+        return np.asarray(index@data[:index.shape[1]],dtype=np.float64)
+    mapped=(index >= 0) & (index < len(data))
+    out=np.zeros((len(index),)+data.shape[1:],dtype=np.float64)
+    out[mapped]=data[index[mapped]]
+    return out
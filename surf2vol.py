@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sparse surface-to-volume projection (replaces 3dSurf2Vol -map_func nzave and @ROI_modal_grow)
+
+The projection of a hemisphere depends only on its pial and white matter
+surfaces and the grid of the SurfVol, so it is built once as a sparse
+(voxels x vertices) matrix and every surface map is then projected with one
+sparse product:
+    segments     each vertex is joined from surf_A (pial) to surf_B (smoothwm)
+                 and the segment sampled at f_steps evenly spaced points, ends
+                 included; every voxel a segment passes through is counted once
+                 for that vertex (3dSurf2Vol -f_index voxels)
+    nzave        a voxel gets the mean of the non-zero values of its vertices:
+                 the matrix is applied to the values and to their non-zero
+                 indicator together and the two are divided
+    hole filling n_grow times, every empty voxel next to a filled one (face
+                 neighbours) takes the values of its filled neighbours, pooled
+                 into the same mean; @ROI_modal_grow takes their mode, which
+                 is not defined for continuous dSPM values. Growth stays within
+                 the non-zero voxels of mask_file (a brain mask on the grid), as
+                 @ROI_modal_grow -mask
+Only the voxels the projection reaches are stored. Surface coordinates are
+taken as RAS millimetres of the grid (SUMA GIFTI surfaces and the SurfVol
+NIFTI written by @SUMA_Make_Spec_FS). The matrix is cached as an .npz file
+named by a hash of the surfaces, the grid and the settings.
+
+Usage:
+    projection=surf2vol_projection(lh_pial, lh_smoothwm, surfvol_file, mask_file=brain_mask_file, cache_dir=out_dir)
+    values=project_surface(projection, smoothed)          # (n_voxels,) or (n_voxels, n_maps)
+    volume=to_volume(projection, values)                   # grid_shape (+ (n_maps,))
+"""
+import hashlib
+import os
+from typing import NamedTuple
+import numpy as np
+import scipy.sparse
+import nibabel as nib
+from cache_mne_models import hash_files, cached_file
+from surface_smoothing import read_surface
+
+class Surf2Vol(NamedTuple):
+    matrix: scipy.sparse.csr_matrix    # (len(voxels), n_vertices)
+    voxels: np.ndarray                 # flat indices into the grid of the rows of matrix
+    grid_shape: tuple
+    affine: np.ndarray
+
+def segment_voxels(coords_a, coords_b, affine, grid_shape, f_steps=15):
+    '''Sparse (flat voxel index, vertex) incidence of the segments joining coords_a to coords_b'''
+    fractions=np.linspace(0,1,f_steps)
+    points=coords_a[np.newaxis]+fractions[:,np.newaxis,np.newaxis]*(coords_b-coords_a)[np.newaxis]
+    ijk=np.rint(nib.affines.apply_affine(np.linalg.inv(affine),points)).astype(np.int64)
+    vertex=np.broadcast_to(np.arange(len(coords_a)),ijk.shape[:2])
+    inside=np.all((ijk >= 0) & (ijk < np.array(grid_shape[:3])),axis=2)
+    flat=np.ravel_multi_index(tuple(ijk[inside].T),grid_shape[:3])
+    pairs=np.unique(np.stack([flat,vertex[inside]],axis=1),axis=0)
+    voxels,rows=np.unique(pairs[:,0],return_inverse=True)
+    matrix=scipy.sparse.csr_matrix((np.ones(len(pairs)),(rows,pairs[:,1])),shape=(len(voxels),len(coords_a)))
+    return voxels, matrix
+
+def grow_matrix(voxels, grid_shape, mask=None):
+    '''Voxels after one step of growth into the empty face neighbours of voxels (sorted flat indices),
+    and the sparse matrix summing every new voxel from its neighbours (identity for the old ones)'''
+    ijk=np.stack(np.unravel_index(voxels,grid_shape[:3]),axis=1)
+    steps=np.concatenate([np.eye(3,dtype=np.int64),-np.eye(3,dtype=np.int64)])
+    neighbours=(ijk[:,np.newaxis]+steps[np.newaxis]).reshape(-1,3)
+    source=np.repeat(np.arange(len(voxels)),len(steps))
+    inside=np.all((neighbours >= 0) & (neighbours < np.array(grid_shape[:3])),axis=1)
+    flat=np.ravel_multi_index(tuple(neighbours[inside].T),grid_shape[:3])
+    source=source[inside]
+    new=~np.isin(flat,voxels)
+    if mask is not None:
+        new&=np.asarray(mask,bool).ravel()[flat]
+    grown=np.union1d(voxels,flat[new])
+    rows=np.concatenate([np.searchsorted(grown,voxels),np.searchsorted(grown,flat[new])])
+    cols=np.concatenate([np.arange(len(voxels)),source[new]])
+    return grown, scipy.sparse.csr_matrix((np.ones(len(rows)),(rows,cols)),shape=(len(grown),len(voxels)))
+
+def build_surf2vol(surf_a, surf_b, grid_file, f_steps=15, n_grow=2, mask=None):
+    '''Projection of the vertices of surf_a/surf_b (same mesh) into the grid of grid_file'''
+    coords_a,_=read_surface(surf_a)
+    coords_b,_=read_surface(surf_b)
+    if coords_a.shape != coords_b.shape:
+        raise ValueError('{} and {} do not share a mesh'.format(surf_a,surf_b))
+    grid=nib.load(grid_file)
+    grid_shape=tuple(int(n) for n in grid.shape[:3])
+    voxels,matrix=segment_voxels(coords_a,coords_b,grid.affine,grid_shape,f_steps)
+    for _ in range(n_grow):
+        voxels,grow=grow_matrix(voxels,grid_shape,mask)
+        matrix=grow@matrix
+    return Surf2Vol(matrix.tocsr(),voxels,grid_shape,np.asarray(grid.affine,dtype=np.float64))
+
+def save_surf2vol(fname, projection):
+    '''Write a projection to an .npz file'''
+    matrix=projection.matrix
+    np.savez(fname,data=matrix.data,indices=matrix.indices,indptr=matrix.indptr,shape=np.array(matrix.shape),
+             voxels=projection.voxels,grid_shape=np.array(projection.grid_shape),affine=projection.affine)
+
+def read_surf2vol(fname):
+    '''Read a projection written by save_surf2vol'''
+    with np.load(fname) as npz:
+        matrix=scipy.sparse.csr_matrix((npz['data'],npz['indices'],npz['indptr']),shape=tuple(npz['shape']))
+        return Surf2Vol(matrix,npz['voxels'],tuple(int(n) for n in npz['grid_shape']),npz['affine'])
+
+def read_mask(mask_file, grid_shape):
+    '''Non-zero voxels of mask_file, which must be on a grid of grid_shape'''
+    mask=np.asanyarray(nib.load(mask_file).dataobj)
+    if tuple(mask.shape[:3]) != tuple(grid_shape[:3]):
+        raise ValueError('Mask {} has shape {}, not the grid shape {}'.format(mask_file,mask.shape[:3],tuple(grid_shape[:3])))
+    return mask.reshape(mask.shape[:3]+(-1,))[...,0] != 0
+
+def surf2vol_projection(surf_a, surf_b, grid_file, f_steps=15, n_grow=2, mask_file=None, cache_dir=None):
+    '''Projection of surf_a/surf_b into the grid of grid_file, growing only into the non-zero voxels of
+    mask_file (everywhere if None), reused from cache_dir (default: the folder of grid_file) as long as
+    the surfaces, grid, mask and settings are unchanged'''
+    if cache_dir is None:
+        cache_dir=os.path.dirname(os.path.abspath(grid_file))
+    os.makedirs(cache_dir,exist_ok=True)
+    file_hash=hashlib.sha1(b'surf2vol')
+    for path in surf_a,surf_b,grid_file:
+        hash_files([path],file_hash)
+    if mask_file is not None:
+        hash_files([mask_file],file_hash)
+    file_hash.update('{} {}'.format(f_steps,n_grow).encode())
+    cache_file=os.path.join(cache_dir,'surf2vol-{}.npz'.format(file_hash.hexdigest()[:16]))
+    return cached_file(cache_file,
+                       lambda: build_surf2vol(surf_a,surf_b,grid_file,f_steps,n_grow,
+                                              None if mask_file is None else read_mask(mask_file,nib.load(grid_file).shape)),
+                       read_surf2vol,save_surf2vol)
+
+def project_surface(projection, data):
+    '''Non-zero average of data (n_vertices,) or (n_vertices, n_maps) in every voxel of the projection;
+    returns (n_voxels,) or (n_voxels, n_maps), 0 where all contributing values are 0'''
+    data=np.asarray(data,dtype=np.float64)
+    squeeze=data.ndim == 1
+    data=data.reshape(len(data),-1)
+    if len(data) != projection.matrix.shape[1]:
+        raise ValueError('Data has {} rows for a projection of {} vertices'.format(len(data),projection.matrix.shape[1]))
+    total=projection.matrix@np.hstack([data,data != 0])
+    values,counts=np.split(total,2,axis=1)
+    values=np.divide(values,counts,out=np.zeros_like(values),where=counts > 0)
+    return values[:,0] if squeeze else values
+
+def voxels_to_volume(voxels, grid_shape, values, dtype=np.float32):
+    '''Volume of grid_shape holding values (n_voxels,) or (n_voxels, n_maps) at the flat indices voxels, 0 elsewhere'''
+    values=np.asarray(values)
+    volume=np.zeros((int(np.prod(grid_shape)),)+values.shape[1:],dtype=dtype)
+    volume[voxels]=values
+    return volume.reshape(tuple(grid_shape)+values.shape[1:])
+
+def to_volume(projection, values, dtype=np.float32):
+    '''Volume of the grid holding values (n_voxels,) or (n_voxels, n_maps) at the projection voxels, 0 elsewhere'''
+    return voxels_to_volume(projection.voxels,projection.grid_shape,values,dtype)
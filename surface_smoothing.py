@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Heat-kernel smoothing of surface data in process (replaces SurfSmooth -met HEAT_07)
+
+The mesh (GIFTI or Freesurfer surface, e.g. std.60.lh.smoothwm.gii) is read with
+nibabel and turned once into a sparse diffusion operator: each step replaces a
+vertex value with the Gaussian-weighted mean of itself and its neighbours,
+exp(-d^2/(2*sigma^2)) with sigma the mean edge length. The operator is cached
+per mesh file.
+
+As with SurfSmooth -target_fwhm, the steps are repeated until the data
+themselves reach the target smoothness. The FWHM of a column is estimated from
+the correlation of values across mesh edges,
+    rho=1-var(f(p)-f(q))/(2*var(f)),   FWHM=d*sqrt(-2*ln(2)/ln(rho))
+(d the mean edge length), and each column stops diffusing when it reaches
+target_fwhm. All columns (timepoints) are smoothed together, one sparse by
+dense product per step.
+
+Usage:
+    smoothed=heat_smooth(lh_smoothwm, values, target_fwhm=20)    # values (n_nodes,) or (n_nodes, n_times)
+"""
+import os
+from functools import lru_cache
+import numpy as np
+import scipy.sparse
+import nibabel as nib
+
+#Upper bound on the number of diffusion steps (SurfSmooth -Niter -1 stops when the target is reached)
+max_iter=2000
+
+@lru_cache(maxsize=8)
+def read_surface_cached(surf_file, mtime):
+    '''Vertex coordinates and triangles of a surface; mtime only serves as part of the cache key'''
+    if surf_file.endswith('.gii'):
+        img=nib.load(surf_file)
+        coords=img.get_arrays_from_intent('NIFTI_INTENT_POINTSET')[0].data
+        faces=img.get_arrays_from_intent('NIFTI_INTENT_TRIANGLE')[0].data
+    else:
+        coords,faces=nib.freesurfer.read_geometry(surf_file)
+    return np.asarray(coords,dtype=np.float64), np.asarray(faces,dtype=np.int64)
+
+def read_surface(surf_file):
+    '''Vertex coordinates (n_nodes, 3) and triangles (n_faces, 3) of a surface, cached per file'''
+    return read_surface_cached(surf_file,os.stat(surf_file).st_mtime_ns)
+
+def mesh_edges(faces):
+    '''Unique undirected edges (n_edges, 2) of a triangle mesh'''
+    edges=np.concatenate([faces[:,[0,1]],faces[:,[1,2]],faces[:,[2,0]]])
+    edges=np.sort(edges,axis=1)
+    return np.unique(edges,axis=0)
+
+@lru_cache(maxsize=8)
+def heat_operator_cached(surf_file, mtime):
+    '''Row-normalized diffusion operator, edges and mean edge length of a mesh'''
+    coords,faces=read_surface(surf_file)
+    edges=mesh_edges(faces)
+    lengths=np.linalg.norm(coords[edges[:,0]]-coords[edges[:,1]],axis=1)
+    sigma=lengths.mean()
+    weights=np.exp(-lengths**2/(2*sigma**2))
+    n_nodes=len(coords)
+    rows=np.concatenate([edges[:,0],edges[:,1],np.arange(n_nodes)])
+    cols=np.concatenate([edges[:,1],edges[:,0],np.arange(n_nodes)])
+    vals=np.concatenate([weights,weights,np.ones(n_nodes)])
+    operator=scipy.sparse.csr_matrix((vals,(rows,cols)),shape=(n_nodes,n_nodes))
+    operator=scipy.sparse.diags(1/np.asarray(operator.sum(axis=1)).ravel())@operator
+    return operator.tocsr(), edges, sigma
+
+def heat_operator(surf_file):
+    '''Diffusion operator (sparse n_nodes x n_nodes), edges and mean edge length of a mesh, cached per file'''
+    return heat_operator_cached(surf_file,os.stat(surf_file).st_mtime_ns)
+
+def estimate_fwhm(data, edges, edge_length):
+    '''FWHM (mesh units) of every column of data (n_nodes, n_cols) from the correlation across edges'''
+    var=data.var(axis=0)
+    diff_var=(data[edges[:,0]]-data[edges[:,1]]).var(axis=0)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        rho=1-diff_var/(2*var)
+        fwhm=edge_length*np.sqrt(-2*np.log(2)/np.log(rho))
+    # Constant columns are infinitely smooth; anti-correlated ones are rough
+    fwhm[~(rho > 0)]=0.
+    fwhm[var == 0]=np.inf
+    return fwhm
+
+def heat_smooth(surf_file, data, target_fwhm=20., max_iter=max_iter):
+    '''Diffuse data (n_nodes,) or (n_nodes, n_cols) on the mesh of surf_file until each column
+    reaches target_fwhm (mm); returns the smoothed data'''
+    operator,edges,edge_length=heat_operator(surf_file)
+    data=np.asarray(data,dtype=np.float64)
+    squeeze=data.ndim == 1
+    out=data.reshape(len(data),-1).copy()
+    if len(out) != operator.shape[0]:
+        raise ValueError('Data has {} rows for a mesh of {} vertices'.format(len(out),operator.shape[0]))
+    active=estimate_fwhm(out,edges,edge_length) < target_fwhm
+    n_iter=0
+    while active.any() and n_iter < max_iter:
+        out[:,active]=operator@out[:,active]
+        active[active]=estimate_fwhm(out[:,active],edges,edge_length) < target_fwhm
+        n_iter+=1
+    return out[:,0] if squeeze else out
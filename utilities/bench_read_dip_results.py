@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark the streaming dfit reader against the dictionary based reader
+
+Usage:
+    python bench_read_dip_results.py [dipole_fit_results_filename]
+
+If no file is given a synthetic dfit results file is written to a temporary
+directory, with n_blocks Fit_Results blocks of n_samples moving dipole fits
+"""
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from read_dip_results import assemble_dipole_dframe_from_dict, read_dipole_dframe
+
+n_blocks=20
+n_samples=5000
+repeats=3
+
+def write_synthetic_dip(filename, n_blocks=n_blocks, n_samples=n_samples, seed=0):
+    '''Write a dfit-like results file: a header block and n_blocks Fit_Results blocks
+    Each Fit_Results block has 13 header lines followed by tab separated dipole rows'''
+    rng=np.random.default_rng(seed)
+    with open(filename,'w') as fid:
+        fid.write('Dipole_File\n{\n\tVersion:\t1\n\n}\n')
+        for block in range(n_blocks):
+            fid.write('Fit_Results\n{\n')
+            for line in range(13):
+                fid.write('\t//header line {}\n'.format(line))
+            vals=rng.normal(size=(n_samples,23))
+            for sample in range(n_samples):
+                row=[str(sample),'',  '0',str(sample+600),'{:.6f}'.format(sample/600.)]
+                row+=['{:.4f}'.format(v) for v in vals[sample]]
+                row+=['avgspike_{}.0'.format(block)]
+                fid.write('\t'.join(row)+'\n')
+            fid.write('\n}\n')
+
+def time_reader(reader, filename):
+    '''Best wall time of repeats calls to reader'''
+    best=np.inf
+    for _ in range(repeats):
+        start=time.perf_counter()
+        dframe=reader(filename)
+        best=min(best,time.perf_counter()-start)
+    return best, dframe
+
+if __name__=='__main__':
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if len(sys.argv) > 1:
+            filename=sys.argv[1]
+        else:
+            filename=os.path.join(tmp_dir,'synthetic.dip')
+            write_synthetic_dip(filename)
+        dict_time,dict_dframe=time_reader(assemble_dipole_dframe_from_dict,filename)
+        stream_time,stream_dframe=time_reader(read_dipole_dframe,filename)
+        pd.testing.assert_frame_equal(dict_dframe,stream_dframe,check_dtype=False)
+        print('{} dipoles, {:.1f} MB'.format(len(stream_dframe),os.path.getsize(filename)/1e6))
+        print('dictionary reader: {:.3f} s'.format(dict_time))
+        print('streaming reader:  {:.3f} s ({:.1f}x)'.format(stream_time,dict_time/stream_time))
@@ -1,51 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Relate the vertices of a SUMA standard mesh to the dSPM virtual sensors
+
+build_suma2mne joins the vertex table of stc2gii_align.py (every vertex, its
+nearest node and the two other nodes of the triangle holding its projection,
+with their barycentric weights) with the coordinates of the virtual sensors, on
+the integer node numbers, into the <subj>_<hemi>_suma2mne.csv table.
+save_suma2mne_index writes the three nodes and weights of every vertex as the
+binary index read by suma_mapping.compile_suma2mne. offset is added to the node
+numbers (the number of left hemisphere sources for the right hemisphere).
+
+Usage:
+    out_df=build_suma2mne(vertex_to_node, node_locs, offset)
+    save_suma2mne_index(os.path.join(dspm_dir,subj+'_'+hemi+'_suma2mne.npz'), vertex_to_node, offset)
+"""
 import pandas as pd
-import os
 import numpy as np
-import sys
 
-subj = sys.argv[1] # Read in subject of interest
-dspm_dir = sys.argv[2] # Read in folder that contains dSPM information
-hemi = sys.argv[3] # Read in hemisphere being analyzed
-
-os.chdir(dspm_dir)
-
-# Read in coordinates from the correctly shifted surface; drop the column that doesn't represent 
-node_locs=pd.read_csv('myhead-'+hemi+'_inv_shifted.gii.coord.1D.dset',skiprows=9,header=None,delim_whitespace=True)
-node_locs=node_locs.rename(columns={0:'virtual_sensor_node',1:'SUMA_X',2:'SUMA_Y',3:'SUMA_Z'})
-
-# Write the second half of nodes if you are iterating through the second (right) hemisphere
-if hemi == 'rh':
-    node_locs['virtual_sensor_node']=node_locs['virtual_sensor_node']+2562
-
-#Read in corresponding virtual sensors for each vertex
-vertex_to_node=pd.read_csv(hemi+'.std.60.1D',skiprows=16,delim_whitespace=True)
-vertex_to_node=vertex_to_node.rename(columns={'#0':'vertex','#1':'First node','#2':'Second node','#3':'Third node','#4':'First node weight','#5':'Second node weight','#6':'Third node weight'})
-
-# Make a table that contains all of the information relating virtual sensors to the node
-out_df=pd.DataFrame(columns=['SUMA_vertex','virtual_sensor_node','SUMA_X','SUMA_Y','SUMA_Z'])
-for vertex in vertex_to_node['vertex']:
-    node=float(vertex_to_node['First node'][vertex_to_node[vertex_to_node['vertex']==vertex].index.values])
-    if node != -1:
-        if hemi == 'rh':
-            node=float(vertex_to_node['First node'][vertex_to_node[vertex_to_node['vertex']==vertex].index.values])+2562
-        index=(np.where(node_locs['virtual_sensor_node']==node))[0][0]
-        SUMA_X=node_locs['SUMA_X'][index]
-        SUMA_Y=node_locs['SUMA_Y'][index]
-        SUMA_Z=node_locs['SUMA_Z'][index]
-        tmp_dict={'SUMA_vertex':vertex,'virtual_sensor_node':node,'SUMA_X':SUMA_X,'SUMA_Y':SUMA_Y,'SUMA_Z':SUMA_Z}
-        tmp_df=pd.DataFrame(tmp_dict,index=[node])
-        out_df=pd.concat([out_df,tmp_df])
-out_df=out_df.reset_index()
-out_df=out_df.drop(columns=['index'])
-
-# Write out the table to the dspm directory
-if 'SUMA_X' in locals():
-    outname=subj+'_'+hemi+'_suma2mne.csv'
-    out=os.path.join(dspm_dir,outname)
-    out_df.to_csv(out,sep=' ',index=False)
-
-# Remove extra files containing information about the standard mesh
-os.chdir(dspm_dir)
-for file in os.listdir(os.getcwd()):
-    if 'std.60.' in file:
-        os.remove(file)
+def build_suma2mne(vertex_to_node, node_locs, offset=0):
+    '''Table relating every SUMA vertex with a first node to its virtual sensor (node + offset) and the
+    coordinates of the virtual sensor, in vertex order'''
+    nodes=node_locs.assign(virtual_sensor_node=node_locs['virtual_sensor_node'].astype(np.int64)+offset)
+    nodes=nodes.drop_duplicates('virtual_sensor_node',keep='first')
+    mapped=vertex_to_node.loc[vertex_to_node['First node'] != -1,['vertex','First node']]
+    mapped=pd.DataFrame({'SUMA_vertex':mapped['vertex'].to_numpy().astype(np.int64),
+                         'virtual_sensor_node':mapped['First node'].to_numpy().astype(np.int64)+offset})
+    return mapped.merge(nodes,on='virtual_sensor_node',how='inner',sort=False)
+
+def save_suma2mne_index(fname, vertex_to_node, offset=0):
+    '''Write the vertices, their three virtual sensors (-1 where there is none) and barycentric weights as .npz'''
+    nodes=vertex_to_node[['First node','Second node','Third node']].to_numpy().astype(np.int64)
+    weights=vertex_to_node[['First node weight','Second node weight','Third node weight']].to_numpy().astype(np.float64)
+    np.savez(fname,vertex=vertex_to_node['vertex'].to_numpy().astype(np.int64),
+             node=np.where(nodes >= 0,nodes+offset,-1),weight=np.where(nodes >= 0,weights,0.))
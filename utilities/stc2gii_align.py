@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Align the dSPM source space with the SUMA standard mesh in process (replaces get_new_stc2gii.sh)
+
+For each hemisphere, on NumPy arrays and without intermediate files:
+    surface     the decimated source space surface of mymodel.fif, in mm (the
+                surface stc2gii_hack writes to myhead-<hemi>.gii)
+    alignment   the inverse of the trans matrix (as ConvertSurface -ixmat_1D
+                trans_mat.1D), then the translation moving the centroid of the
+                surface onto the centroid of std.60.<hemi>.smoothwm.gii, applied
+                as a single affine; each hemisphere gets its own translation
+    mapping     every std.60 vertex is related to its nearest source node
+                (KD-tree) and to the other two nodes of the triangle around
+                that node that holds its projection, with the barycentric
+                weights clipped to the triangle (as the columns of SurfToSurf)
+The suma2mne table and binary index are then built with mne2suma.py. Both
+hemispheres run concurrently.
+
+Usage:
+    align_source_space(subj, fs_dir, dspm_dir, trans_file)     (as do_dspm_clustering.py does)
+    python stc2gii_align.py subj freesurfer_dir dspm_dir trans_file_path
+"""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import mne
+from scipy.spatial import cKDTree
+from mne2suma import build_suma2mne, save_suma2mne_index
+
+def read_trans_matrix(trans_file):
+    '''4x4 matrix of a .fif trans file, as written to trans_mat.1D by write_trans_1D.py'''
+    trans_arr=mne.read_trans(trans_file)['trans']
+    if not np.array_equal(trans_arr[3,:],np.array([0,0,0,1])):
+        raise ValueError('Manually verify fourth row of transformation matrix in {}'.format(trans_file))
+    return trans_arr
+
+def decimated_surfaces(src_file, scale_rr=1e3):
+    '''Vertex coordinates (mm) and triangles of the decimated surfaces (lh, rh) of a source space'''
+    surfaces=[]
+    for s in mne.read_source_spaces(src_file,verbose=False):
+        if s['type'] != 'surf':
+            continue
+        reindex=np.full(len(s['rr']),-1,int)
+        reindex[s['vertno']]=np.arange(len(s['vertno']))
+        surfaces.append((s['rr'][s['vertno']]*scale_rr,reindex[s['use_tris']]))
+    if len(surfaces) != 2:
+        raise ValueError('{} contains {} surface source spaces, should be exactly 2'.format(src_file,len(surfaces)))
+    return surfaces
+
+def read_gifti_surface(surf_file):
+    '''Vertex coordinates and triangles of a GIFTI surface'''
+    img=nib.load(surf_file)
+    return (np.asarray(img.get_arrays_from_intent('NIFTI_INTENT_POINTSET')[0].data,dtype=np.float64),
+            np.asarray(img.get_arrays_from_intent('NIFTI_INTENT_TRIANGLE')[0].data,dtype=np.int64))
+
+def alignment_affine(coords, trans, std_coords):
+    '''Affine applying the inverse of trans, then moving the centroid of coords onto that of std_coords'''
+    inverse=np.linalg.inv(trans)
+    shift=np.eye(4)
+    shift[:3,3]=std_coords.mean(axis=0)-nib.affines.apply_affine(inverse,coords).mean(axis=0)
+    return shift@inverse
+
+def vertex_faces(faces, n_nodes):
+    '''Triangles around every node, as (n_nodes, max_degree) padded with -1'''
+    node=faces.ravel()
+    face=np.repeat(np.arange(len(faces)),3)
+    order=np.argsort(node,kind='stable')
+    node,face=node[order],face[order]
+    degree=np.bincount(node,minlength=n_nodes)
+    position=np.arange(len(node))-np.repeat(np.cumsum(degree)-degree,degree)
+    around=np.full((n_nodes,max(degree.max(),1)),-1,dtype=np.int64)
+    around[node,position]=face
+    return around
+
+def surf2surf_nearest(points, coords, faces):
+    '''Nearest node of the surface (coords, faces) to every point, the two other nodes of the triangle around it
+    holding the projection of the point and the barycentric weights, in the columns of a SurfToSurf .1D'''
+    _,nearest=cKDTree(coords).query(points)
+    around=vertex_faces(faces,len(coords))[nearest]
+    candidate=np.where(around >= 0,around,0)
+    a,b,c=(coords[faces[candidate,k]] for k in range(3))
+    v0,v1,v2=b-a,c-a,points[:,np.newaxis]-a
+    d00,d01,d11=(v0*v0).sum(-1),(v0*v1).sum(-1),(v1*v1).sum(-1)
+    d20,d21=(v2*v0).sum(-1),(v2*v1).sum(-1)
+    denom=d00*d11-d01*d01
+    with np.errstate(divide='ignore',invalid='ignore'):
+        wb=(d11*d20-d01*d21)/denom
+        wc=(d00*d21-d01*d20)/denom
+    wa=1-wb-wc
+    weights=np.stack([wa,wb,wc],axis=-1)
+    # The triangle whose barycentric weights are least negative holds the projection, or is closest to holding it
+    # (the projection of a point above a convex node falls just outside every triangle around it)
+    score=np.where((around >= 0) & np.isfinite(weights).all(axis=-1),weights.min(axis=-1),-np.inf)
+    best=np.argmax(score,axis=1)
+    found=np.isfinite(score[np.arange(len(points)),best])
+    rows=np.arange(len(points))
+    tri_nodes=faces[candidate[rows,best]]
+    tri_weights=np.clip(weights[rows,best],0,None)
+    # Put the nearest node first, keeping the order of the triangle
+    first=np.argmax(tri_nodes == nearest[:,np.newaxis],axis=1)
+    roll=(np.arange(3)[np.newaxis]+first[:,np.newaxis])%3
+    tri_nodes=np.take_along_axis(tri_nodes,roll,axis=1)
+    tri_weights=np.take_along_axis(tri_weights,roll,axis=1)
+    tri_weights/=tri_weights.sum(axis=1,keepdims=True)
+    nodes=np.where(found[:,np.newaxis],tri_nodes,np.stack([nearest,np.full(len(points),-1),np.full(len(points),-1)],axis=1))
+    node_weights=np.where(found[:,np.newaxis],tri_weights,np.array([1.,0.,0.]))
+    return pd.DataFrame({'vertex':np.arange(len(points)),'First node':nodes[:,0],'Second node':nodes[:,1],'Third node':nodes[:,2],
+                         'First node weight':node_weights[:,0],'Second node weight':node_weights[:,1],'Third node weight':node_weights[:,2]})
+
+def align_hemisphere(subj, fs_dir, dspm_dir, hemi, surface, trans, offset=0):
+    '''Write the suma2mne table and binary index of one hemisphere of the source space
+    offset is added to the node numbers (the number of left hemisphere sources for the right hemisphere)'''
+    coords,faces=surface
+    std_coords,_=read_gifti_surface(os.path.join(fs_dir,'SUMA','std.60.'+hemi+'.smoothwm.gii'))
+    affine=alignment_affine(coords,trans,std_coords)
+    inv_shifted=nib.affines.apply_affine(np.linalg.inv(trans),coords)
+    vertex_to_node=surf2surf_nearest(std_coords,nib.affines.apply_affine(affine,coords),faces)
+    node_locs=pd.DataFrame({'virtual_sensor_node':np.arange(len(coords)),'SUMA_X':inv_shifted[:,0],
+                            'SUMA_Y':inv_shifted[:,1],'SUMA_Z':inv_shifted[:,2]})
+    out_df=build_suma2mne(vertex_to_node,node_locs,offset)
+    if len(out_df) > 0:
+        out_df.to_csv(os.path.join(dspm_dir,subj+'_'+hemi+'_suma2mne.csv'),sep=' ',index=False)
+        save_suma2mne_index(os.path.join(dspm_dir,subj+'_'+hemi+'_suma2mne.npz'),vertex_to_node,offset)
+    return hemi, len(out_df)
+
+def align_source_space(subj, fs_dir, dspm_dir, trans_file):
+    '''Write the suma2mne tables and binary indices of both hemispheres of dspm_dir/mymodel.fif, concurrently
+    Raises ValueError if no SUMA vertex of a hemisphere is related to a virtual sensor'''
+    trans=read_trans_matrix(trans_file)
+    surfaces=decimated_surfaces(os.path.join(dspm_dir,'mymodel.fif'))
+    # Virtual sensors of the right hemisphere follow those of the left hemisphere
+    offsets=(0,len(surfaces[0][0]))
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        jobs=[pool.submit(align_hemisphere,subj,fs_dir,dspm_dir,hemi,surface,trans,offset)
+              for hemi,surface,offset in zip(('lh','rh'),surfaces,offsets)]
+        for job in jobs:
+            hemi,n_mapped=job.result()
+            if n_mapped == 0:
+                raise ValueError('No SUMA vertex of {} is related to a virtual sensor; check {} and {}'.format(hemi,trans_file,fs_dir))
+            print('{}: {} SUMA vertices related to virtual sensors'.format(hemi,n_mapped))
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5:
+        sys.exit('usage: {} subj freesurfer_dir dspm_dir trans_file_path'.format(sys.argv[0]))
+    align_source_space(*sys.argv[1:5])